@@ -0,0 +1,218 @@
+"""
+Admission control for generation requests: per-client limits and fair ordering
+
+Only `max_concurrent` generations run at once (one for direct generation,
+the batch size with the scheduler); the rest wait here. Waiting requests are
+ordered by weighted fair queueing on their token budget, so a client sending
+2048-token questions moves to the back behind everyone else's first
+question, and optionally by shortest job first.
+"""
+import itertools
+import logging
+import threading
+import time
+from typing import Callable, Dict, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+# Token budget charged for an image question (its answers are capped at 300 tokens)
+IMAGE_COST = 300
+
+
+class Ticket:
+    """One request's place in the admission queue"""
+
+    def __init__(self, number: int, client_id: str, cost: int, start_tag: float, finish_tag: float):
+        self.number = number
+        self.client_id = client_id
+        self.cost = cost
+        self.start_tag = start_tag
+        self.finish_tag = finish_tag
+        self.entered = time.time()
+        self.admitted: Optional[float] = None
+
+
+class Rejected(Exception):
+    """The request was turned away; `reason` is 'queue_full' or 'client_limit'"""
+
+    def __init__(self, reason: str, message: str):
+        super().__init__(message)
+        self.reason = reason
+
+
+class AdmissionController:
+    """
+    Decides which waiting request runs next.
+
+    Every client accumulates virtual time at `cost / weight` per request
+    (start-time fair queueing), and requests are admitted in order of their
+    virtual finish time, so one client's requests interleave with everyone
+    else's instead of running back to back. With `shortest_first` the
+    cheapest waiting request goes first instead; anything that has waited
+    longer than `starvation_seconds` still goes ahead of it.
+
+    Like PendingRequestQueue, handlers poll with their server's cooperative sleep.
+    """
+
+    def __init__(self, max_concurrent: int = 1, max_queue: int = 32, max_per_client: int = 2,
+                 shortest_first: bool = False, starvation_seconds: float = 30.0):
+        self.max_concurrent = max(1, max_concurrent)
+        self.max_queue = max_queue
+        self.max_per_client = max(1, max_per_client)
+        self.shortest_first = shortest_first
+        self.starvation_seconds = starvation_seconds
+
+        self._lock = threading.Lock()
+        self._counter = itertools.count(1)
+        self._waiting: Dict[int, Ticket] = {}
+        self._running: Dict[int, Ticket] = {}
+        self._client_finish: Dict[str, float] = {}
+        self._virtual_time = 0.0
+        self._order: Optional[List[Ticket]] = None
+
+        # Seconds a slot stays busy per request (moving average), for wait estimates
+        self.service_seconds = 10.0
+        self.admitted = 0
+        self.rejected = {'queue_full': 0, 'client_limit': 0}
+        self.abandoned = 0
+
+    def enter(self, client_id: str, cost: int, weight: float = 1.0) -> Ticket:
+        """Queue a request costing `cost` tokens; raises Rejected if it may not wait"""
+        with self._lock:
+            in_flight = sum(1 for t in self._waiting.values() if t.client_id == client_id)
+            in_flight += sum(1 for t in self._running.values() if t.client_id == client_id)
+            if in_flight >= self.max_per_client:
+                self.rejected['client_limit'] += 1
+                raise Rejected('client_limit', f"You already have {in_flight} question(s) in progress. "
+                                               f"Please wait for an answer before asking more.")
+            if len(self._waiting) >= self.max_queue:
+                self.rejected['queue_full'] += 1
+                raise Rejected('queue_full', "The tutor is busy answering other students. Please try again shortly.")
+
+            start_tag = max(self._virtual_time, self._client_finish.get(client_id, 0.0))
+            finish_tag = start_tag + max(1, cost) / max(weight, 1e-6)
+            self._client_finish[client_id] = finish_tag
+            ticket = Ticket(next(self._counter), client_id, cost, start_tag, finish_tag)
+            self._waiting[ticket.number] = ticket
+            self._order = None
+            return ticket
+
+    def _ordered(self) -> List[Ticket]:
+        """Waiting tickets in admission order (caller holds the lock)"""
+        if self._order is None:
+            if self.shortest_first:
+                starved_before = time.time() - self.starvation_seconds
+                key = lambda t: (t.entered > starved_before, t.cost if t.entered > starved_before else t.entered,
+                                 t.finish_tag)
+            else:
+                key = lambda t: (t.finish_tag, t.number)
+            self._order = sorted(self._waiting.values(), key=key)
+        return self._order
+
+    def position(self, ticket: Ticket) -> int:
+        """1-based place in line (0 once admitted or dropped)"""
+        with self._lock:
+            if ticket.number not in self._waiting:
+                return 0
+            if self.shortest_first:
+                # Starvation depends on the clock, so the order can change without a new arrival
+                self._order = None
+            return self._ordered().index(ticket) + 1
+
+    def estimated_wait(self, position: int) -> float:
+        """Seconds until a request at `position` should start, from recent service times"""
+        with self._lock:
+            busy = len(self._running) >= self.max_concurrent
+        rounds = (position - 1) // self.max_concurrent + (1 if busy else 0)
+        return rounds * self.service_seconds
+
+    def try_admit(self, ticket: Ticket) -> bool:
+        """Admit the ticket if a slot is free and it is next in line"""
+        with self._lock:
+            if ticket.number not in self._waiting or len(self._running) >= self.max_concurrent:
+                return False
+            if self.shortest_first:
+                self._order = None
+            # Any of the first free-slot tickets may go, so one slow poller doesn't hold up the rest
+            free = self.max_concurrent - len(self._running)
+            if ticket not in self._ordered()[:free]:
+                return False
+            del self._waiting[ticket.number]
+            self._order = None
+            self._running[ticket.number] = ticket
+            self._virtual_time = max(self._virtual_time, ticket.start_tag)
+            ticket.admitted = time.time()
+            self.admitted += 1
+            return True
+
+    def release(self, ticket: Ticket):
+        """Free the ticket's slot (or its place in line) once the request is done"""
+        with self._lock:
+            if self._waiting.pop(ticket.number, None) is not None:
+                self._order = None
+                self.abandoned += 1
+            elif self._running.pop(ticket.number, None) is not None and ticket.admitted is not None:
+                self.service_seconds += 0.2 * ((time.time() - ticket.admitted) - self.service_seconds)
+            self._forget_idle_clients()
+
+    def drop_client(self, client_id: str):
+        """Forget a disconnected client's waiting requests"""
+        with self._lock:
+            for number in [n for n, t in self._waiting.items() if t.client_id == client_id]:
+                del self._waiting[number]
+                self.abandoned += 1
+            self._order = None
+            self._forget_idle_clients()
+
+    def _forget_idle_clients(self):
+        """Drop finish tags that no longer affect ordering (caller holds the lock)"""
+        active = {t.client_id for t in self._waiting.values()} | {t.client_id for t in self._running.values()}
+        for client_id in [c for c, tag in self._client_finish.items()
+                          if c not in active and tag <= self._virtual_time]:
+            del self._client_finish[client_id]
+
+    def poll(self, ticket: Ticket, cancelled: Optional[Callable[[], bool]] = None) -> Tuple[Optional[str], int]:
+        """One step of waiting: (outcome, position), where outcome None means keep waiting at `position`"""
+        if cancelled is not None and cancelled():
+            self.release(ticket)
+            return 'cancelled', 0
+        if self.try_admit(ticket):
+            return 'admitted', 0
+        position = self.position(ticket)
+        return ('dropped', 0) if position == 0 else (None, position)
+
+    def wait(self, ticket: Ticket, sleep: Callable[[float], None],
+             on_position: Optional[Callable[[int], None]] = None,
+             cancelled: Optional[Callable[[], bool]] = None,
+             poll_interval: float = 0.05, position_interval: float = 2.0) -> str:
+        """
+        Wait (cooperatively) for a slot: 'admitted', 'cancelled' or 'dropped'.
+
+        on_position(position) is called when the request starts waiting, when
+        its place changes and at least every `position_interval` seconds.
+        """
+        last_position, last_report = None, 0.0
+        while True:
+            outcome, position = self.poll(ticket, cancelled)
+            if outcome is not None:
+                return outcome
+            now = time.time()
+            if on_position is not None and (position != last_position or now - last_report >= position_interval):
+                on_position(position)
+                last_position, last_report = position, now
+            sleep(poll_interval)
+
+    def get_stats(self) -> dict:
+        with self._lock:
+            return {
+                'running': len(self._running),
+                'waiting': len(self._waiting),
+                'max_concurrent': self.max_concurrent,
+                'max_queue': self.max_queue,
+                'max_per_client': self.max_per_client,
+                'shortest_first': self.shortest_first,
+                'admitted': self.admitted,
+                'rejected': dict(self.rejected),
+                'abandoned': self.abandoned,
+                'service_seconds': round(self.service_seconds, 2),
+            }
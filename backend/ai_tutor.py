@@ -3,13 +3,31 @@ AI Tutor using the cached Gemma3n E2B-it model
 """
 import os
 import torch
-from transformers import AutoProcessor, Gemma3nForConditionalGeneration
+from transformers import AutoProcessor, DynamicCache, Gemma3nForConditionalGeneration, StoppingCriteriaList
 from PIL import Image
 import requests
 import logging
 import time
 import io
 import base64
+import asyncio
+import queue
+import threading
+import functools
+import json
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, List, Optional
+
+from streaming import CallbackStreamer, CancelledCriteria, DeadlineCriteria, RowFinishedCriteria
+from deadline import Deadline, DecodeRate
+from prefix_cache import PrefixKVCache, PrefixEntry, fork_cache
+from image_cache import ImageFeatureCache, ImageEntry, image_content_key
+from image_ingest import ImageIngestor, check_bytes
+from quantization import normalize_mode, pack_model, quantize_model
+from speculative import SpeculativeDecoder
+import metrics
+from profiling import RequestProfiler, profiled
 
 # Fix Unicode encoding issues
 os.environ['PYTHONIOENCODING'] = 'utf-8'
@@ -17,14 +35,116 @@ os.environ['HF_HUB_USER_AGENT'] = 'transformers/4.53.0; python/3.12'
 
 logger = logging.getLogger(__name__)
 
+@contextmanager
+def track_shard_progress(on_progress: Optional[Callable[[str, dict], None]]):
+    """Call on_progress after each checkpoint shard from_pretrained finishes loading"""
+    if on_progress is None:
+        yield
+        return
+
+    import transformers.modeling_utils as modeling_utils
+    original = modeling_utils.load_shard_file
+    lock = threading.Lock()
+    progress = {'shards_loaded': 0, 'shards_total': 0, 'bytes_loaded': 0, 'bytes_total': 0}
+
+    def shard_sizes(shard_file: str) -> dict:
+        # Shards are listed in the index next to them; a single-file checkpoint has no index
+        folder = os.path.dirname(shard_file)
+        index_path = os.path.join(folder, 'model.safetensors.index.json')
+        names = [os.path.basename(shard_file)]
+        if os.path.isfile(index_path):
+            with open(index_path, 'r', encoding='utf-8') as f:
+                names = sorted(set(json.load(f)['weight_map'].values()))
+        return {name: os.path.getsize(os.path.join(folder, name)) for name in names}
+
+    def load_shard_file(args):
+        result = original(args)
+        shard_file = args[0]
+        if shard_file:
+            with lock:
+                if not progress['shards_total']:
+                    sizes = shard_sizes(shard_file)
+                    progress.update(shards_total=len(sizes), bytes_total=sum(sizes.values()))
+                progress['shards_loaded'] += 1
+                progress['bytes_loaded'] += os.path.getsize(shard_file)
+                snapshot = dict(progress)
+            try:
+                on_progress(
+                    f"📦 Loaded weight shard {snapshot['shards_loaded']}/{snapshot['shards_total']} "
+                    f"({snapshot['bytes_loaded'] / 1024**3:.1f}/{snapshot['bytes_total'] / 1024**3:.1f} GB)",
+                    snapshot
+                )
+            except Exception as e:
+                logger.warning(f"⚠️ Progress callback failed: {e}")
+        return result
+
+    modeling_utils.load_shard_file = load_shard_file
+    try:
+        yield
+    finally:
+        modeling_utils.load_shard_file = original
+
+# Placeholder used to find where the user turn starts in the rendered chat template
+USER_TURN_SENTINEL = "<<<__user_turn__>>>"
+
+def exclusive(method):
+    """Method decorator: run the call holding `self.model_lock`, so it never overlaps another model call"""
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        with self.model_lock:
+            return method(self, *args, **kwargs)
+    return wrapper
+
 class AITutor:
-    def __init__(self, model_id: str, hf_token: str):
+    def __init__(self, model_id: str, hf_token: str, settings=None):
         # Use the cached E2B model instead of E4B
         self.model_id = "google/gemma-3n-e2b-it"  # This one is already cached!
         self.hf_token = hf_token
+        self.settings = settings
         self.model = None
         self.processor = None
         
+        # KV cache of the rendered system prompts, shared by all requests
+        self.prefix_cache = PrefixKVCache(int(self._setting('prefix_cache_max_mb', 256) * 1024**2))
+        
+        # Preprocessed pixels and vision tower output of recently seen images
+        self.image_cache = ImageFeatureCache(int(self._setting('image_cache_max_mb', 512) * 1024**2))
+        self._active_image: Optional[ImageEntry] = None
+        self._active_batch: Optional[tuple] = None
+        self._compute_image_features = None
+        self._image_ingest: Optional[ImageIngestor] = None
+        
+        # Held by every forward pass outside the batch scheduler and by each scheduler step,
+        # so direct, image, embedding and batched work never run on the model at once
+        self.model_lock = threading.RLock()
+        
+        # Assisted decoding: a draft model (loaded in initialize() when DRAFT_MODEL_ID is set)
+        # or n-gram lookup in the prompt for long pasted questions
+        self.speculative = SpeculativeDecoder(
+            num_tokens=self._setting('speculative_tokens', 5),
+            min_acceptance=self._setting('speculative_min_acceptance', 0.35),
+            window=self._setting('speculative_window', 8),
+            lookup_tokens=self._setting('prompt_lookup_tokens', 10) if self._setting('prompt_lookup_enabled', False) else 0,
+            lookup_max_ngram=self._setting('prompt_lookup_max_ngram', 3),
+            lookup_min_tokens=self._setting('prompt_lookup_min_tokens', 150)
+        )
+        
+        # Decode speed of recent answers, to size token budgets to a deadline
+        self.decode_rate = DecodeRate()
+        
+        # Opt-in torch.profiler traces of single requests (asked for by the client, or sampled)
+        self.profiler = RequestProfiler(
+            enabled=self._setting('profiling_enabled', False),
+            sample_rate=self._setting('profiling_sample_rate', 0.0),
+            directory=self._setting('profiling_dir', ''),
+            max_files=self._setting('profiling_max_files', 20),
+            max_mb=self._setting('profiling_max_mb', 200),
+            top_ops=self._setting('profiling_top_ops', 15)
+        )
+        
+        # Seconds spent in each phase of initialize()
+        self.startup_timings = {}
+        
         # Check GPU availability
         if not torch.cuda.is_available():
             logger.warning("⚠️ CUDA not available, will use CPU")
@@ -33,8 +153,18 @@ class AITutor:
             self.device = "cuda"
             logger.info(f"🎮 GPU available: {torch.cuda.get_device_name()}")
         
-    def initialize(self):
-        """Initialize with cached Gemma3n E2B-it model"""
+        # Weight quantization only applies to CPU inference
+        self.quantization = normalize_mode(self._setting('cpu_quantization', 'none'))
+        if self.device != "cpu" and self.quantization != "none":
+            logger.info(f"ℹ️ cpu_quantization={self.quantization} ignored on GPU")
+            self.quantization = "none"
+        
+    def _setting(self, name: str, default):
+        """Read an optional value from Settings, tolerating fallback settings objects"""
+        return getattr(self.settings, name, default) if self.settings is not None else default
+
+    def initialize(self, on_progress: Optional[Callable[[str, dict], None]] = None):
+        """Initialize with cached Gemma3n E2B-it model, reporting (message, progress) per weight shard"""
         try:
             logger.info(f"🚀 Loading cached Gemma3n E2B-it: {self.model_id}")
             if torch.cuda.is_available():
@@ -49,44 +179,118 @@ class AITutor:
             if torch.cuda.is_available():
                 torch.cuda.empty_cache()
             
-            # Load the cached model (should work without network issues)
-            logger.info("🧠 Loading cached Gemma3n E2B-it model...")
-            self.model = Gemma3nForConditionalGeneration.from_pretrained(
-                self.model_id,
-                device_map="auto",
-                torch_dtype=torch.bfloat16 if torch.cuda.is_available() else torch.float32,
-                token=self.hf_token,
-                trust_remote_code=True,
-                use_safetensors=True,
-                low_cpu_mem_usage=True,
-                max_memory={0: "11GB"} if torch.cuda.is_available() else None,
-                local_files_only=True   # Use only cached files
-            ).eval()
-            
-            # Load processor
-            logger.info("🔧 Loading cached processor...")
-            self.processor = AutoProcessor.from_pretrained(
-                self.model_id,
-                token=self.hf_token,
-                trust_remote_code=True,
-                local_files_only=True   # Use only cached files
-            )
+            # Pre-converted (and quantized) CPU weights, memory-mapped instead of re-read and converted every start
+            snapshot = self._weight_snapshot()
+            from_snapshot = snapshot is not None and snapshot.is_current()
+            
+            # The processor (tokenizer + image processor) loads in parallel with the weights
+            start = time.perf_counter()
+            with ThreadPoolExecutor(max_workers=1, thread_name_prefix="processor-load") as pool, \
+                    track_shard_progress(on_progress):
+                processor_future = pool.submit(self._load_processor)
+                
+                if from_snapshot:
+                    logger.info(f"⚡ Memory-mapping weight snapshot {snapshot.path}...")
+                    self.model = snapshot.load(Gemma3nForConditionalGeneration, prepare=self._prepare_quantized)
+                else:
+                    # Load the cached model (should work without network issues)
+                    logger.info("🧠 Loading cached Gemma3n E2B-it model...")
+                    self.model = Gemma3nForConditionalGeneration.from_pretrained(
+                        self.model_id,
+                        device_map="auto",
+                        # The checkpoint is bf16: quantizing from it halves peak memory and loses nothing
+                        torch_dtype=torch.bfloat16 if torch.cuda.is_available() or self.quantization != "none" else torch.float32,
+                        token=self.hf_token,
+                        trust_remote_code=True,
+                        use_safetensors=True,
+                        low_cpu_mem_usage=True,
+                        max_memory={0: "11GB"} if torch.cuda.is_available() else None,
+                        local_files_only=True   # Use only cached files
+                    ).eval()
+                self.startup_timings['model_weights'] = time.perf_counter() - start
+                
+                self.processor = processor_future.result()
+            
+            if self.quantization != "none" and not from_snapshot:
+                quantize_start = time.perf_counter()
+                quantize_model(self.model, self.quantization)
+                self.startup_timings['quantize'] = time.perf_counter() - quantize_start
+            
+            if snapshot is not None and not from_snapshot:
+                write_start = time.perf_counter()
+                try:
+                    snapshot.save(self.model)
+                    # Serve from the mapped copy right away so this process shares pages with later ones
+                    self.model = snapshot.load(Gemma3nForConditionalGeneration, prepare=self._prepare_quantized)
+                except Exception as e:
+                    logger.warning(f"⚠️ Could not write weight snapshot: {e}")
+                self.startup_timings['snapshot_write'] = time.perf_counter() - write_start
+            
+            if self.quantization != "none":
+                pack_model(self.model)
+            self.startup_timings['model_and_processor'] = time.perf_counter() - start
             
             # Check where model actually loaded
             self._check_model_devices()
             
+            draft_model_id = self._setting('draft_model_id', '')
+            if draft_model_id:
+                draft_start = time.perf_counter()
+                try:
+                    self.speculative.load_draft(
+                        draft_model_id, self.model, self.model.config.get_text_config().vocab_size, token=self.hf_token
+                    )
+                except Exception as e:
+                    logger.warning(f"⚠️ Could not load draft model {draft_model_id}, speculative decoding off: {e}")
+                self.startup_timings['draft_model'] = time.perf_counter() - draft_start
+            self.speculative.install(self.model)
+            
             # Print GPU status
             if torch.cuda.is_available():
                 memory_mb = torch.cuda.memory_allocated() / 1024**2
                 memory_cached = torch.cuda.memory_reserved() / 1024**2
                 logger.info(f"📊 GPU Memory: {memory_mb:.0f}MB allocated, {memory_cached:.0f}MB cached")
             
-            logger.info("✅ Cached Gemma3n E2B-it loaded successfully!")
+            logger.info(f"✅ Cached Gemma3n E2B-it loaded successfully! "
+                        f"(weights {self.startup_timings['model_weights']:.1f}s, "
+                        f"processor {self.startup_timings['processor']:.1f}s in parallel)")
             
         except Exception as e:
             logger.error(f"❌ Failed to initialize cached Gemma3n E2B-it: {e}")
             raise
 
+    def _weight_snapshot(self):
+        """
+        The CPU weight snapshot to load from or write, or None when disabled or
+        running on GPU. Quantized weights are always persisted so the conversion runs once.
+        """
+        if self.device != "cpu":
+            return None
+        if self.quantization == "none" and not self._setting('weight_snapshot_enabled', False):
+            return None
+        from weight_snapshot import WeightSnapshot
+        return WeightSnapshot.for_model(
+            self.model_id, torch.float32,
+            variant="" if self.quantization == "none" else self.quantization,
+            base_dir=self._setting('weight_snapshot_dir', '') or None
+        )
+
+    def _prepare_quantized(self, model):
+        """Swap in empty quantized modules so a quantized snapshot can be mapped into them"""
+        return quantize_model(model, self.quantization, empty=True)
+
+    def _load_processor(self):
+        logger.info("🔧 Loading cached processor...")
+        start = time.perf_counter()
+        processor = AutoProcessor.from_pretrained(
+            self.model_id,
+            token=self.hf_token,
+            trust_remote_code=True,
+            local_files_only=True   # Use only cached files
+        )
+        self.startup_timings['processor'] = time.perf_counter() - start
+        return processor
+
     def _check_model_devices(self):
         """Check which devices the model parameters are on"""
         devices = {}
@@ -102,22 +306,8 @@ class AITutor:
 
     # Update the ask_ai_tutor method in ai_tutor.py to handle response style
 
-    def ask_ai_tutor(
-        self, 
-        question: str, 
-        subject: str = "General", 
-        language: str = "English", 
-        level: str = "middle_school",
-        max_tokens: int = 256,
-        response_style: str = "regular"  # ← ADD THIS PARAMETER
-    ) -> str:
-        """Generate text response using cached Gemma3n E2B-it"""
-        if not self.model or not self.processor:
-            raise RuntimeError("AI Tutor not initialized. Call initialize() first.")
-        
-        # Validate token count
-        max_tokens = max(50, min(2048, max_tokens))
-        
+    def build_system_prompt(self, subject: str, language: str, level: str) -> str:
+        """Render the subject/level/language system prompt"""
         # Create level and subject-specific system prompt
         level_descriptions = {
             "elementary": "elementary school students (age 6-12)",
@@ -130,10 +320,10 @@ class AITutor:
         
         level_desc = level_descriptions.get(level, "students")
         
-        # Build system prompt
-        system_content = f"You are a helpful {subject} tutor. Explain concepts clearly and appropriately for {level_desc}. Always respond in {language}. Be educational, engaging, and provide examples when helpful."
-        
-        # Handle response style modifications
+        return f"You are a helpful {subject} tutor. Explain concepts clearly and appropriately for {level_desc}. Always respond in {language}. Be educational, engaging, and provide examples when helpful."
+
+    def apply_response_style(self, question: str, response_style: str) -> str:
+        """Prefix the question according to the selected response style"""
         modified_question = question
         
         if response_style == "effective":
@@ -146,8 +336,22 @@ class AITutor:
             if response_style.strip():  # If there's a custom instruction
                 modified_question = response_style.strip() + ": " + question
         
+        return modified_question
+
+    def build_messages(
+        self,
+        question: str,
+        subject: str = "General",
+        language: str = "English",
+        level: str = "middle_school",
+        response_style: str = "regular"
+    ) -> list:
+        """Build the system + user chat messages for a text question"""
+        system_content = self.build_system_prompt(subject, language, level)
+        modified_question = self.apply_response_style(question, response_style)
+        
         # Create chat messages using the official format
-        messages = [
+        return [
             {
                 "role": "system",
                 "content": [{"type": "text", "text": system_content}]
@@ -157,30 +361,293 @@ class AITutor:
                 "content": [{"type": "text", "text": modified_question}]  # ← Use modified question
             }
         ]
+
+    def encode_messages(self, messages: list) -> list:
+        """Apply the chat template and return the prompt token ids as a list"""
+        inputs = self.processor.apply_chat_template(
+            messages,
+            add_generation_prompt=True,
+            tokenize=True,
+            return_dict=True,
+            return_tensors="pt",
+        )
+        return inputs["input_ids"][0].tolist()
+
+    def prepare_text_prompt(self, messages: list):
+        """Return (prompt token ids, cached system-prompt prefix or None)"""
+        input_ids = self.encode_messages(messages)
+        return input_ids, self.lookup_prefix(messages, input_ids)
+
+    def lookup_prefix(self, messages: list, input_ids: list) -> Optional[PrefixEntry]:
+        """Find (or compute) the KV cache for everything before the user's text"""
+        if not self.prefix_cache.enabled:
+            return None
+
+        prefix_text = self._render_prefix(messages)
+        if not prefix_text:
+            return None
+
+        prefix_ids = self.processor.tokenizer(prefix_text, add_special_tokens=False)["input_ids"]
+        # The prefix must tokenize identically inside the full prompt, and leave
+        # at least one token for the model to prefill.
+        if not prefix_ids or len(prefix_ids) >= len(input_ids) or input_ids[:len(prefix_ids)] != prefix_ids:
+            logger.debug("Prefix tokens do not match the full prompt, skipping prefix cache")
+            return None
+
+        return self.prefix_cache.get_or_compute(prefix_text, prefix_ids, self._compute_prefix_cache)
+
+    def _render_prefix(self, messages: list) -> Optional[str]:
+        """Render the chat template up to where the last user message's text begins"""
+        probe = messages[:-1] + [{
+            "role": messages[-1]["role"],
+            "content": [{"type": "text", "text": USER_TURN_SENTINEL}]
+        }]
+        rendered = self.processor.apply_chat_template(probe, add_generation_prompt=True, tokenize=False)
+        if USER_TURN_SENTINEL not in rendered:
+            return None
+        return rendered.split(USER_TURN_SENTINEL, 1)[0]
+
+    def prepare_session_turn(
+        self,
+        session,
+        question: str,
+        subject: str = "General",
+        language: str = "English",
+        level: str = "middle_school",
+        response_style: str = "regular"
+    ):
+        """
+        Return (messages, prompt token ids, past_key_values or None) for the next turn of a session.
+
+        A follow-up turn appends only the new user turn to the exact tokens of
+        the conversation so far, so the session's KV cache stays valid and only
+        the new tokens need a prefill.
+        """
+        if not session.has_history:
+            messages = self.build_messages(question, subject, language, level, response_style)
+            input_ids, prefix = self.prepare_text_prompt(messages)
+            return messages, input_ids, prefix.fork() if prefix is not None else None
+
+        user_message = {
+            "role": "user",
+            "content": [{"type": "text", "text": self.apply_response_style(question, response_style)}]
+        }
+        messages = session.messages + [user_message]
+        input_ids = session.token_ids + self._encode_turn_tail(session.messages, user_message)
+
+        past_key_values = None
+        if session.cache is not None and session.cache.get_seq_length() < len(input_ids):
+            past_key_values = fork_cache(session.cache)
+        return messages, input_ids, past_key_values
+
+    def record_session_answer(self, session, question: str, answer: str, settings_data: dict):
+        """Add an answer that was served from cache to the session transcript (no KV cache)"""
+        messages, input_ids, _ = self.prepare_session_turn(
+            session,
+            question,
+            subject=settings_data.get('subject', 'General'),
+            language=settings_data.get('language', 'English'),
+            level=settings_data.get('level', 'middle_school'),
+            response_style=settings_data.get('response_style', 'regular')
+        )
+        answer_ids = self.processor.tokenizer(answer, add_special_tokens=False)["input_ids"]
+        session.record_turn(
+            messages + [{"role": "assistant", "content": [{"type": "text", "text": answer}]}],
+            input_ids + answer_ids,
+            None
+        )
+
+    def _encode_turn_tail(self, history: list, user_message: dict) -> list:
+        """Token ids that follow the last assistant answer: end of that turn plus the new user turn"""
+        probe = history[:-1] + [
+            {"role": history[-1]["role"], "content": [{"type": "text", "text": USER_TURN_SENTINEL}]},
+            user_message
+        ]
+        rendered = self.processor.apply_chat_template(probe, add_generation_prompt=True, tokenize=False)
+        tail = rendered.split(USER_TURN_SENTINEL, 1)[1]
+        return self.processor.tokenizer(tail, add_special_tokens=False)["input_ids"]
+
+    @exclusive
+    def _compute_prefix_cache(self, prefix_ids: list):
+        """Run prefill over the prefix once and return its past_key_values"""
+        start_time = time.time()
+        cache = DynamicCache()
+        with torch.inference_mode():
+            self.model(
+                input_ids=torch.tensor([prefix_ids], device=self.model.device),
+                past_key_values=cache,
+                use_cache=True,
+                logits_to_keep=1
+            )
+        logger.info(f"🧩 Cached system prompt prefix: {len(prefix_ids)} tokens in {time.time() - start_time:.3f}s")
+        return cache
+
+    @property
+    def embedding_dim(self) -> int:
+        return self.model.config.get_text_config().hidden_size
+
+    def embed_question(self, question: str, mode: str = "input"):
+        """
+        Mean-pooled, L2-normalized question embedding for the semantic answer cache.
+
+        mode="input" pools the token input embeddings (no forward pass);
+        mode="hidden" pools the language model's last hidden states, which costs
+        a forward pass per question and needs a higher threshold (decoder states
+        are anisotropic, so unrelated questions also score high).
+        """
+        token_ids = self.processor.tokenizer(question.strip(), add_special_tokens=False)["input_ids"]
+        if not token_ids:
+            token_ids = [self.processor.tokenizer.eos_token_id]
+        input_ids = torch.tensor([token_ids], device=self.model.device)
+
+        with torch.inference_mode():
+            if mode == "input":
+                states = self.model.get_input_embeddings()(input_ids)
+            else:
+                with self.model_lock:
+                    states = self.model.model.language_model(input_ids=input_ids, use_cache=False).last_hidden_state
+            vector = states[0].float().mean(dim=0)
+            vector = vector / vector.norm().clamp(min=1e-6)
+        return vector.cpu().numpy()
+
+    def speculation_mode(self, question: str) -> Optional[str]:
+        """Assisted decoding mode for a question: 'draft', 'ngram' (long pasted input) or None"""
+        if self.speculative.enabled:
+            return "draft"
+        question_tokens = len(self.processor.tokenizer.encode(question, add_special_tokens=False))
+        return self.speculative.choose_mode(question_tokens)
+
+    @property
+    def stop_token_ids(self) -> set:
+        """Token ids that end a model turn"""
+        stop_ids = set()
+        eos = getattr(getattr(self.model, "generation_config", None), "eos_token_id", None)
+        if isinstance(eos, int):
+            stop_ids.add(eos)
+        elif eos:
+            stop_ids.update(eos)
+        if self.processor.tokenizer.eos_token_id is not None:
+            stop_ids.add(self.processor.tokenizer.eos_token_id)
+        return stop_ids
+
+    @profiled("text")
+    @exclusive
+    def ask_ai_tutor(
+        self, 
+        question: str, 
+        subject: str = "General", 
+        language: str = "English", 
+        level: str = "middle_school",
+        max_tokens: int = 256,
+        response_style: str = "regular",  # ← ADD THIS PARAMETER
+        on_chunk: Optional[Callable[[str], None]] = None,
+        stream_chunk_tokens: int = 1,
+        deterministic: bool = False,
+        session=None,
+        cancel_event: Optional[threading.Event] = None,
+        deadline: Optional[Deadline] = None
+    ) -> str:
+        """
+        Generate text response using cached Gemma3n E2B-it
+
+        If on_chunk is given it is called with each new piece of text while
+        decoding is still running (every `stream_chunk_tokens` tokens).
+        deterministic=True uses greedy decoding so answers are reproducible.
+        With a session, the question continues that conversation and the
+        session keeps the resulting KV cache for the next turn.
+        Setting cancel_event stops decoding after the current step; the text
+        so far is returned and the turn is not added to the session.
+        With a deadline, decoding stops at a sentence end once most of its
+        budget is spent (and sets deadline.truncated).
+        profile=True (with profiling enabled) writes a Chrome trace of the call.
+        """
+        if not self.model or not self.processor:
+            raise RuntimeError("AI Tutor not initialized. Call initialize() first.")
+        
+        # Validate token count
+        max_tokens = max(50, min(2048, max_tokens))
+        
+        # Cancelled while it was still waiting for the model
+        if cancel_event is not None and cancel_event.is_set():
+            metrics.record_cancelled("direct", 0, max_tokens)
+            return ""
+        
+        # The deadline counts from here, once this request has the model
+        if deadline is not None:
+            deadline.start()
         
         try:
             start_time = time.time()
+            template_start = time.perf_counter()
             
-            # Apply chat template
-            inputs = self.processor.apply_chat_template(
-                messages,
-                add_generation_prompt=True,
-                tokenize=True,
-                return_dict=True,
-                return_tensors="pt",
-            ).to(self.model.device)
+            # Apply chat template and reuse the system prompt's (or conversation's) KV cache if we have it
+            with self.profiler.span("template"):
+                if session is not None:
+                    messages, input_ids, past_key_values = self.prepare_session_turn(
+                        session, question, subject, language, level, response_style
+                    )
+                else:
+                    messages = self.build_messages(question, subject, language, level, response_style)
+                    input_ids, prefix = self.prepare_text_prompt(messages)
+                    past_key_values = prefix.fork() if prefix is not None else None
+            cached_tokens = past_key_values.get_seq_length() if past_key_values is not None else 0
+            if session is not None and past_key_values is None:
+                # Start an empty cache so generate hands back one we can keep
+                past_key_values = DynamicCache()
+            metrics.TEMPLATE.observe(time.perf_counter() - template_start)
             
-            input_len = inputs["input_ids"].shape[-1]
+            inputs = {
+                "input_ids": torch.tensor([input_ids], device=self.model.device),
+                "attention_mask": torch.ones((1, len(input_ids)), dtype=torch.long, device=self.model.device)
+            }
+            
+            input_len = len(input_ids)
+            
+            if deterministic:
+                generate_kwargs = {"do_sample": False, "temperature": None, "top_p": None}
+            else:
+                generate_kwargs = {"do_sample": True, "temperature": 0.7, "top_p": 0.9}
+            
+            if past_key_values is not None:
+                # Only the uncached tail is prefilled; generate skips the cached positions
+                generate_kwargs["past_key_values"] = past_key_values
+                generate_kwargs["cache_implementation"] = None
+            
+            # A draft model (or the prompt itself) proposes tokens for the main model to verify in one pass
+            speculation_mode = self.speculation_mode(question)
+            speculative_kwargs = self.speculative.generate_kwargs(speculation_mode, self.processor.tokenizer)
+            generate_kwargs.update(speculative_kwargs)
+            
+            stopping_criteria = StoppingCriteriaList()
+            if cancel_event is not None:
+                stopping_criteria.append(CancelledCriteria(cancel_event))
+            if deadline is not None:
+                stopping_criteria.append(DeadlineCriteria(deadline, self.processor.tokenizer, input_len))
+            if stopping_criteria:
+                generate_kwargs["stopping_criteria"] = stopping_criteria
+            
+            # Profiled requests split generate() into prefill and decode at the first streamed token
+            profile_session = self.profiler.current
+            streamer = None
+            if on_chunk is not None:
+                streamer = CallbackStreamer(
+                    self.processor.tokenizer,
+                    on_chunk,
+                    chunk_tokens=stream_chunk_tokens,
+                    on_first_token=(lambda: profile_session.begin("decode")) if profile_session else None
+                )
             
             # Generate with user-specified token count
-            with torch.inference_mode():
+            if profile_session is not None:
+                profile_session.begin("prefill" if streamer is not None else "generate")
+            generate_start = time.time()
+            with torch.inference_mode(), self.speculative.track(speculation_mode) as speculation:
                 generation = self.model.generate(
                     **inputs,
                     max_new_tokens=max_tokens,
-                    do_sample=True,
-                    temperature=0.7,
-                    top_p=0.9,
-                    pad_token_id=self.processor.tokenizer.eos_token_id
+                    pad_token_id=self.processor.tokenizer.eos_token_id,
+                    streamer=streamer,
+                    **generate_kwargs
                 )
                 
                 # Sync if on GPU
@@ -188,17 +655,71 @@ class AITutor:
                     torch.cuda.synchronize()
                     
                 generation = generation[0][input_len:]
+            generate_end = time.time()
+            if profile_session is not None:
+                profile_session.end()
             
             # Decode response
-            response = self.processor.decode(generation, skip_special_tokens=True)
+            decode_start = time.perf_counter()
+            with self.profiler.span("detokenize"):
+                response = self.processor.decode(generation, skip_special_tokens=True)
+            detokenize_time = time.perf_counter() - decode_start
             
             inference_time = time.time() - start_time
             tokens_generated = len(generation)
             
+            first_token_time = streamer.first_token_time if streamer is not None else None
+            metrics.record_generation(
+                speculation_mode or "direct",
+                prompt_tokens=input_len - cached_tokens,
+                tokens=tokens_generated,
+                prefill=first_token_time - generate_start if first_token_time else None,
+                decode=generate_end - first_token_time if first_token_time else None,
+                detokenize=detokenize_time + (streamer.detokenize_time if streamer is not None else 0.0)
+            )
+            if first_token_time:
+                self.decode_rate.observe(tokens_generated - 1, generate_end - first_token_time)
+            else:
+                self.decode_rate.observe(tokens_generated, generate_end - generate_start)
+            cancelled = cancel_event is not None and cancel_event.is_set()
+            if deadline is not None and not cancelled:
+                # Tokens up to a stop token; reaching a fitted budget without one counts as truncated
+                answer_tokens = tokens_generated - (1 if tokens_generated and int(generation[-1]) in self.stop_token_ids else 0)
+                deadline.note_length(answer_tokens, max_tokens)
+            truncated = deadline is not None and deadline.truncated
+            if truncated:
+                metrics.record_truncated(speculation_mode or "direct")
+            
+            if cancelled:
+                metrics.record_cancelled(speculation_mode or "direct", tokens_generated, max_tokens)
+            elif session is not None:
+                output_ids = generation.tolist()
+                stop_ids = self.stop_token_ids
+                while output_ids and output_ids[-1] in stop_ids:
+                    output_ids.pop()
+                session.record_turn(
+                    messages + [{"role": "assistant", "content": [{"type": "text", "text": response.strip()}]}],
+                    input_ids + output_ids,
+                    past_key_values
+                )
+            
             # Log performance with device info, token count, and style
             device_info = "GPU" if str(self.model.device).startswith("cuda") else "CPU"
             style_info = f" [{response_style}]" if response_style != "regular" else ""
-            logger.info(f"⚡ {device_info} Gemma3n E2B-it: {tokens_generated} tokens in {inference_time:.3f}s ({tokens_generated/inference_time:.1f} tok/s) [max: {max_tokens}]{style_info}")
+            prefix_info = f" [prefix: {cached_tokens} cached]" if cached_tokens else ""
+            turn_info = f" [turn: {session.turns}]" if session is not None else ""
+            if cancelled:
+                turn_info += " [cancelled]"
+            elif truncated:
+                turn_info += " [deadline]"
+            speculation_info = ""
+            if speculative_kwargs:
+                self.speculative.record(speculation)
+                speculation_info = f" {speculation.describe()}"
+            ttft_info = ""
+            if streamer is not None and streamer.first_token_time is not None:
+                ttft_info = f" [ttft: {streamer.first_token_time - start_time:.3f}s]"
+            logger.info(f"⚡ {device_info} Gemma3n E2B-it: {tokens_generated} tokens in {inference_time:.3f}s ({tokens_generated/inference_time:.1f} tok/s) [max: {max_tokens}]{ttft_info}{prefix_info}{turn_info}{speculation_info}{style_info}")
             
             return response.strip()
             
@@ -206,66 +727,63 @@ class AITutor:
             logger.error(f"❌ Error in Gemma3n E2B-it inference: {e}")
             raise
 
+    @profiled("image")
+    @exclusive
     def ask_image_question(self, image_input, question: str) -> str:
-        """Analyze image using cached Gemma3n E2B-it vision capabilities"""
+        """Analyze image using cached Gemma3n E2B-it vision capabilities (profile=True traces the call)"""
         if not self.model or not self.processor:
             raise RuntimeError("AI Tutor not initialized. Call initialize() first.")
         
         try:
-            # Handle different image input types
-            image = self._load_image(image_input)
-            
-            # Create chat messages with image
-            messages = [
-                {
-                    "role": "system",
-                    "content": [{"type": "text", "text": "You are a helpful AI assistant that can analyze images and answer questions about them in detail."}]
-                },
-                {
-                    "role": "user",
-                    "content": [
-                        {"type": "image", "image": image},
-                        {"type": "text", "text": question}
-                    ]
-                }
-            ]
-            
             start_time = time.time()
             
-            # Apply chat template with image
-            inputs = self.processor.apply_chat_template(
-                messages,
-                add_generation_prompt=True,
-                tokenize=True,
-                return_dict=True,
-                return_tensors="pt",
-            ).to(self.model.device)
+            # Reuse the decoded pixels (and vision features) of an image we've seen before
+            with metrics.IMAGE_PREPROCESS.time(), self.profiler.span("preprocess"):
+                entry = self._get_image_entry(image_input)
+            
+            # Apply chat template and expand the image placeholder to its soft tokens
+            with self.profiler.span("template"):
+                input_ids = torch.tensor([self._encode_image_prompt(question)])
+            inputs = {
+                "input_ids": input_ids.to(self.model.device),
+                "attention_mask": torch.ones_like(input_ids, device=self.model.device),
+                "pixel_values": entry.pixel_values
+            }
             
             input_len = inputs["input_ids"].shape[-1]
+            feature_cached = entry.image_features is not None
             
             # Generate with vision
-            with torch.inference_mode():
-                generation = self.model.generate(
-                    **inputs,
-                    max_new_tokens=300,
-                    do_sample=True,
-                    temperature=0.7,
-                    pad_token_id=self.processor.tokenizer.eos_token_id
-                )
-                
-                if str(self.model.device).startswith("cuda"):
-                    torch.cuda.synchronize()
+            self._install_image_feature_cache()
+            self._active_image = entry
+            try:
+                with torch.inference_mode(), metrics.IMAGE_GENERATE.time(), self.profiler.span("generate"):
+                    generation = self.model.generate(
+                        **inputs,
+                        max_new_tokens=300,
+                        do_sample=True,
+                        temperature=0.7,
+                        pad_token_id=self.processor.tokenizer.eos_token_id
+                    )
                     
-                generation = generation[0][input_len:]
+                    if str(self.model.device).startswith("cuda"):
+                        torch.cuda.synchronize()
+                        
+                    generation = generation[0][input_len:]
+            finally:
+                self._active_image = None
             
             # Decode response
-            response = self.processor.decode(generation, skip_special_tokens=True)
+            with self.profiler.span("detokenize"):
+                response = self.processor.decode(generation, skip_special_tokens=True)
             
             inference_time = time.time() - start_time
             tokens_generated = len(generation)
+            metrics.record_generation("image", prompt_tokens=input_len, tokens=tokens_generated)
             
             device_info = "GPU" if str(self.model.device).startswith("cuda") else "CPU"
-            logger.info(f"🖼️ {device_info} Gemma3n E2B-it Vision: {tokens_generated} tokens in {inference_time:.3f}s ({tokens_generated/inference_time:.1f} tok/s)")
+            cache_info = " [image: cached features]" if feature_cached else " [image: cached pixels]" if entry.hits else ""
+            logger.info(f"🖼️ {device_info} Gemma3n E2B-it Vision: {tokens_generated} tokens in {inference_time:.3f}s ({tokens_generated/inference_time:.1f} tok/s){cache_info}")
             
             return response.strip()
             
@@ -273,60 +791,289 @@ class AITutor:
             logger.error(f"❌ Error in Gemma3n E2B-it vision: {e}")
             return f"Error analyzing image: {str(e)}"
 
-    def _load_image(self, image_input) -> Image.Image:
-        """Load image from URL, file path, or base64 data"""
+    @profiled("image_batch")
+    def ask_image_batch(
+        self,
+        image_inputs: list,
+        questions: List[str],
+        max_tokens: int = 300,
+        on_result: Optional[Callable[[int, str], None]] = None
+    ) -> List[str]:
+        """
+        Answer several image questions together (profile=True traces the call).
+
+        The images are preprocessed in parallel, the vision tower runs once over
+        every image whose features aren't cached, and up to `image_batch_size`
+        answers decode as one batch. on_result(index, text) is called as each
+        answer finishes, so short answers arrive before the batch is done.
+        Images that fail to load get an error text instead of failing the rest.
+        """
+        if not self.model or not self.processor:
+            raise RuntimeError("AI Tutor not initialized. Call initialize() first.")
+        if len(image_inputs) != len(questions):
+            raise ValueError("Every image needs a question")
+        
+        max_tokens = max(50, min(2048, max_tokens))
+        start_time = time.time()
+        results: List[Optional[str]] = [None] * len(questions)
+        
+        def deliver(index: int, text: str):
+            results[index] = text
+            if on_result is not None:
+                on_result(index, text)
+        
+        with metrics.IMAGE_PREPROCESS.time(), self.profiler.span("preprocess"):
+            loaded = self._get_image_entries(image_inputs)
+        
+        pending = []
+        for index, entry in enumerate(loaded):
+            if isinstance(entry, Exception):
+                logger.error(f"❌ Failed to load image {index + 1}/{len(loaded)}: {entry}")
+                deliver(index, f"Error analyzing image: {entry}")
+            else:
+                pending.append(index)
+        
+        batch_size = max(1, int(self._setting('image_batch_size', 4)))
+        tokens_generated = 0
+        for start in range(0, len(pending), batch_size):
+            indices = pending[start:start + batch_size]
+            try:
+                tokens_generated += self._answer_image_batch(
+                    [loaded[i] for i in indices], [questions[i] for i in indices], max_tokens,
+                    lambda row, text, indices=indices: deliver(indices[row], text)
+                )
+            except Exception as e:
+                logger.error(f"❌ Error in Gemma3n E2B-it vision batch: {e}")
+                for index in indices:
+                    if results[index] is None:
+                        deliver(index, f"Error analyzing image: {str(e)}")
+        
+        inference_time = time.time() - start_time
+        device_info = "GPU" if str(self.model.device).startswith("cuda") else "CPU"
+        logger.info(f"🖼️ {device_info} Gemma3n E2B-it Vision batch: {len(questions)} images, {tokens_generated} tokens "
+                    f"in {inference_time:.3f}s ({tokens_generated/inference_time:.1f} tok/s) [batch: {batch_size}]")
+        return results
+
+    @exclusive
+    def _answer_image_batch(self, entries: List[ImageEntry], questions: List[str], max_tokens: int,
+                            deliver: Callable[[int, str], None]) -> int:
+        """Generate one left-padded batch of image answers; returns the number of tokens generated"""
+        self._batch_image_features(entries)
+        
+        with self.profiler.span("template"):
+            prompts = [self._encode_image_prompt(question) for question in questions]
+        width = max(len(ids) for ids in prompts)
+        pad_id = self.processor.tokenizer.pad_token_id
+        if pad_id is None:
+            pad_id = self.processor.tokenizer.eos_token_id
+        device = self.model.device
+        input_ids = torch.tensor([[pad_id] * (width - len(ids)) + ids for ids in prompts], device=device)
+        attention_mask = torch.tensor([[0] * (width - len(ids)) + [1] * len(ids) for ids in prompts], device=device)
+        pixel_values = torch.cat([entry.pixel_values for entry in entries])
+        
+        lengths = {}
+        
+        def finished(row: int, token_ids: torch.Tensor):
+            lengths[row] = len(token_ids)
+            deliver(row, self.processor.decode(token_ids, skip_special_tokens=True).strip())
+        
+        watcher = RowFinishedCriteria(width, self.stop_token_ids, finished)
+        self._active_batch = (pixel_values, entries)
         try:
-            # Check if it's base64 data
-            if isinstance(image_input, str) and image_input.startswith('data:image'):
-                # Extract base64 data
-                base64_data = image_input.split(',')[1]
-                image_data = base64.b64decode(base64_data)
-                return Image.open(io.BytesIO(image_data)).convert('RGB')
-            
-            # Check if it's a URL
-            elif isinstance(image_input, str) and image_input.startswith(('http://', 'https://')):
-                response = requests.get(image_input, timeout=10)
+            with torch.inference_mode(), metrics.IMAGE_GENERATE.time(), self.profiler.span("generate"):
+                generation = self.model.generate(
+                    input_ids=input_ids,
+                    attention_mask=attention_mask,
+                    pixel_values=pixel_values,
+                    max_new_tokens=max_tokens,
+                    do_sample=True,
+                    temperature=0.7,
+                    pad_token_id=self.processor.tokenizer.eos_token_id,
+                    stopping_criteria=StoppingCriteriaList([watcher])
+                )
+        finally:
+            self._active_batch = None
+        
+        # Rows that ran to max_tokens never emitted a stop token
+        for row in range(len(entries)):
+            if row not in watcher.finished:
+                lengths[row] = generation.shape[1] - width
+                deliver(row, self.processor.decode(generation[row, width:], skip_special_tokens=True).strip())
+        
+        for row, ids in enumerate(prompts):
+            metrics.record_generation("image", prompt_tokens=len(ids), tokens=lengths[row])
+        return sum(lengths.values())
+
+    def _encode_image_prompt(self, question: str) -> List[int]:
+        """Token ids of an image question, with the image placeholder expanded to its soft tokens"""
+        messages = [
+            {
+                "role": "system",
+                "content": [{"type": "text", "text": "You are a helpful AI assistant that can analyze images and answer questions about them in detail."}]
+            },
+            {
+                "role": "user",
+                "content": [
+                    {"type": "image"},
+                    {"type": "text", "text": question}
+                ]
+            }
+        ]
+        prompt = self.processor.apply_chat_template(messages, add_generation_prompt=True, tokenize=False)
+        prompt = prompt.replace(self.processor.image_token, self.processor.full_image_sequence)
+        return self.processor.tokenizer(prompt, add_special_tokens=False)["input_ids"]
+
+    def _batch_image_features(self, entries: List[ImageEntry]):
+        """Run the vision tower once over every entry that has no cached features"""
+        self._install_image_feature_cache()
+        missing = list({id(entry): entry for entry in entries if entry.image_features is None}.values())
+        for _ in range(len(entries) - len(missing)):
+            self.image_cache.record_feature_hit()
+        if not missing:
+            return
+        with torch.inference_mode(), self.profiler.span("vision_tower"):
+            features = self._compute_image_features(torch.cat([entry.pixel_values for entry in missing]))
+        for entry, entry_features in zip(missing, features.split(1)):
+            # Copies, so each cached entry holds (and is charged for) only its own rows
+            self.image_cache.attach_features(entry, entry_features.clone())
+
+    @property
+    def image_ingest(self) -> ImageIngestor:
+        """Pool that decodes and preprocesses images for the processor's input size (created on first use)"""
+        if self._image_ingest is None:
+            self._image_ingest = ImageIngestor(
+                self.processor.image_processor,
+                workers=self._setting('image_ingest_workers', 2),
+                max_bytes=int(self._setting('image_max_mb', 20) * 1024**2),
+                max_pixels=int(self._setting('image_max_megapixels', 50) * 1e6),
+                draft=self._setting('image_draft_decode', True)
+            )
+        return self._image_ingest
+
+    def _get_image_entry(self, image_input) -> ImageEntry:
+        """Return the preprocessed pixel tensor for an image, from cache when the content was seen before"""
+        entry = self._get_image_entries([image_input])[0]
+        if isinstance(entry, Exception):
+            raise entry
+        return entry
+
+    def _get_image_entries(self, image_inputs: list) -> list:
+        """
+        ImageEntry per input (or the exception that stopped it). Cache misses
+        are decoded in the ingest pool in parallel, each distinct image once.
+        """
+        entries, pending = [], {}
+        for image_input in image_inputs:
+            try:
+                data = self._image_bytes(image_input)
+                key = image_content_key(data)
+                entry = self.image_cache.get(key) if key not in pending else None
+                if entry is None and key not in pending:
+                    pending[key] = self.image_ingest.submit(data)
+                entries.append(entry if entry is not None else key)
+            except Exception as e:
+                entries.append(e)
+        
+        loaded = {}
+        for key, future in pending.items():
+            try:
+                loaded[key] = self.image_cache.put(key, future.result().to(self.model.device))
+            except Exception as e:
+                loaded[key] = e
+        return [loaded[entry] if isinstance(entry, str) else entry for entry in entries]
+
+    def _install_image_feature_cache(self):
+        """Route the model's vision tower through the image cache"""
+        if self._compute_image_features is not None:
+            return
+        self._compute_image_features = self.model.model.get_image_features
+        self.model.model.get_image_features = self._image_features
+
+    def _image_features(self, pixel_values: torch.Tensor) -> torch.Tensor:
+        batch = self._active_batch
+        if batch is not None and batch[0] is pixel_values:
+            return torch.cat([entry.image_features for entry in batch[1]])
+        entry = self._active_image
+        if entry is None or entry.pixel_values is not pixel_values:
+            return self._compute_image_features(pixel_values)
+        if entry.image_features is not None:
+            self.image_cache.record_feature_hit()
+            return entry.image_features
+        with self.profiler.span("vision_tower"):
+            image_features = self._compute_image_features(pixel_values)
+        self.image_cache.attach_features(entry, image_features)
+        return image_features
+
+    def _image_bytes(self, image_input):
+        """Encoded bytes of an image from a binary upload, data URL, URL, file path or PIL image"""
+        if isinstance(image_input, (bytes, bytearray, memoryview)):
+            return image_input
+        # Byte limits apply before anything is decoded (or fully downloaded)
+        max_bytes = self.image_ingest.max_bytes
+        if isinstance(image_input, str) and image_input.startswith('data:image'):
+            encoded = image_input.split(',')[1]
+            check_bytes(len(encoded) * 3 // 4, max_bytes)
+            return base64.b64decode(encoded)
+        if isinstance(image_input, str) and image_input.startswith(('http://', 'https://')):
+            with requests.get(image_input, timeout=10, stream=True) as response:
                 response.raise_for_status()
-                return Image.open(io.BytesIO(response.content)).convert('RGB')
-            
-            # Assume it's a file path or PIL Image
-            elif isinstance(image_input, str):
-                return Image.open(image_input).convert('RGB')
-            elif isinstance(image_input, Image.Image):
-                return image_input.convert('RGB')
-            
-            else:
-                raise ValueError(f"Unsupported image input type: {type(image_input)}")
-                
-        except Exception as e:
-            logger.error(f"❌ Failed to load image: {e}")
-            raise ValueError(f"Could not load image: {str(e)}")
+                check_bytes(int(response.headers.get('Content-Length') or 0), max_bytes)
+                data = response.raw.read(max_bytes + 1 if max_bytes else None, decode_content=True)
+            check_bytes(len(data), max_bytes)
+            return data
+        if isinstance(image_input, str):
+            check_bytes(os.path.getsize(image_input), max_bytes)
+            with open(image_input, 'rb') as f:
+                return f.read()
+        if isinstance(image_input, Image.Image):
+            buffer = io.BytesIO()
+            image_input.save(buffer, format='PNG')
+            return buffer.getvalue()
+        raise ValueError(f"Unsupported image input type: {type(image_input)}")
 
     async def ask_ai_tutor_stream(
         self, 
         question: str, 
         subject: str = "General", 
         language: str = "English", 
-        level: str = "middle_school"
+        level: str = "middle_school",
+        max_tokens: int = 256,
+        response_style: str = "regular",
+        stream_chunk_tokens: int = 1
     ):
-        """Streaming version"""
-        try:
-            response = self.ask_ai_tutor(question, subject, language, level)
-            
-            # Simulate streaming by yielding chunks
-            words = response.split()
-            current_chunk = ""
-            
-            for i, word in enumerate(words):
-                current_chunk += word + " "
-                
-                if (i + 1) % 3 == 0 or i == len(words) - 1:
-                    yield current_chunk.strip()
-                    current_chunk = ""
-                    
-        except Exception as e:
-            logger.error(f"❌ Error in Gemma3n E2B-it streaming: {e}")
-            raise
+        """Streaming version - yields text chunks while the model is still decoding"""
+        loop = asyncio.get_running_loop()
+        chunks = queue.Queue()
+        done = object()
+        errors = []
+
+        def run():
+            try:
+                self.ask_ai_tutor(
+                    question, subject, language, level,
+                    max_tokens=max_tokens,
+                    response_style=response_style,
+                    on_chunk=chunks.put,
+                    stream_chunk_tokens=stream_chunk_tokens
+                )
+            except Exception as e:
+                errors.append(e)
+            finally:
+                chunks.put(done)
+
+        worker = threading.Thread(target=run, daemon=True)
+        worker.start()
+
+        while True:
+            chunk = await loop.run_in_executor(None, chunks.get)
+            if chunk is done:
+                break
+            yield chunk
+
+        await loop.run_in_executor(None, worker.join)
+        if errors:
+            logger.error(f"❌ Error in Gemma3n E2B-it streaming: {errors[0]}")
+            raise errors[0]
 
     def get_model_size_info(self):
         """Get model info with device distribution"""
@@ -0,0 +1,160 @@
+"""
+Exact-match answer cache for repeated tutor questions
+"""
+import hashlib
+import json
+import logging
+import re
+import sqlite3
+import threading
+import time
+import unicodedata
+from collections import OrderedDict
+from pathlib import Path
+from typing import Optional
+
+logger = logging.getLogger(__name__)
+
+
+def normalize_question(question: str) -> str:
+    """Case-fold, collapse whitespace and drop trailing punctuation"""
+    text = unicodedata.normalize("NFKC", question).casefold()
+    text = re.sub(r"\s+", " ", text).strip()
+    return text.rstrip(" ?!.")
+
+
+def make_cache_key(
+    question: str,
+    subject: str,
+    level: str,
+    language: str,
+    response_style: str,
+    max_tokens: int,
+    deterministic: bool = False
+) -> str:
+    payload = json.dumps([
+        normalize_question(question),
+        subject.strip().casefold(),
+        level.strip().casefold(),
+        language.strip().casefold(),
+        response_style.strip(),
+        int(max_tokens),
+        bool(deterministic),
+    ], ensure_ascii=False)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class AnswerCache:
+    """
+    Two-tier answer cache: an in-memory LRU in front of an optional SQLite file.
+
+    Entries older than `ttl_seconds` are treated as misses (0 disables expiry).
+    """
+
+    def __init__(self, max_entries: int = 1024, ttl_seconds: float = 86400, db_path: Optional[str] = None):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self._memory: "OrderedDict[str, tuple]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._db = None
+
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.expired = 0
+
+        if db_path:
+            self._open_db(db_path)
+
+    def _open_db(self, db_path: str):
+        try:
+            Path(db_path).parent.mkdir(parents=True, exist_ok=True)
+            self._db = sqlite3.connect(db_path, check_same_thread=False)
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS answers ("
+                "key TEXT PRIMARY KEY, answer TEXT NOT NULL, created_at REAL NOT NULL)"
+            )
+            self._db.commit()
+            logger.info(f"💾 Answer cache persisted to {db_path}")
+        except sqlite3.Error as e:
+            logger.warning(f"⚠️ Could not open answer cache database, using memory only: {e}")
+            self._db = None
+
+    def _is_fresh(self, created_at: float) -> bool:
+        return self.ttl_seconds <= 0 or (time.time() - created_at) < self.ttl_seconds
+
+    def get(self, key: str) -> Optional[str]:
+        with self._lock:
+            entry = self._memory.get(key)
+            if entry is not None:
+                answer, created_at = entry
+                if self._is_fresh(created_at):
+                    self._memory.move_to_end(key)
+                    self.memory_hits += 1
+                    return answer
+                del self._memory[key]
+                self.expired += 1
+
+            if self._db is not None:
+                row = self._db.execute(
+                    "SELECT answer, created_at FROM answers WHERE key = ?", (key,)
+                ).fetchone()
+                if row is not None:
+                    answer, created_at = row
+                    if self._is_fresh(created_at):
+                        self._remember(key, answer, created_at)
+                        self.disk_hits += 1
+                        return answer
+                    self._db.execute("DELETE FROM answers WHERE key = ?", (key,))
+                    self._db.commit()
+                    self.expired += 1
+
+            self.misses += 1
+            return None
+
+    def put(self, key: str, answer: str):
+        created_at = time.time()
+        with self._lock:
+            self._remember(key, answer, created_at)
+            if self._db is not None:
+                try:
+                    self._db.execute(
+                        "INSERT OR REPLACE INTO answers (key, answer, created_at) VALUES (?, ?, ?)",
+                        (key, answer, created_at)
+                    )
+                    self._db.commit()
+                except sqlite3.Error as e:
+                    logger.warning(f"⚠️ Failed to persist cached answer: {e}")
+
+    def _remember(self, key: str, answer: str, created_at: float):
+        self._memory[key] = (answer, created_at)
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.max_entries:
+            self._memory.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._memory.clear()
+            if self._db is not None:
+                self._db.execute("DELETE FROM answers")
+                self._db.commit()
+
+    def get_stats(self) -> dict:
+        with self._lock:
+            hits = self.memory_hits + self.disk_hits
+            lookups = hits + self.misses
+            disk_entries = None
+            if self._db is not None:
+                disk_entries = self._db.execute("SELECT COUNT(*) FROM answers").fetchone()[0]
+            return {
+                'memory_entries': len(self._memory),
+                'disk_entries': disk_entries,
+                'hits': hits,
+                'memory_hits': self.memory_hits,
+                'disk_hits': self.disk_hits,
+                'misses': self.misses,
+                'expired': self.expired,
+                'hit_rate': round(hits / lookups, 3) if lookups else 0.0,
+                'ttl_seconds': self.ttl_seconds,
+            }
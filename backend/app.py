@@ -1,22 +1,35 @@
 """
 Robust Flask Backend for AI Tutor - Fixed for multiple responses
 """
-from flask import Flask, request
+from flask import Flask, Response, request
 from flask_socketio import SocketIO, emit, disconnect
 import json
 import uuid
 import time
 import os
 from dotenv import load_dotenv
+import sys
+import queue
 import asyncio
 import logging
+import importlib
+import threading
 from threading import Timer, Lock
-import torch
 import traceback
+from contextlib import contextmanager, nullcontext
 
-# Import your actual AI classes
-from ai_tutor import AITutor
+# Import your actual AI classes (torch/transformers are only imported when the model loads in-process)
 from model_manager import ModelManager
+from inference_worker import InferenceClient, generate_text_answer, uses_scheduler
+from answer_cache import AnswerCache, make_cache_key
+from semantic_cache import SemanticAnswerCache, make_partition
+from sessions import SessionStore
+from pending import PendingRequestQueue
+from traces import TraceRecorder
+from cancellation import CancelRegistry
+from admission import AdmissionController, IMAGE_COST, Rejected
+from deadline import Deadline
+import metrics
 from config import get_settings
 
 # Load environment variables
@@ -48,38 +61,76 @@ settings = None
 model_manager = None
 ai_tutor = None
 image_analyzer = None
+batch_scheduler = None
+answer_cache = None
+semantic_cache = None
+session_store = None
+inference_client = None
+trace_recorder = None
 models_loaded = False
 loading_in_progress = False
+model_load_error = None
+startup_timings = {}
+
+# Requests that arrive before the model is ready wait here instead of bouncing
+pending_requests = PendingRequestQueue()
+
+# Streamed answers in progress, so cancel_generation / disconnects can stop them
+cancel_registry = CancelRegistry()
+
+# Once the model is up, generation requests take turns here (fair order, per-client limits)
+admission = AdmissionController()
+
+# Broadcasts produced on OS threads (loading status) are emitted by a green thread
+broadcast_queue = queue.Queue()
 response_lock = Lock()  # Thread safety for responses
 
 # Track active connections
 active_connections = {}
 connection_lock = Lock()
 
-def send_loading_status(message):
-    """Send loading status to all connected clients with error handling"""
-    try:
-        with connection_lock:
-            if active_connections:
-                socketio.emit('model_loading_status', {
-                    'message': message,
-                    'timestamp': time.time()
-                })
-                print(f"📡 Status sent to {len(active_connections)} clients: {message}")
-            else:
-                print(f"📡 Status (no clients): {message}")
-    except Exception as e:
-        print(f"⚠️ Failed to send status: {e}")
+def send_loading_status(message, progress=None):
+    """Send loading status to all connected clients (safe to call from any thread)"""
+    payload = {'message': message, 'timestamp': time.time()}
+    if progress:
+        payload['progress'] = progress
+    broadcast_queue.put(('model_loading_status', payload))
+    print(f"📡 Status: {message}")
+
+def pump_broadcasts():
+    """Emit queued broadcasts from the eventlet hub"""
+    while True:
+        try:
+            event, payload = broadcast_queue.get_nowait()
+        except queue.Empty:
+            socketio.sleep(0.1)
+            continue
+        try:
+            with connection_lock:
+                has_clients = bool(active_connections)
+            if has_clients:
+                socketio.emit(event, payload)
+        except Exception as e:
+            print(f"⚠️ Failed to send {event}: {e}")
 
 def initialize_models():
     """Initialize AI models with robust error handling"""
-    global settings, model_manager, ai_tutor, image_analyzer, models_loaded, loading_in_progress
+    global settings, model_manager, ai_tutor, image_analyzer, batch_scheduler, answer_cache, semantic_cache, session_store, inference_client, trace_recorder, models_loaded, loading_in_progress, model_load_error
     
     if loading_in_progress:
         print("⚠️ Model loading already in progress...")
         return
         
     loading_in_progress = True
+    model_load_error = None
+    startup_start = time.perf_counter()
+    phase_start = startup_start
+    
+    def end_phase(name):
+        nonlocal phase_start
+        now = time.perf_counter()
+        startup_timings[name] = round(now - phase_start, 3)
+        phase_start = now
     
     try:
         print("🚀 Starting AI Tutor Backend...")
@@ -95,17 +146,40 @@ def initialize_models():
                 hf_model_id = "google/gemma-3n-e2b-it"
                 hf_token = None
             settings = FallbackSettings()
+        pending_requests.max_size = getattr(settings, 'pending_queue_max_size', pending_requests.max_size)
+        pending_requests.timeout = getattr(settings, 'pending_request_timeout', pending_requests.timeout)
+        admission.max_queue = getattr(settings, 'admission_max_queue', admission.max_queue)
+        admission.max_per_client = max(1, getattr(settings, 'admission_max_per_client', admission.max_per_client))
+        admission.shortest_first = getattr(settings, 'admission_shortest_first', admission.shortest_first)
         
-        # Validate HF token
-        if not settings.hf_token or settings.hf_token == "your_hugging_face_token_here":
-            print("❌ HF_TOKEN environment variable not found!")
-            send_loading_status("🔧 Waiting for HuggingFace token...")
-            token = input("Enter your HuggingFace token: ")
-            settings.hf_token = token
-            print("✅ Token set temporarily")
+        # In-process mode: import torch/transformers while the cache check runs
+        model_imports = None
+        if not getattr(settings, 'inference_worker_enabled', False):
+            model_imports = threading.Thread(target=import_model_modules, name="model-imports", daemon=True)
+            model_imports.start()
+        end_phase('settings')
         
-        print(f"✅ HF Token present: {bool(settings.hf_token)}")
-        send_loading_status("🔑 HuggingFace token validated...")
+        # Answer cache is independent of the model, so cached answers are served even while loading
+        if getattr(settings, 'answer_cache_enabled', False) and answer_cache is None:
+            answer_cache = AnswerCache(
+                max_entries=settings.answer_cache_max_entries,
+                ttl_seconds=settings.answer_cache_ttl_seconds,
+                db_path=settings.answer_cache_db_path or None
+            )
+            print(f"✅ Answer cache ready (TTL: {settings.answer_cache_ttl_seconds}s)")
+        
+        if getattr(settings, 'trace_file', '') and trace_recorder is None:
+            trace_recorder = TraceRecorder(settings.trace_file, include_text=getattr(settings, 'trace_include_text', False))
+            print(f"📼 Recording request traces to {settings.trace_file}")
+        
+        # Validate HF token (only needed to download the model; cached files load without it)
+        if not settings.hf_token or settings.hf_token == "your_hugging_face_token_here":
+            print("⚠️ HF_TOKEN not set - set it in .env if the model still needs to be downloaded")
+            send_loading_status("⚠️ No HuggingFace token - using cached model files only")
+            settings.hf_token = None
+        else:
+            print(f"✅ HF Token present: {bool(settings.hf_token)}")
+            send_loading_status("🔑 HuggingFace token validated...")
         
         # Initialize model manager
         print("📦 Loading Gemma model from cache...")
@@ -121,22 +195,81 @@ def initialize_models():
             print(f"⚠️ Model manager failed, using direct model ID: {e}")
             model_id = "google/gemma-3n-e2b-it"
             send_loading_status("📦 Using cached model directly...")
+        end_phase('cache_check')
         
-        # Initialize AI tutor
-        print("🎓 Initializing AI Tutor...")
-        send_loading_status("🎓 Loading AI Tutor model...")
+        if getattr(settings, 'inference_worker_enabled', False):
+            # Host the model in a separate process so this server never blocks on torch
+            print("🧠 Starting inference worker process...")
+            send_loading_status("🧠 Starting inference worker...")
+            
+            inference_client = InferenceClient(settings, on_status=send_loading_status)
+            inference_client.start()
+            if not inference_client.wait_ready():
+                raise RuntimeError(inference_client.failed or "Inference worker failed to start")
+            embedding_dim = inference_client.info.get('embedding_dim')
+            end_phase('inference_worker')
+            startup_timings['worker'] = inference_client.info.get('startup_timings', {})
+            
+            send_loading_status("✅ AI Tutor loaded successfully!")
+        else:
+            # Initialize AI tutor
+            print("🎓 Initializing AI Tutor...")
+            send_loading_status("🎓 Loading AI Tutor model...")
+            
+            model_imports.join()
+            from ai_tutor import AITutor
+            from scheduler import BatchScheduler
+            end_phase('imports')
+            
+            ai_tutor = AITutor(model_id, settings.hf_token, settings)
+            ai_tutor.initialize(on_progress=send_loading_status)
+            embedding_dim = ai_tutor.embedding_dim
+            end_phase('model_load')
+            startup_timings.update({name: round(seconds, 3) for name, seconds in ai_tutor.startup_timings.items()})
+            
+            send_loading_status("✅ AI Tutor loaded successfully!")
+            
+            # Start the continuous-batching scheduler for text requests
+            if getattr(settings, 'batch_scheduler_enabled', False):
+                batch_scheduler = BatchScheduler(
+                    ai_tutor,
+                    max_batch_size=settings.max_batch_size,
+                    max_prefill_batch=settings.max_prefill_batch
+                )
+                batch_scheduler.start()
+                print(f"✅ Batch scheduler running (max batch size: {settings.max_batch_size})")
         
-        ai_tutor = AITutor(model_id, settings.hf_token)
-        ai_tutor.initialize()
+        # Per-client conversations that keep their KV cache between turns
+        # (with the inference worker this only tracks turns; the KV cache lives in the worker)
+        if getattr(settings, 'sessions_enabled', False):
+            session_store = SessionStore(
+                max_bytes=int(settings.session_cache_max_mb * 1024**2),
+                idle_seconds=settings.session_idle_seconds,
+                max_tokens=settings.session_max_tokens
+            )
+            print(f"✅ Multi-turn sessions enabled (KV budget: {settings.session_cache_max_mb}MB)")
         
-        send_loading_status("✅ AI Tutor loaded successfully!")
+        # Paraphrase-tolerant answer cache keyed by question embeddings
+        if getattr(settings, 'semantic_cache_enabled', False):
+            try:
+                semantic_cache = SemanticAnswerCache(
+                    dim=embedding_dim,
+                    threshold=settings.semantic_cache_threshold,
+                    max_entries=settings.semantic_cache_max_entries,
+                    persist_dir=settings.semantic_cache_dir or None,
+                    signature=f"{model_id}|{settings.semantic_cache_embedding}"
+                )
+                print(f"✅ Semantic cache ready (threshold: {settings.semantic_cache_threshold})")
+            except Exception as e:
+                print(f"⚠️ Semantic cache unavailable: {e}")
+                semantic_cache = None
         
         # Initialize Image Analyzer
         print("🖼️ Setting up Image Analyzer...")
         send_loading_status("🖼️ Setting up Image Analyzer...")
         
         try:
-            image_analyzer = ai_tutor  # Share the same model instance
+            image_analyzer = inference_client or ai_tutor  # Share the same model instance
             print("✅ Image Analyzer using shared model")
             send_loading_status("✅ Image Analyzer ready!")
         except Exception as e:
@@ -144,10 +277,21 @@ def initialize_models():
             send_loading_status("⚠️ Image analysis unavailable - text-only mode")
             image_analyzer = None
         
+        admission.max_concurrent = generation_slots()
+        print(f"🚦 Admission control: {admission.max_concurrent} concurrent generation(s), "
+              f"{admission.max_per_client} per client, queue of {admission.max_queue}")
+        
         models_loaded = True
         loading_in_progress = False
+        end_phase('caches')
+        startup_timings['total'] = round(time.perf_counter() - startup_start, 3)
+        
+        broadcast_queue.put(('connection_established', connection_status()))
         
         print("✅ All models initialized successfully!")
+        print("⏱️ Startup phases: " + ", ".join(
+            f"{name} {seconds:.2f}s" for name, seconds in startup_timings.items() if isinstance(seconds, float)
+        ))
         send_loading_status("🎉 All AI models loaded! Ready to chat!")
         
         Timer(2.0, lambda: send_loading_status("✨ AI Tutor is ready for questions!")).start()
@@ -156,22 +300,175 @@ def initialize_models():
         print(f"❌ Failed to initialize models: {e}")
         traceback.print_exc()
         send_loading_status(f"❌ Model loading failed: {str(e)}")
+        model_load_error = str(e)
         loading_in_progress = False
         models_loaded = False
         raise
 
-def send_keep_alive():
-    """Send periodic keep-alive with robust error handling"""
+def generation_slots():
+    """Generations allowed to run at once: the batch size with a batch scheduler, else one"""
+    configured = getattr(settings, 'admission_max_concurrent', 0)
+    if configured > 0:
+        return configured
+    batched = batch_scheduler is not None or (inference_client is not None and inference_client.info.get('batch_scheduler'))
+    return getattr(settings, 'max_batch_size', 1) if batched else 1
+
+def admit_request(client_id, kind, context, cost, message_id=None, cancel_event=None):
+    """Wait for a generation slot; returns the admission ticket, or None if the request was turned away"""
     try:
-        with connection_lock:
-            if active_connections:
-                socketio.emit('keep_alive', {
-                    'timestamp': time.time(),
-                    'status': 'ready' if models_loaded else 'loading',
-                    'active_connections': len(active_connections)
-                })
-    except Exception as e:
-        print(f"⚠️ Keep-alive failed: {e}")
+        ticket = admission.enter(client_id, cost)
+    except Rejected as e:
+        print(f"🚫 Rejecting {context} request from {client_id}: {e.reason}")
+        metrics.REQUESTS.labels(kind, 'busy').inc()
+        socketio.emit('busy', {
+            'type': 'busy',
+            'reason': e.reason,
+            'message': str(e),
+            'context': context,
+            'retry_after': round(admission.estimated_wait(admission.max_queue), 1),
+            'timestamp': time.time()
+        }, to=client_id)
+        return None
+    
+    def send_position(position):
+        socketio.emit('queue_position', {
+            'type': 'queue_position',
+            'message_id': message_id,
+            'context': context,
+            'position': position,
+            'estimated_wait': round(admission.estimated_wait(position), 1),
+            'timestamp': time.time()
+        }, to=client_id)
+    
+    wait_start = time.perf_counter()
+    outcome = admission.wait(
+        ticket,
+        sleep=socketio.sleep,
+        on_position=send_position,
+        cancelled=cancel_event.is_set if cancel_event is not None else None,
+        position_interval=getattr(settings, 'admission_position_interval', 2.0)
+    )
+    metrics.ADMISSION.observe(time.perf_counter() - wait_start)
+    if outcome != 'admitted':
+        print(f"🚪 {context} request from {client_id} left the admission queue ({outcome})")
+        metrics.REQUESTS.labels(kind, 'cancelled').inc()
+        return None
+    return ticket
+
+def start_model_loading():
+    """Load the models on a background thread so the server accepts connections right away"""
+    def load():
+        try:
+            initialize_models()
+        except Exception as e:
+            print(f"⚠️ Server keeps running without models: {e}")
+    
+    threading.Thread(target=load, name="model-loading", daemon=True).start()
+
+def models_ready():
+    return models_loaded and tutor_ready()
+
+def models_unavailable():
+    """True once loading has failed for good (waiting longer would not help)"""
+    return model_load_error is not None or (inference_client is not None and inference_client.failed is not None)
+
+def connection_status():
+    """Model status in the shape the renderer expects from connection_established"""
+    status = 'ready' if models_ready() else 'failed' if models_unavailable() else 'loading'
+    return {
+        'tutor_status': status,
+        'image_analyzer_status': status if image_analyzer is not None or status != 'ready' else 'unavailable',
+        'timestamp': time.time()
+    }
+
+@contextmanager
+def model_turn():
+    """
+    Hold response_lock for in-process generation that doesn't go through the batch
+    scheduler. Green threads streaming under it yield to the hub, so others poll
+    for it instead of blocking the hub on a real lock.
+    """
+    while not response_lock.acquire(blocking=False):
+        socketio.sleep(0.05)
+    try:
+        yield
+    finally:
+        response_lock.release()
+
+def wait_for_models(client_id, context):
+    """Hold a request that arrived before the model was ready; returns True once it may proceed"""
+    if models_ready():
+        return True
+    
+    def send_error(message):
+        socketio.emit('error', {
+            'type': 'error',
+            'message': message,
+            'context': context,
+            'timestamp': time.time(),
+            'client_id': client_id
+        }, to=client_id)
+    
+    if models_unavailable():
+        send_error('AI models failed to load.')
+        return False
+    
+    ticket = pending_requests.enter(client_id)
+    if ticket is None:
+        print(f"🚫 Pending queue full - rejecting request from {client_id}")
+        send_error('AI models are still loading and too many questions are waiting. Please try again shortly.')
+        return False
+    
+    position = pending_requests.position(ticket)
+    print(f"⏳ Request from {client_id} queued until models are ready (position {position})")
+    socketio.emit('model_loading_status', {
+        'message': f"⏳ Your question is queued (position {position}) and will be answered as soon as the AI model is ready",
+        'timestamp': time.time()
+    }, to=client_id)
+    
+    outcome = pending_requests.wait(ticket, ready=models_ready, failed=models_unavailable, sleep=socketio.sleep)
+    if outcome == 'ready':
+        print(f"▶️ Serving queued request from {client_id}")
+        return True
+    if outcome == 'failed':
+        send_error('AI models failed to load.')
+    elif outcome == 'timeout':
+        send_error('AI models are still loading. Please try again.')
+    return False
+
+def import_model_modules():
+    """Import torch/transformers and the model modules (the slowest part of a cold start)"""
+    for module in ('torch', 'transformers', 'ai_tutor', 'scheduler'):
+        try:
+            importlib.import_module(module)
+        except Exception as e:
+            print(f"⚠️ Failed to import {module}: {e}")
+            return
+
+def gpu_status():
+    """GPU availability without importing torch in the web process when the model runs in the worker"""
+    if inference_client is not None:
+        gpu_name = inference_client.info.get('gpu_name') if inference_client.ready else None
+        return gpu_name is not None, gpu_name or "N/A"
+    torch = sys.modules.get('torch')
+    if torch is None or not torch.cuda.is_available():
+        return False, "N/A"
+    return True, torch.cuda.get_device_name()
+
+def send_keep_alive():
+    """Send periodic keep-alive (runs on a Timer thread, so it goes through the broadcast queue)"""
+    with connection_lock:
+        connection_count = len(active_connections)
+    if connection_count:
+        broadcast_queue.put(('keep_alive', {
+            'timestamp': time.time(),
+            'status': 'ready' if models_loaded else 'loading',
+            'active_connections': connection_count
+        }))
+    
+    # Idle conversations (and the KV caches they pin) expire even when nobody is asking
+    if session_store is not None:
+        session_store.sweep()
     
     Timer(25.0, send_keep_alive).start()
 
@@ -182,29 +479,167 @@ def index():
         "websocket": "Connect to /socket.io/",
         "models_loaded": models_loaded,
         "active_connections": len(active_connections),
-        "text_model": "ready" if ai_tutor else "loading" if loading_in_progress else "failed",
+        "text_model": "ready" if tutor_ready() else "loading" if loading_in_progress else "failed",
         "image_model": "ready" if image_analyzer else "unavailable",
         "loading_in_progress": loading_in_progress
     }
 
 @app.route('/health')
 def health():
+    if inference_client is not None:
+        worker_stats = {}
+        if inference_client.ready:
+            try:
+                worker_stats = inference_client.request('stats', {}).result(socketio.sleep, timeout=2.0)
+            except Exception as e:
+                print(f"⚠️ Inference worker stats unavailable: {e}")
+        model_stats = {name: worker_stats.get(name) for name in ('batch_scheduler', 'prefix_cache', 'image_cache', 'image_ingest', 'speculative', 'profiler')}
+        worker_sessions = worker_stats.get('sessions')
+    else:
+        model_stats = {
+            "batch_scheduler": batch_scheduler.get_stats() if batch_scheduler else None,
+            "prefix_cache": ai_tutor.prefix_cache.get_stats() if ai_tutor else None,
+            "image_cache": ai_tutor.image_cache.get_stats() if ai_tutor else None,
+            "image_ingest": ai_tutor.image_ingest.get_stats() if ai_tutor else None,
+            "speculative": ai_tutor.speculative.get_stats() if ai_tutor else None,
+            "profiler": ai_tutor.profiler.get_stats() if ai_tutor else None,
+        }
+        worker_sessions = None
+    gpu_available, gpu_name = gpu_status()
+    
     return {
         "status": "healthy" if models_loaded else "loading" if loading_in_progress else "failed",
-        "tutor_ready": ai_tutor is not None,
+        "tutor_ready": tutor_ready(),
         "image_analyzer_ready": image_analyzer is not None,
         "websocket_endpoint": "/socket.io/",
         "models_loaded": models_loaded,
         "loading_in_progress": loading_in_progress,
         "active_connections": len(active_connections),
         "model_id": getattr(settings, 'hf_model_id', 'unknown') if settings else "unknown",
-        "gpu_available": torch.cuda.is_available(),
-        "gpu_name": torch.cuda.get_device_name() if torch.cuda.is_available() else "N/A"
+        **model_stats,
+        "answer_cache": answer_cache.get_stats() if answer_cache else None,
+        "semantic_cache": semantic_cache.get_stats() if semantic_cache else None,
+        "sessions": worker_sessions or (session_store.get_stats() if session_store else None),
+        "inference_worker": inference_client.get_stats() if inference_client else None,
+        "pending_requests": pending_requests.get_stats(),
+        "cancellation": cancel_registry.get_stats(),
+        "admission": admission.get_stats(),
+        "model_load_error": model_load_error,
+        "startup_timings": startup_timings,
+        "gpu_available": gpu_available,
+        "gpu_name": gpu_name
     }
 
+def collect_server_metrics():
+    """Scrape-time metrics owned by the web server"""
+    families = metrics.cache_families({
+        'answer': answer_cache.get_stats() if answer_cache else None,
+        'semantic': semantic_cache.get_stats() if semantic_cache else None,
+    })
+    families.append(metrics.gauge_family('tutor_active_connections', 'Connected Socket.IO clients',
+                                         [({}, len(active_connections))]))
+    families.append(metrics.gauge_family('tutor_pending_requests', 'Requests waiting for the model to load',
+                                         [({}, pending_requests.get_stats()['waiting'])]))
+    families += metrics.admission_families(admission.get_stats())
+    return families
+
+metrics.REGISTRY.add_collector('server', collect_server_metrics)
+metrics.watch_model(lambda: ai_tutor, lambda: batch_scheduler)
+
+@app.route('/metrics')
+def metrics_endpoint():
+    if settings is not None and not getattr(settings, 'metrics_enabled', True):
+        return Response("Metrics are disabled\n", status=404, mimetype='text/plain')
+    families = metrics.REGISTRY.collect()
+    # Generation stages are recorded in the worker process when there is one
+    if inference_client is not None and inference_client.ready:
+        try:
+            families += inference_client.request('metrics', {}).result(socketio.sleep, timeout=2.0)
+        except Exception as e:
+            print(f"⚠️ Inference worker metrics unavailable: {e}")
+    return Response(metrics.render(families), content_type=metrics.CONTENT_TYPE)
+
+def send_cached_answer(message_id, answer, cached=True):
+    """Replay a cached answer using the normal start/chunk/complete sequence"""
+    for event, payload in (
+        ('text_response_start', {}),
+        ('text_response_chunk', {'content': answer}),
+        ('text_response_complete', {'cached': cached}),
+    ):
+        emit(event, {
+            'type': event,
+            'message_id': message_id,
+            'timestamp': time.time(),
+            **payload
+        })
+
+def tutor_ready():
+    """Whether the text model can take requests right now (the worker may be restarting)"""
+    if inference_client is not None:
+        return inference_client.ready
+    return ai_tutor is not None
+
+def embed_question(question):
+    """Question embedding for the semantic cache, computed wherever the model lives"""
+    if inference_client is not None:
+        return inference_client.request('embed', {
+            'question': question,
+            'mode': settings.semantic_cache_embedding
+        }).result(socketio.sleep, timeout=30.0)
+    return ai_tutor.embed_question(question, settings.semantic_cache_embedding)
+
+def record_cached_answer(session, question, answer, settings_data):
+    """Add an answer served from cache to the conversation so follow-ups have its context"""
+    if inference_client is not None:
+        inference_client.request('record_answer', {
+            'session_id': session.sid,
+            'signature': session.signature,
+            'question': question,
+            'answer': answer,
+            'settings': settings_data
+        })
+        session.mark_turn()
+    else:
+        ai_tutor.record_session_answer(session, question, answer, settings_data)
+
+def generate_in_worker(message_id, text_request, send_chunk, session=None, deadline=None):
+    """Run a text request in the inference worker and stream its chunks back to the client"""
+    if session is not None:
+        text_request = dict(text_request, session_id=session.sid, signature=session.signature)
+    
+    # Wait cooperatively so the eventlet hub keeps serving other clients
+    for event in inference_client.generate(text_request, request_id=message_id).iter_events(socketio.sleep):
+        if event[0] == 'chunk':
+            send_chunk(event[1])
+        elif event[0] == 'complete':
+            if session is not None and event[2].get('session_turns') and not event[2].get('cancelled'):
+                session.mark_turn()
+            if deadline is not None:
+                # The worker enforces the deadline; this copy only reports the outcome
+                deadline.truncated = bool(event[2].get('truncated'))
+                deadline.fitted = bool(event[2].get('fitted'))
+            return event[1]
+        elif event[0] == 'error':
+            raise RuntimeError(event[1])
+
+def forward_cancellations(message_ids):
+    """Stop these generations in the inference worker (in-process generation watches its event itself)"""
+    if inference_client is None or not inference_client.ready:
+        return
+    for message_id in message_ids:
+        inference_client.cancel(message_id)
+
 @socketio.on('ask_ai_tutor')
 def handle_text_tutor(data):
     client_id = request.sid
+    received = time.perf_counter()
+    
+    if trace_recorder is not None:
+        trace_recorder.record_event(client_id, 'ask_ai_tutor', data)
+    
+    with connection_lock:
+        if client_id in active_connections:
+            active_connections[client_id]['message_count'] += 1
     
     print(f"\n" + "="*80)
     print(f"🎓 NEW REQUEST FROM CLIENT: {client_id}")
@@ -226,17 +661,99 @@ def handle_text_tutor(data):
         print(f"⚙️ Settings: {settings_data}")
         print(f"⚡ Max tokens: {max_tokens}")
         
-        if not models_loaded or not ai_tutor:
-            print(f"❌ MODELS NOT READY - models_loaded: {models_loaded}, ai_tutor: {ai_tutor is not None}")
-            emit('error', {
-                'type': 'error',
-                'message': 'AI models are still loading.',
-                'context': 'text-tutor'
-            })
+        # Opt-in greedy decoding so the same question always gets the same answer
+        deterministic = bool(settings_data.get('deterministic', False))
+        
+        # Follow-up questions continue this client's conversation; changing the
+        # tutor settings (or sending new_conversation) starts a fresh one
+        session = None
+        if session_store is not None:
+            session = session_store.get(
+                client_id,
+                signature=(
+                    settings_data.get('subject', 'General'),
+                    settings_data.get('language', 'English'),
+                    settings_data.get('level', 'middle_school')
+                ),
+                reset=bool(settings_data.get('new_conversation', False))
+            )
+            if session.busy:
+                print(f"⚠️ Previous answer for {client_id} still generating - answering without conversation context")
+                session = None
+        
+        # Cached answers only apply to the first question of a conversation
+        use_answer_caches = session is None or not session.has_history
+        
+        cache_key = None
+        if answer_cache is not None and use_answer_caches:
+            cache_key = make_cache_key(
+                user_message,
+                subject=settings_data.get('subject', 'General'),
+                level=settings_data.get('level', 'middle_school'),
+                language=settings_data.get('language', 'English'),
+                response_style=settings_data.get('response_style', 'regular'),
+                max_tokens=max(50, min(2048, int(max_tokens))),
+                deterministic=deterministic
+            )
+            cached_answer = answer_cache.get(cache_key)
+            if cached_answer is not None:
+                print(f"💾 Answer cache hit - skipping generation")
+                send_cached_answer(message_id, cached_answer)
+                metrics.REQUESTS.labels('text', 'answer_cache').inc()
+                metrics.REQUEST_SECONDS.labels('text').observe(time.perf_counter() - received)
+                if session is not None and models_loaded and tutor_ready():
+                    record_cached_answer(session, user_message, cached_answer, settings_data)
+                return
+        
+        queue_start = time.perf_counter()
+        if not wait_for_models(client_id, 'text-tutor'):
+            print(f"❌ MODELS NOT READY - models_loaded: {models_loaded}, tutor_ready: {tutor_ready()}")
+            metrics.REQUESTS.labels('text', 'unavailable').inc()
             return
+        metrics.QUEUE.observe(time.perf_counter() - queue_start)
         
         print(f"✅ Models ready, proceeding with generation")
         
+        question_vector = None
+        partition = None
+        if semantic_cache is not None and use_answer_caches:
+            try:
+                partition = make_partition(
+                    settings_data.get('subject', 'General'),
+                    settings_data.get('level', 'middle_school'),
+                    settings_data.get('language', 'English'),
+                    settings_data.get('response_style', 'regular'),
+                    max_tokens=max(50, min(2048, int(max_tokens))),
+                    deterministic=deterministic
+                )
+                question_vector = embed_question(user_message)
+                match = semantic_cache.lookup(question_vector, partition, question=user_message)
+                if match is not None:
+                    print(f"🧠 Semantic cache hit (similarity {match[1]:.3f}) - skipping generation")
+                    send_cached_answer(message_id, match[0], cached='semantic')
+                    metrics.REQUESTS.labels('text', 'semantic_cache').inc()
+                    metrics.REQUEST_SECONDS.labels('text').observe(time.perf_counter() - received)
+                    if session is not None:
+                        record_cached_answer(session, user_message, match[0], settings_data)
+                    return
+            except Exception as e:
+                print(f"⚠️ Semantic cache lookup failed: {e}")
+                question_vector = None
+        
+        # Wait for a generation slot; queue_position events carry the message_id so it can be cancelled
+        cancel_event = cancel_registry.register(message_id, client_id)
+        ticket = admit_request(client_id, 'text', 'text-tutor', max(50, min(2048, int(max_tokens))), message_id, cancel_event)
+        if ticket is None:
+            cancel_registry.release(message_id)
+            if cancel_event.is_set():
+                emit('text_response_complete', {
+                    'type': 'text_response_complete',
+                    'message_id': message_id,
+                    'cancelled': True,
+                    'timestamp': time.time()
+                })
+            return
+        
         # Step 1: Send start signal
         print(f"📤 STEP 1: Sending text_response_start to {client_id}")
         try:
@@ -248,23 +765,74 @@ def handle_text_tutor(data):
             print(f"✅ text_response_start sent successfully")
         except Exception as e:
             print(f"❌ FAILED to send text_response_start: {e}")
+            admission.release(ticket)
+            cancel_registry.release(message_id)
             return
         
-        # Step 2: Generate response
-        print(f"🔄 STEP 2: Generating AI response...")
+        # Step 2: Generate response, streaming chunks while decoding runs
+        print(f"🔄 STEP 2: Generating AI response (streaming)...")
         start_time = time.time()
+        chunk_count = 0
+        emit_time = 0.0
         
+        # Latency budget for this answer, counted from here
+        deadline = Deadline.from_request(settings_data, getattr(settings, 'generation_deadline_ms', 0))
+        
+        def send_chunk(text):
+            nonlocal chunk_count, emit_time
+            if cancel_event.is_set():
+                # The client stopped listening; the last step's text is dropped
+                return
+            emit_start = time.perf_counter()
+            if chunk_count == 0:
+                print(f"⏱️ First chunk after {time.time() - start_time:.2f}s")
+                metrics.FIRST_CHUNK_SECONDS.observe(emit_start - received)
+            chunk_count += 1
+            socketio.emit('text_response_chunk', {
+                'type': 'text_response_chunk',
+                'message_id': message_id,
+                'content': text,
+                'timestamp': time.time()
+            }, to=client_id)
+            emit_time += time.perf_counter() - emit_start
+            # Yield to the eventlet hub so the chunk is flushed before the next decode step
+            socketio.sleep(0)
+        
+        generation_failed = False
+        if session is not None:
+            session.busy = True
         try:
-            response = ai_tutor.ask_ai_tutor(
-                question=user_message,
-                subject=settings_data.get('subject', 'General'),
-                language=settings_data.get('language', 'English'),
-                level=settings_data.get('level', 'middle_school'),
-                max_tokens=max_tokens  # ← PASS THE TOKEN COUNT
-            )
+            text_request = {
+                'question': user_message,
+                'subject': settings_data.get('subject', 'General'),
+                'language': settings_data.get('language', 'English'),
+                'level': settings_data.get('level', 'middle_school'),
+                'max_tokens': max_tokens,  # ← PASS THE TOKEN COUNT
+                'response_style': settings_data.get('response_style', 'regular'),
+                'deterministic': deterministic,
+                'stream_chunk_tokens': getattr(settings, 'stream_chunk_tokens', 1),
+                'client_id': client_id,
+                'request_id': message_id,
+                'new_conversation': bool(settings_data.get('new_conversation', False)),
+                'profile': bool(settings_data.get('profile', False)),
+                'deadline_ms': deadline.budget * 1000 if deadline is not None else 0
+            }
+            if inference_client is not None:
+                response = generate_in_worker(message_id, text_request, send_chunk, session, deadline)
+            else:
+                # Assisted, profiled and unbatched answers take turns with image requests
+                batched = uses_scheduler(ai_tutor, batch_scheduler, text_request)
+                with (nullcontext() if batched else model_turn()):
+                    response = generate_text_answer(ai_tutor, batch_scheduler, text_request, send_chunk, socketio.sleep,
+                                                    session, cancel_event=cancel_event, deadline=deadline)
             
             generation_time = time.time() - start_time
-            print(f"✅ AI response generated in {generation_time:.2f}s")
+            if cancel_event.is_set():
+                print(f"🛑 Generation cancelled after {generation_time:.2f}s ({chunk_count} chunks streamed)")
+            elif deadline is not None and deadline.truncated:
+                print(f"⏱️ Answer cut short at its {deadline.budget:.1f}s deadline after {generation_time:.2f}s ({chunk_count} chunks streamed)")
+            else:
+                print(f"✅ AI response generated in {generation_time:.2f}s ({chunk_count} chunks streamed)")
             print(f"📝 Response length: {len(response)} characters")
             
             # PRINT THE FULL RESPONSE SO WE CAN SEE IT
@@ -276,36 +844,64 @@ def handle_text_tutor(data):
             print(f"❌ AI GENERATION FAILED: {e}")
             import traceback
             traceback.print_exc()
+            generation_failed = True
             response = f"Error generating response: {str(e)}"
             
             # PRINT THE ERROR RESPONSE TOO
             print(f"\n{'❌ ERROR RESPONSE:':=^80}")
             print(response)
             print(f"{'END OF ERROR RESPONSE':=^80}\n")
+            
+            # Step 3: Send the error text as a final chunk
+            try:
+                emit('text_response_chunk', {
+                    'type': 'text_response_chunk',
+                    'message_id': message_id,
+                    'content': response,
+                    'timestamp': time.time()
+                })
+            except Exception as e:
+                print(f"❌ FAILED to send text_response_chunk: {e}")
+                return
+        finally:
+            admission.release(ticket)
+            cancel_registry.release(message_id)
+            if session is not None:
+                session.busy = False
+            metrics.EMIT.observe(emit_time)
+            outcome = 'error' if generation_failed else 'cancelled' if cancel_event.is_set() else 'ok'
+            metrics.REQUESTS.labels('text', outcome).inc()
+            metrics.REQUEST_SECONDS.labels('text').observe(time.perf_counter() - received)
         
-        # Step 3: Send response
-        print(f"📤 STEP 3: Sending text_response_chunk to {client_id}")
-        print(f"📦 Chunk content length: {len(response)}")
-        try:
-            emit('text_response_chunk', {
-                'type': 'text_response_chunk',
+        if cancel_event.is_set():
+            # A partial answer is not cached and not part of the conversation
+            emit('text_response_complete', {
+                'type': 'text_response_complete',
                 'message_id': message_id,
-                'content': response,
+                'cancelled': True,
                 'timestamp': time.time()
             })
-            print(f"✅ text_response_chunk sent successfully ({len(response)} chars)")
-        except Exception as e:
-            print(f"❌ FAILED to send text_response_chunk: {e}")
-            import traceback
-            traceback.print_exc()
             return
         
+        if session is not None and not generation_failed:
+            session_store.commit(session)
+        
+        # Answers cut short by a deadline (or given a smaller budget to fit it) depend on
+        # this machine's speed, so they aren't cached under the client's max_tokens
+        truncated = deadline is not None and deadline.truncated
+        cacheable = not generation_failed and not truncated and not (deadline is not None and deadline.fitted)
+        if cache_key is not None and cacheable and response:
+            answer_cache.put(cache_key, response)
+        if question_vector is not None and cacheable and response:
+            semantic_cache.insert(question_vector, partition, response, question=user_message)
+        
         # Step 4: Send completion
         print(f"📤 STEP 4: Sending text_response_complete to {client_id}")
         try:
             emit('text_response_complete', {
                 'type': 'text_response_complete',
                 'message_id': message_id,
+                'truncated': truncated,
                 'timestamp': time.time()
             })
             print(f"✅ text_response_complete sent successfully")
@@ -323,6 +919,21 @@ def handle_text_tutor(data):
         traceback.print_exc()
         print(f"="*80 + "\n")
 
+@socketio.on('connect')
+def handle_connect():
+    client_id = request.sid
+    
+    with connection_lock:
+        active_connections[client_id] = {
+            'connected_at': time.time(),
+            'last_ping': time.time(),
+            'message_count': 0
+        }
+        total = len(active_connections)
+    print(f'🔗 Client {client_id} connected (Total: {total})')
+    
+    emit('connection_established', dict(connection_status(), client_id=client_id))
+
 @socketio.on('disconnect')
 def handle_disconnect():
     client_id = request.sid
@@ -333,6 +944,29 @@ def handle_disconnect():
             print(f'🔌 Client {client_id} disconnected after {connection_info["message_count"]} messages (Remaining: {len(active_connections)})')
         else:
             print(f'🔌 Unknown client disconnected: {client_id}')
+    
+    # Questions still waiting for the model are no longer wanted, and answers in progress can stop
+    pending_requests.drop_client(client_id)
+    admission.drop_client(client_id)
+    cancelled = cancel_registry.cancel_client(client_id)
+    if cancelled:
+        forward_cancellations(cancelled)
+        print(f'🛑 Cancelled {len(cancelled)} generation(s) for {client_id}')
+    
+    # Free the conversation's KV cache
+    if session_store is not None and session_store.drop(client_id):
+        if inference_client is not None and inference_client.ready:
+            inference_client.request('drop_session', {'session_id': client_id})
+        print(f'🧹 Cleared conversation state for {client_id}')
+
+@socketio.on('cancel_generation')
+def handle_cancel_generation(data):
+    """Stop streaming an answer: {'message_id': <id from text_response_start>}"""
+    client_id = request.sid
+    message_id = (data or {}).get('message_id')
+    if message_id and cancel_registry.cancel(message_id, client_id):
+        forward_cancellations([message_id])
+        print(f'🛑 Cancelling generation {message_id} for {client_id}')
 
 @socketio.on('ping')
 def handle_ping(data):
@@ -351,55 +985,197 @@ def handle_ping(data):
 @socketio.on('ask_image_question')
 def handle_image_analysis(data):
     client_id = request.sid
+    received = time.perf_counter()
     
-    with response_lock:
-        try:
-            image_url = data['image_url']
-            question = data['question']
-            
-            print(f"🖼️ Processing image analysis for {client_id}: {question[:50]}...")
-            
-            if not models_loaded or not image_analyzer:
-                emit('error', {
-                    'type': 'error',
-                    'message': 'Image analysis is not available. Running in text-only mode.',
-                    'context': 'image-analyzer',
-                    'timestamp': time.time(),
-                    'client_id': client_id
-                })
-                return
-            
-            emit('image_analysis_start', {
-                'type': 'image_analysis_start',
-                'timestamp': time.time(),
-                'client_id': client_id
-            })
-            
+    if trace_recorder is not None:
+        trace_recorder.record_event(client_id, 'ask_image_question', data)
+    
+    # Requests that arrive while the model loads wait in line (before taking the response lock)
+    if not wait_for_models(client_id, 'image-analyzer'):
+        return
+    
+    ticket = admit_request(client_id, 'image', 'image-analyzer', IMAGE_COST)
+    if ticket is None:
+        return
+    
+    # The worker serializes image requests itself, and waiting on it must not hold a real lock
+    try:
+        with (nullcontext() if inference_client is not None else model_turn()):
+            metrics.QUEUE.observe(time.perf_counter() - received)
             try:
-                result = image_analyzer.ask_image_question(image_url, question)
+                question = data['question']
+                
+                # Binary uploads arrive as bytes; decode them in place instead of via a base64 data URL
+                if data.get('image') is not None:
+                    image_input = memoryview(data['image'])
+                    print(f"🖼️ Processing image analysis for {client_id} ({image_input.nbytes / 1024:.0f}KB {data.get('image_type', 'image')}): {question[:50]}...")
+                else:
+                    image_input = data['image_url']
+                    print(f"🖼️ Processing image analysis for {client_id}: {question[:50]}...")
+                
+                if not models_loaded or not image_analyzer or not tutor_ready():
+                    emit('error', {
+                        'type': 'error',
+                        'message': 'Image analysis is not available. Running in text-only mode.',
+                        'context': 'image-analyzer',
+                        'timestamp': time.time(),
+                        'client_id': client_id
+                    })
+                    return
                 
-                emit('image_analysis_result', {
-                    'type': 'image_analysis_result',
-                    'result': result,
+                emit('image_analysis_start', {
+                    'type': 'image_analysis_start',
                     'timestamp': time.time(),
                     'client_id': client_id
                 })
                 
-                print(f"✅ Image analysis completed for {client_id}")
+                try:
+                    profile = bool(data.get('settings', {}).get('profile', False))
+                    if inference_client is not None:
+                        result = inference_client.ask_image_question(image_input, question, profile).result(socketio.sleep)
+                    else:
+                        result = image_analyzer.ask_image_question(image_input, question, profile=profile)
+                    
+                    emit('image_analysis_result', {
+                        'type': 'image_analysis_result',
+                        'result': result,
+                        'timestamp': time.time(),
+                        'client_id': client_id
+                    })
+                    
+                    print(f"✅ Image analysis completed for {client_id}")
+                    metrics.REQUESTS.labels('image', 'ok').inc()
+                    metrics.REQUEST_SECONDS.labels('image').observe(time.perf_counter() - received)
+                    
+                except Exception as e:
+                    print(f"❌ Error in image analysis for {client_id}: {e}")
+                    metrics.REQUESTS.labels('image', 'error').inc()
+                    emit('error', {
+                        'type': 'error',
+                        'message': f"Error analyzing image: {str(e)}",
+                        'context': 'image-analyzer',
+                        'timestamp': time.time(),
+                        'client_id': client_id
+                    })
                 
             except Exception as e:
-                print(f"❌ Error in image analysis for {client_id}: {e}")
-                emit('error', {
-                    'type': 'error',
-                    'message': f"Error analyzing image: {str(e)}",
-                    'context': 'image-analyzer',
+                print(f"❌ Image analysis handler error for {client_id}: {e}")
+                traceback.print_exc()
+    finally:
+        admission.release(ticket)
+
+@socketio.on('ask_image_batch')
+def handle_image_batch(data):
+    """Several image questions (e.g. worksheet pages) answered in one batch, each result sent as it finishes"""
+    client_id = request.sid
+    received = time.perf_counter()
+    
+    if trace_recorder is not None:
+        trace_recorder.record_event(client_id, 'ask_image_batch', data)
+    
+    items = data.get('images') or []
+    max_images = getattr(settings, 'image_batch_max_images', 8)
+    if not items or len(items) > max_images:
+        emit('error', {
+            'type': 'error',
+            'message': f"Send between 1 and {max_images} images per batch.",
+            'context': 'image-analyzer',
+            'timestamp': time.time(),
+            'client_id': client_id
+        })
+        return
+    
+    if not wait_for_models(client_id, 'image-analyzer'):
+        return
+    
+    ticket = admit_request(client_id, 'image', 'image-analyzer', IMAGE_COST * len(items))
+    if ticket is None:
+        return
+    
+    batch_id = str(uuid.uuid4())
+    try:
+        with (nullcontext() if inference_client is not None else model_turn()):
+            metrics.QUEUE.observe(time.perf_counter() - received)
+            try:
+                # Binary uploads arrive as bytes, like ask_image_question
+                image_inputs = [memoryview(item['image']) if item.get('image') is not None else item['image_url']
+                                for item in items]
+                questions = [item['question'] for item in items]
+                max_tokens = int(data.get('max_tokens', 300))
+                print(f"🖼️ Processing batch of {len(items)} images for {client_id}")
+                
+                if not models_loaded or not image_analyzer or not tutor_ready():
+                    emit('error', {
+                        'type': 'error',
+                        'message': 'Image analysis is not available. Running in text-only mode.',
+                        'context': 'image-analyzer',
+                        'timestamp': time.time(),
+                        'client_id': client_id
+                    })
+                    return
+                
+                emit('image_batch_start', {
+                    'type': 'image_batch_start',
+                    'batch_id': batch_id,
+                    'count': len(items),
                     'timestamp': time.time(),
                     'client_id': client_id
                 })
-            
-        except Exception as e:
-            print(f"❌ Image analysis handler error for {client_id}: {e}")
-            traceback.print_exc()
+                
+                def send_result(index, result):
+                    socketio.emit('image_batch_result', {
+                        'type': 'image_batch_result',
+                        'batch_id': batch_id,
+                        'index': index,
+                        'result': result,
+                        'timestamp': time.time()
+                    }, to=client_id)
+                    # Flush it before the rest of the batch keeps decoding
+                    socketio.sleep(0)
+                
+                try:
+                    profile = bool(data.get('settings', {}).get('profile', False))
+                    if inference_client is not None:
+                        handle = inference_client.ask_image_batch(image_inputs, questions, max_tokens, profile)
+                        for event in handle.iter_events(socketio.sleep):
+                            if event[0] == 'chunk':
+                                send_result(*event[1])
+                            elif event[0] == 'complete':
+                                results = event[1]
+                            elif event[0] == 'error':
+                                raise RuntimeError(event[1])
+                    else:
+                        results = image_analyzer.ask_image_batch(image_inputs, questions, max_tokens=max_tokens,
+                                                                 on_result=send_result, profile=profile)
+                    
+                    emit('image_batch_complete', {
+                        'type': 'image_batch_complete',
+                        'batch_id': batch_id,
+                        'results': results,
+                        'timestamp': time.time(),
+                        'client_id': client_id
+                    })
+                    
+                    print(f"✅ Image batch completed for {client_id}")
+                    metrics.REQUESTS.labels('image', 'ok').inc()
+                    metrics.REQUEST_SECONDS.labels('image').observe(time.perf_counter() - received)
+                    
+                except Exception as e:
+                    print(f"❌ Error in image batch for {client_id}: {e}")
+                    metrics.REQUESTS.labels('image', 'error').inc()
+                    emit('error', {
+                        'type': 'error',
+                        'message': f"Error analyzing images: {str(e)}",
+                        'context': 'image-analyzer',
+                        'timestamp': time.time(),
+                        'client_id': client_id
+                    })
+                
+            except Exception as e:
+                print(f"❌ Image batch handler error for {client_id}: {e}")
+                traceback.print_exc()
+    finally:
+        admission.release(ticket)
 
 if __name__ == '__main__':
     print("🚀 Starting Robust AI Tutor Backend")
@@ -411,19 +1187,21 @@ if __name__ == '__main__':
     print("💓 Starting keep-alive mechanism...")
     Timer(10.0, send_keep_alive).start()
     
-    # Initialize models
-    try:
-        initialize_models()
-    except Exception as e:
-        print(f"❌ Model initialization failed: {e}")
-        print("⚠️ Starting server anyway - models can be loaded later")
+    # Load models in the background; early requests wait in the pending queue
+    socketio.start_background_task(pump_broadcasts)
+    start_model_loading()
     
     # Run with SocketIO
-    socketio.run(
-        app, 
-        host='0.0.0.0', 
-        port=5000, 
-        debug=True,
-        use_reloader=False,
-        allow_unsafe_werkzeug=True
-    )
\ No newline at end of file
+    try:
+        socketio.run(
+            app, 
+            host='0.0.0.0', 
+            port=5000, 
+            debug=True,
+            use_reloader=False,
+            allow_unsafe_werkzeug=True
+        )
+    finally:
+        # Memory-mapped semantic index rows and recency are only written on flush
+        if semantic_cache is not None:
+            semantic_cache.flush()
\ No newline at end of file
@@ -0,0 +1,1034 @@
+"""
+ASGI/asyncio server for the AI Tutor - same Socket.IO protocol as app.py, without eventlet
+
+    python asgi_app.py                      # serves on ASGI_PORT (default 5001)
+    uvicorn asgi_app:app --port 5001
+
+Inference never runs on the event loop: it happens in the inference worker
+process, or in background threads when the worker is disabled. Every
+connection has its own bounded send queue, so a slow client only stalls its
+own requests and is disconnected if it stops reading altogether.
+"""
+import asyncio
+import functools
+import logging
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
+from typing import Dict, Optional
+
+import socketio
+from fastapi import FastAPI, Response
+
+import metrics
+from answer_cache import AnswerCache, make_cache_key
+from config import get_settings
+from inference_worker import InferenceClient, WorkerRequest, generate_text_answer, uses_scheduler
+from cancellation import CancelRegistry
+from admission import AdmissionController, IMAGE_COST, Rejected
+from deadline import Deadline
+from pending import PendingRequestQueue
+from semantic_cache import SemanticAnswerCache, make_partition
+from sessions import SessionStore
+from traces import TraceRecorder
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+settings = get_settings()
+
+sio = socketio.AsyncServer(
+    async_mode='asgi',
+    cors_allowed_origins='*',
+    ping_timeout=900,
+    ping_interval=30,
+    max_http_buffer_size=10000000
+)
+
+
+class ClientChannel:
+    """
+    Outgoing events for one connection, sent in order by a dedicated task.
+
+    `send` waits while the queue is full (backpressure on that client's
+    requests). Consecutive chunks of the same message are merged when a
+    client falls behind, and a client that cannot take an event within
+    `send_timeout` seconds is disconnected.
+    """
+
+    def __init__(self, sid: str, maxsize: int, send_timeout: float, max_transport_backlog: int = 16):
+        self.sid = sid
+        self.send_timeout = send_timeout
+        self.max_transport_backlog = max_transport_backlog
+        self.queue: asyncio.Queue = asyncio.Queue(maxsize=maxsize)
+        self.sent = 0
+        self.merged_chunks = 0
+        self._held = None
+        self._task = asyncio.create_task(self._drain())
+
+    async def send(self, event: str, data: dict):
+        try:
+            await asyncio.wait_for(self.queue.put((event, data)), self.send_timeout)
+        except asyncio.TimeoutError:
+            logger.warning(f"🐢 Client {self.sid} stopped reading, disconnecting")
+            await sio.disconnect(self.sid)
+            raise ConnectionError(f"client {self.sid} is not reading")
+
+    def close(self):
+        self._task.cancel()
+
+    def _transport_backlog(self) -> int:
+        """Packets engine.io has queued but not yet written to this client's transport"""
+        try:
+            eio_sid = sio.manager.eio_sid_from_sid(self.sid, '/')
+            return sio.eio.sockets[eio_sid].queue.qsize()
+        except (AttributeError, KeyError):
+            return 0
+
+    async def _next(self):
+        if self._held is not None:
+            item, self._held = self._held, None
+            return item
+        return await self.queue.get()
+
+    async def _drain(self):
+        while True:
+            event, data = await self._next()
+
+            if event == 'text_response_chunk':
+                # Catch up by folding queued chunks of the same message into one frame
+                while not self.queue.empty():
+                    next_event, next_data = self.queue.get_nowait()
+                    if next_event == event and next_data.get('message_id') == data.get('message_id'):
+                        data = dict(data, content=data['content'] + next_data['content'])
+                        self.merged_chunks += 1
+                    else:
+                        self._held = (next_event, next_data)
+                        break
+
+            # Let the transport drain before handing engine.io more data
+            while self._transport_backlog() > self.max_transport_backlog:
+                await asyncio.sleep(0.01)
+
+            try:
+                await sio.emit(event, data, to=self.sid)
+                self.sent += 1
+            except Exception as e:
+                logger.warning(f"⚠️ Failed to send {event} to {self.sid}: {e}")
+
+
+class TutorRuntime:
+    """Models, caches and connections shared by all handlers"""
+
+    def __init__(self):
+        self.ai_tutor = None
+        self.batch_scheduler = None
+        self.inference_client: Optional[InferenceClient] = None
+        self.answer_cache: Optional[AnswerCache] = None
+        self.semantic_cache: Optional[SemanticAnswerCache] = None
+        self.session_store: Optional[SessionStore] = None
+        self.trace_recorder: Optional[TraceRecorder] = None
+        self.models_loaded = False
+        self.loading_in_progress = False
+        self.load_error: Optional[str] = None
+        self.startup_timings = {}
+        self.pending = PendingRequestQueue(settings.pending_queue_max_size, settings.pending_request_timeout)
+        self.cancels = CancelRegistry()
+        self.admission = AdmissionController(
+            max_queue=settings.admission_max_queue,
+            max_per_client=settings.admission_max_per_client,
+            shortest_first=settings.admission_shortest_first
+        )
+        self.channels: Dict[str, ClientChannel] = {}
+        self.loop: Optional[asyncio.AbstractEventLoop] = None
+        # Direct (unbatched) generation and vision requests run one at a time, off the event loop
+        self.generate_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="asgi-generate")
+
+    def tutor_ready(self) -> bool:
+        if self.inference_client is not None:
+            return self.inference_client.ready
+        return self.ai_tutor is not None
+
+    def models_ready(self) -> bool:
+        return self.models_loaded and self.tutor_ready()
+
+    def models_unavailable(self) -> bool:
+        """True once loading has failed for good (waiting longer would not help)"""
+        return self.load_error is not None or (
+            self.inference_client is not None and self.inference_client.failed is not None
+        )
+
+    # -- startup -------------------------------------------------------
+
+    def start(self, loop: asyncio.AbstractEventLoop):
+        self.loop = loop
+        if getattr(settings, 'answer_cache_enabled', False):
+            self.answer_cache = AnswerCache(
+                max_entries=settings.answer_cache_max_entries,
+                ttl_seconds=settings.answer_cache_ttl_seconds,
+                db_path=settings.answer_cache_db_path or None
+            )
+        if getattr(settings, 'sessions_enabled', False):
+            self.session_store = SessionStore(
+                max_bytes=int(settings.session_cache_max_mb * 1024**2),
+                idle_seconds=settings.session_idle_seconds,
+                max_tokens=settings.session_max_tokens
+            )
+        if getattr(settings, 'trace_file', ''):
+            self.trace_recorder = TraceRecorder(settings.trace_file, include_text=settings.trace_include_text)
+        self.loading_in_progress = True
+        threading.Thread(target=self._load_models, name="asgi-model-load", daemon=True).start()
+
+    def _load_models(self):
+        start = time.perf_counter()
+        try:
+            if getattr(settings, 'inference_worker_enabled', False):
+                self.send_status("🧠 Starting inference worker...")
+                self.inference_client = InferenceClient(settings, on_status=self.send_status)
+                self.inference_client.start()
+                if not self.inference_client.wait_ready():
+                    raise RuntimeError(self.inference_client.failed or "Inference worker failed to start")
+                embedding_dim = self.inference_client.info.get('embedding_dim')
+                self.startup_timings['worker'] = self.inference_client.info.get('startup_timings', {})
+            else:
+                from ai_tutor import AITutor
+                from scheduler import BatchScheduler
+
+                self.send_status("🎓 Loading AI Tutor model...")
+                ai_tutor = AITutor(settings.hf_model_id, settings.hf_token, settings)
+                ai_tutor.initialize(on_progress=self.send_status)
+                if getattr(settings, 'batch_scheduler_enabled', False):
+                    self.batch_scheduler = BatchScheduler(
+                        ai_tutor,
+                        max_batch_size=settings.max_batch_size,
+                        max_prefill_batch=settings.max_prefill_batch
+                    )
+                    self.batch_scheduler.start()
+                self.ai_tutor = ai_tutor
+                embedding_dim = ai_tutor.embedding_dim
+                self.startup_timings.update(ai_tutor.startup_timings)
+
+            if getattr(settings, 'semantic_cache_enabled', False) and embedding_dim:
+                try:
+                    self.semantic_cache = SemanticAnswerCache(
+                        dim=embedding_dim,
+                        threshold=settings.semantic_cache_threshold,
+                        max_entries=settings.semantic_cache_max_entries,
+                        persist_dir=settings.semantic_cache_dir or None,
+                        signature=f"{settings.hf_model_id}|{settings.semantic_cache_embedding}"
+                    )
+                except Exception as e:
+                    logger.warning(f"⚠️ Semantic cache unavailable: {e}")
+
+            self.admission.max_concurrent = self.generation_slots()
+            self.models_loaded = True
+            self.startup_timings['total'] = time.perf_counter() - start
+            self.send_status("🎉 All AI models loaded! Ready to chat!")
+            asyncio.run_coroutine_threadsafe(sio.emit('connection_established', self.connection_status()), self.loop)
+        except Exception as e:
+            logger.error(f"❌ Failed to initialize models: {e}")
+            self.load_error = str(e)
+            self.send_status(f"❌ Model loading failed: {str(e)}")
+        finally:
+            self.loading_in_progress = False
+
+    def generation_slots(self) -> int:
+        """Generations allowed to run at once: the batch size with a batch scheduler, else one"""
+        if settings.admission_max_concurrent > 0:
+            return settings.admission_max_concurrent
+        batched = self.batch_scheduler is not None or (
+            self.inference_client is not None and self.inference_client.info.get('batch_scheduler')
+        )
+        return settings.max_batch_size if batched else 1
+
+    def connection_status(self) -> dict:
+        """Model status in the shape the renderer expects from connection_established"""
+        status = 'ready' if self.models_ready() else 'failed' if self.models_unavailable() else 'loading'
+        return {'tutor_status': status, 'image_analyzer_status': status, 'timestamp': time.time()}
+
+    def send_status(self, message: str, progress: Optional[dict] = None):
+        """Broadcast model_loading_status; safe to call from any thread"""
+        logger.info(f"📡 {message}")
+        if self.loop is None:
+            return
+        payload = {'message': message, 'timestamp': time.time()}
+        if progress:
+            payload['progress'] = progress
+        asyncio.run_coroutine_threadsafe(sio.emit('model_loading_status', payload), self.loop)
+
+    # -- inference off the event loop ----------------------------------
+
+    def start_text_generation(self, message_id: str, text_request: dict, session=None,
+                              cancel_event: Optional[threading.Event] = None) -> WorkerRequest:
+        """Start generating in the worker or a background thread; events arrive on the handle"""
+        if self.inference_client is not None:
+            if session is not None:
+                text_request = dict(text_request, session_id=session.sid, signature=session.signature)
+            return self.inference_client.generate(text_request, request_id=message_id)
+
+        handle = WorkerRequest(message_id)
+        deadline = Deadline.from_request(text_request, settings.generation_deadline_ms)
+
+        def run():
+            try:
+                response = generate_text_answer(
+                    self.ai_tutor,
+                    self.batch_scheduler,
+                    text_request,
+                    on_chunk=lambda text: handle.events.put(('chunk', text)),
+                    session=session,
+                    cancel_event=cancel_event,
+                    deadline=deadline
+                )
+                handle.events.put(('complete', response, {
+                    'session_turns': session.turns if session else 0,
+                    'cancelled': cancel_event is not None and cancel_event.is_set(),
+                    'truncated': deadline is not None and deadline.truncated,
+                    'fitted': deadline is not None and deadline.fitted
+                }))
+            except Exception as e:
+                handle.events.put(('error', str(e)))
+
+        if uses_scheduler(self.ai_tutor, self.batch_scheduler, text_request):
+            # Waits on the scheduler's events; the scheduler thread does the work
+            threading.Thread(target=run, daemon=True).start()
+        else:
+            self.generate_executor.submit(run)
+        return handle
+
+    async def embed_question(self, question: str):
+        if self.inference_client is not None:
+            handle = self.inference_client.request('embed', {
+                'question': question,
+                'mode': settings.semantic_cache_embedding
+            })
+            return await wait_result(handle, timeout=30.0)
+        return await asyncio.get_running_loop().run_in_executor(
+            None, self.ai_tutor.embed_question, question, settings.semantic_cache_embedding
+        )
+
+    async def ask_image_question(self, image_input, question: str, profile: bool = False) -> str:
+        if self.inference_client is not None:
+            return await wait_result(self.inference_client.ask_image_question(image_input, question, profile))
+        return await asyncio.get_running_loop().run_in_executor(
+            self.generate_executor, functools.partial(self.ai_tutor.ask_image_question, image_input, question, profile=profile)
+        )
+
+    def start_image_batch(self, image_inputs: list, questions: list, max_tokens: int = 300,
+                          profile: bool = False) -> WorkerRequest:
+        """Start answering several image questions; ('chunk', (index, text)) events arrive as each finishes"""
+        if self.inference_client is not None:
+            return self.inference_client.ask_image_batch(image_inputs, questions, max_tokens, profile)
+
+        handle = WorkerRequest(str(uuid.uuid4()))
+
+        def run():
+            try:
+                results = self.ai_tutor.ask_image_batch(
+                    image_inputs, questions, max_tokens=max_tokens,
+                    on_result=lambda index, text: handle.events.put(('chunk', (index, text))),
+                    profile=profile
+                )
+                handle.events.put(('complete', results, {}))
+            except Exception as e:
+                handle.events.put(('error', str(e)))
+
+        self.generate_executor.submit(run)
+        return handle
+
+    def cancel_generations(self, message_ids):
+        """Stop these generations in the inference worker (in-process generation watches its event itself)"""
+        if self.inference_client is None or not self.inference_client.ready:
+            return
+        for message_id in message_ids:
+            self.inference_client.cancel(message_id)
+
+    def record_cached_answer(self, session, question: str, answer: str, settings_data: dict):
+        if self.inference_client is not None:
+            self.inference_client.request('record_answer', {
+                'session_id': session.sid,
+                'signature': session.signature,
+                'question': question,
+                'answer': answer,
+                'settings': settings_data
+            })
+            session.mark_turn()
+        else:
+            self.ai_tutor.record_session_answer(session, question, answer, settings_data)
+
+
+runtime = TutorRuntime()
+
+
+async def iter_events(handle, poll_interval: float = 0.01):
+    """Async version of GenerationRequest.iter_events for any handle with an `events` queue"""
+    while True:
+        while handle.events.empty():
+            await asyncio.sleep(poll_interval)
+        event = handle.events.get_nowait()
+        yield event
+        if event[0] in ('complete', 'error'):
+            return
+
+
+async def wait_result(handle, timeout: Optional[float] = None):
+    async def wait():
+        async for event in iter_events(handle):
+            if event[0] == 'complete':
+                return event[1]
+            if event[0] == 'error':
+                raise RuntimeError(event[1])
+    return await asyncio.wait_for(wait(), timeout)
+
+
+async def wait_for_models(sid: str, channel: ClientChannel, context: str) -> bool:
+    """Hold a request that arrived before the model was ready; returns True once it may proceed"""
+    if runtime.models_ready():
+        return True
+
+    async def send_error(message):
+        await channel.send('error', {
+            'type': 'error',
+            'message': message,
+            'context': context,
+            'timestamp': time.time(),
+            'client_id': sid
+        })
+
+    if runtime.models_unavailable():
+        await send_error('AI models failed to load.')
+        return False
+
+    ticket = runtime.pending.enter(sid)
+    if ticket is None:
+        await send_error('AI models are still loading and too many questions are waiting. Please try again shortly.')
+        return False
+
+    position = runtime.pending.position(ticket)
+    await channel.send('model_loading_status', {
+        'message': f"⏳ Your question is queued (position {position}) and will be answered as soon as the AI model is ready",
+        'timestamp': time.time()
+    })
+    started = time.time()
+    try:
+        while True:
+            outcome = runtime.pending.poll(ticket, runtime.models_ready, runtime.models_unavailable, started)
+            if outcome is not None:
+                break
+            await asyncio.sleep(0.1)
+    finally:
+        runtime.pending.leave(ticket)
+
+    if outcome == 'failed':
+        await send_error('AI models failed to load.')
+    elif outcome == 'timeout':
+        await send_error('AI models are still loading. Please try again.')
+    return outcome == 'ready'
+
+
+async def admit_request(sid: str, channel: ClientChannel, kind: str, context: str, cost: int,
+                        message_id: Optional[str] = None, cancel_event: Optional[threading.Event] = None):
+    """Wait for a generation slot; returns the admission ticket, or None if the request was turned away"""
+    try:
+        ticket = runtime.admission.enter(sid, cost)
+    except Rejected as e:
+        logger.info(f"🚫 Rejecting {context} request from {sid}: {e.reason}")
+        metrics.REQUESTS.labels(kind, 'busy').inc()
+        await channel.send('busy', {
+            'type': 'busy',
+            'reason': e.reason,
+            'message': str(e),
+            'context': context,
+            'retry_after': round(runtime.admission.estimated_wait(runtime.admission.max_queue), 1),
+            'timestamp': time.time()
+        })
+        return None
+
+    wait_start = time.perf_counter()
+    last_position, last_report = None, 0.0
+    try:
+        while True:
+            outcome, position = runtime.admission.poll(ticket, cancel_event.is_set if cancel_event is not None else None)
+            if outcome is not None:
+                break
+            now = time.time()
+            if position != last_position or now - last_report >= settings.admission_position_interval:
+                await channel.send('queue_position', {
+                    'type': 'queue_position',
+                    'message_id': message_id,
+                    'context': context,
+                    'position': position,
+                    'estimated_wait': round(runtime.admission.estimated_wait(position), 1),
+                    'timestamp': time.time()
+                })
+                last_position, last_report = position, now
+            await asyncio.sleep(0.05)
+    except BaseException:
+        # Client gone (ConnectionError) or handler cancelled while waiting
+        runtime.admission.release(ticket)
+        raise
+    metrics.ADMISSION.observe(time.perf_counter() - wait_start)
+    if outcome != 'admitted':
+        logger.info(f"🚪 {context} request from {sid} left the admission queue ({outcome})")
+        metrics.REQUESTS.labels(kind, 'cancelled').inc()
+        return None
+    return ticket
+
+
+async def send_keep_alive():
+    while True:
+        await asyncio.sleep(25.0)
+        # Idle conversations (and the KV caches they pin) expire even when nobody is asking
+        if runtime.session_store is not None:
+            runtime.session_store.sweep()
+        if runtime.channels:
+            await sio.emit('keep_alive', {
+                'timestamp': time.time(),
+                'status': 'ready' if runtime.models_loaded else 'loading',
+                'active_connections': len(runtime.channels)
+            })
+
+
+@asynccontextmanager
+async def lifespan(api: FastAPI):
+    runtime.start(asyncio.get_running_loop())
+    keep_alive = asyncio.create_task(send_keep_alive())
+    yield
+    keep_alive.cancel()
+    if runtime.inference_client is not None:
+        runtime.inference_client.stop()
+    if runtime.batch_scheduler is not None:
+        runtime.batch_scheduler.stop()
+    if runtime.semantic_cache is not None:
+        runtime.semantic_cache.flush()
+
+
+api = FastAPI(title="AI Tutor", lifespan=lifespan)
+app = socketio.ASGIApp(sio, other_asgi_app=api)
+
+
+@api.get('/')
+async def index():
+    return {
+        "status": "AI Tutor Backend Running (ASGI)",
+        "websocket": "Connect to /socket.io/",
+        "models_loaded": runtime.models_loaded,
+        "active_connections": len(runtime.channels),
+        "text_model": "ready" if runtime.tutor_ready() else "loading" if runtime.loading_in_progress else "failed",
+        "image_model": "ready" if runtime.tutor_ready() else "unavailable",
+        "loading_in_progress": runtime.loading_in_progress
+    }
+
+
+@api.get('/health')
+async def health():
+    model_stats, worker_sessions = {}, None
+    if runtime.inference_client is not None and runtime.inference_client.ready:
+        try:
+            worker_stats = await wait_result(runtime.inference_client.request('stats', {}), timeout=2.0)
+            model_stats = {name: worker_stats.get(name) for name in ('batch_scheduler', 'prefix_cache', 'image_cache', 'image_ingest', 'speculative', 'profiler')}
+            worker_sessions = worker_stats.get('sessions')
+        except Exception as e:
+            logger.warning(f"⚠️ Inference worker stats unavailable: {e}")
+    elif runtime.ai_tutor is not None:
+        model_stats = {
+            "batch_scheduler": runtime.batch_scheduler.get_stats() if runtime.batch_scheduler else None,
+            "prefix_cache": runtime.ai_tutor.prefix_cache.get_stats(),
+            "image_cache": runtime.ai_tutor.image_cache.get_stats(),
+            "image_ingest": runtime.ai_tutor.image_ingest.get_stats(),
+            "speculative": runtime.ai_tutor.speculative.get_stats(),
+            "profiler": runtime.ai_tutor.profiler.get_stats(),
+        }
+
+    return {
+        "status": "healthy" if runtime.models_loaded else "loading" if runtime.loading_in_progress else "failed",
+        "server": "asgi",
+        "tutor_ready": runtime.tutor_ready(),
+        "websocket_endpoint": "/socket.io/",
+        "models_loaded": runtime.models_loaded,
+        "loading_in_progress": runtime.loading_in_progress,
+        "active_connections": len(runtime.channels),
+        "model_id": getattr(settings, 'hf_model_id', 'unknown'),
+        **model_stats,
+        "answer_cache": runtime.answer_cache.get_stats() if runtime.answer_cache else None,
+        "semantic_cache": runtime.semantic_cache.get_stats() if runtime.semantic_cache else None,
+        "sessions": worker_sessions or (runtime.session_store.get_stats() if runtime.session_store else None),
+        "inference_worker": runtime.inference_client.get_stats() if runtime.inference_client else None,
+        "pending_requests": runtime.pending.get_stats(),
+        "cancellation": runtime.cancels.get_stats(),
+        "admission": runtime.admission.get_stats(),
+        "model_load_error": runtime.load_error,
+        "startup_timings": runtime.startup_timings,
+        "send_queues": {
+            "queued": sum(channel.queue.qsize() for channel in runtime.channels.values()),
+            "merged_chunks": sum(channel.merged_chunks for channel in runtime.channels.values()),
+        },
+    }
+
+
+def collect_server_metrics():
+    """Scrape-time metrics owned by the web server"""
+    families = metrics.cache_families({
+        'answer': runtime.answer_cache.get_stats() if runtime.answer_cache else None,
+        'semantic': runtime.semantic_cache.get_stats() if runtime.semantic_cache else None,
+    })
+    families.append(metrics.gauge_family('tutor_active_connections', 'Connected Socket.IO clients',
+                                         [({}, len(runtime.channels))]))
+    families.append(metrics.gauge_family('tutor_pending_requests', 'Requests waiting for the model to load',
+                                         [({}, runtime.pending.get_stats()['waiting'])]))
+    families.append(metrics.gauge_family('tutor_send_queue_events', 'Events queued for slow clients',
+                                         [({}, sum(c.queue.qsize() for c in runtime.channels.values()))]))
+    families += metrics.admission_families(runtime.admission.get_stats())
+    return families
+
+
+metrics.REGISTRY.add_collector('server', collect_server_metrics)
+metrics.watch_model(lambda: runtime.ai_tutor, lambda: runtime.batch_scheduler)
+
+
+@api.get('/metrics')
+async def metrics_endpoint():
+    if not settings.metrics_enabled:
+        return Response("Metrics are disabled\n", status_code=404, media_type='text/plain')
+    families = metrics.REGISTRY.collect()
+    # Generation stages are recorded in the worker process when there is one
+    if runtime.inference_client is not None and runtime.inference_client.ready:
+        try:
+            families += await wait_result(runtime.inference_client.request('metrics', {}), timeout=2.0)
+        except Exception as e:
+            logger.warning(f"⚠️ Inference worker metrics unavailable: {e}")
+    return Response(metrics.render(families), headers={'Content-Type': metrics.CONTENT_TYPE})
+
+
+# ----------------------------------------------------------------------
+# Socket.IO events
+# ----------------------------------------------------------------------
+
+@sio.event
+async def connect(sid, environ, auth=None):
+    runtime.channels[sid] = ClientChannel(
+        sid,
+        maxsize=settings.asgi_send_queue_size,
+        send_timeout=settings.asgi_send_timeout
+    )
+    logger.info(f"🔗 Client {sid} connected (Total: {len(runtime.channels)})")
+    await runtime.channels[sid].send('connection_established', dict(runtime.connection_status(), client_id=sid))
+
+
+@sio.event
+async def disconnect(sid, *args):
+    channel = runtime.channels.pop(sid, None)
+    if channel is not None:
+        channel.close()
+    runtime.pending.drop_client(sid)
+    runtime.admission.drop_client(sid)
+    cancelled = runtime.cancels.cancel_client(sid)
+    if cancelled:
+        runtime.cancel_generations(cancelled)
+        logger.info(f"🛑 Cancelled {len(cancelled)} generation(s) for {sid}")
+    if runtime.session_store is not None and runtime.session_store.drop(sid):
+        if runtime.inference_client is not None and runtime.inference_client.ready:
+            runtime.inference_client.request('drop_session', {'session_id': sid})
+    logger.info(f"🔌 Client {sid} disconnected (Remaining: {len(runtime.channels)})")
+
+
+@sio.event
+async def cancel_generation(sid, data=None):
+    """Stop streaming an answer: {'message_id': <id from text_response_start>}"""
+    message_id = (data or {}).get('message_id')
+    if message_id and runtime.cancels.cancel(message_id, sid):
+        runtime.cancel_generations([message_id])
+        logger.info(f"🛑 Cancelling generation {message_id} for {sid}")
+
+
+@sio.event
+async def ping(sid, data=None):
+    channel = runtime.channels.get(sid)
+    if channel is not None:
+        await channel.send('pong', {'timestamp': time.time(), 'client_id': sid})
+
+
+async def send_cached_answer(channel: ClientChannel, message_id: str, answer: str, cached=True):
+    """Replay a cached answer using the normal start/chunk/complete sequence"""
+    for event, payload in (
+        ('text_response_start', {}),
+        ('text_response_chunk', {'content': answer}),
+        ('text_response_complete', {'cached': cached}),
+    ):
+        await channel.send(event, {'type': event, 'message_id': message_id, 'timestamp': time.time(), **payload})
+
+
+@sio.event
+async def ask_ai_tutor(sid, data):
+    channel = runtime.channels.get(sid)
+    if channel is None:
+        return
+    if runtime.trace_recorder is not None:
+        runtime.trace_recorder.record_event(sid, 'ask_ai_tutor', data)
+    try:
+        await handle_text_tutor(sid, channel, data)
+    except ConnectionError:
+        pass
+    except Exception as e:
+        logger.exception(f"❌ Text handler error for {sid}: {e}")
+
+
+async def handle_text_tutor(sid: str, channel: ClientChannel, data: dict):
+    received = time.perf_counter()
+    message_id = str(uuid.uuid4())
+    user_message = data.get('message', 'NO_MESSAGE')
+    settings_data = data.get('settings', {})
+    max_tokens = settings_data.get('max_tokens', 256)
+    deterministic = bool(settings_data.get('deterministic', False))
+    logger.info(f"🎓 Request from {sid}: '{user_message[:50]}' (max tokens: {max_tokens})")
+
+    session = None
+    if runtime.session_store is not None:
+        session = runtime.session_store.get(
+            sid,
+            signature=(
+                settings_data.get('subject', 'General'),
+                settings_data.get('language', 'English'),
+                settings_data.get('level', 'middle_school')
+            ),
+            reset=bool(settings_data.get('new_conversation', False))
+        )
+        if session.busy:
+            session = None
+    use_answer_caches = session is None or not session.has_history
+
+    cache_key = None
+    if runtime.answer_cache is not None and use_answer_caches:
+        cache_key = make_cache_key(
+            user_message,
+            subject=settings_data.get('subject', 'General'),
+            level=settings_data.get('level', 'middle_school'),
+            language=settings_data.get('language', 'English'),
+            response_style=settings_data.get('response_style', 'regular'),
+            max_tokens=max(50, min(2048, int(max_tokens))),
+            deterministic=deterministic
+        )
+        cached_answer = runtime.answer_cache.get(cache_key)
+        if cached_answer is not None:
+            logger.info("💾 Answer cache hit - skipping generation")
+            await send_cached_answer(channel, message_id, cached_answer)
+            metrics.REQUESTS.labels('text', 'answer_cache').inc()
+            metrics.REQUEST_SECONDS.labels('text').observe(time.perf_counter() - received)
+            if session is not None and runtime.tutor_ready():
+                runtime.record_cached_answer(session, user_message, cached_answer, settings_data)
+            return
+
+    queue_start = time.perf_counter()
+    if not await wait_for_models(sid, channel, 'text-tutor'):
+        metrics.REQUESTS.labels('text', 'unavailable').inc()
+        return
+    metrics.QUEUE.observe(time.perf_counter() - queue_start)
+
+    question_vector = None
+    partition = None
+    if runtime.semantic_cache is not None and use_answer_caches:
+        try:
+            partition = make_partition(
+                settings_data.get('subject', 'General'),
+                settings_data.get('level', 'middle_school'),
+                settings_data.get('language', 'English'),
+                settings_data.get('response_style', 'regular'),
+                max_tokens=max(50, min(2048, int(max_tokens))),
+                deterministic=deterministic
+            )
+            question_vector = await runtime.embed_question(user_message)
+            match = runtime.semantic_cache.lookup(question_vector, partition, question=user_message)
+            if match is not None:
+                logger.info(f"🧠 Semantic cache hit (similarity {match[1]:.3f}) - skipping generation")
+                await send_cached_answer(channel, message_id, match[0], cached='semantic')
+                metrics.REQUESTS.labels('text', 'semantic_cache').inc()
+                metrics.REQUEST_SECONDS.labels('text').observe(time.perf_counter() - received)
+                if session is not None:
+                    runtime.record_cached_answer(session, user_message, match[0], settings_data)
+                return
+        except Exception as e:
+            logger.warning(f"⚠️ Semantic cache lookup failed: {e}")
+            question_vector = None
+
+    # Wait for a generation slot; queue_position events carry the message_id so it can be cancelled
+    cancel_event = runtime.cancels.register(message_id, sid)
+    ticket = None
+    try:
+        ticket = await admit_request(sid, channel, 'text', 'text-tutor', max(50, min(2048, int(max_tokens))),
+                                     message_id, cancel_event)
+        if ticket is not None:
+            await channel.send('text_response_start', {
+                'type': 'text_response_start',
+                'message_id': message_id,
+                'timestamp': time.time()
+            })
+    except BaseException:
+        if ticket is not None:
+            runtime.admission.release(ticket)
+        runtime.cancels.release(message_id)
+        raise
+    if ticket is None:
+        runtime.cancels.release(message_id)
+        if cancel_event.is_set():
+            await channel.send('text_response_complete', {
+                'type': 'text_response_complete',
+                'message_id': message_id,
+                'cancelled': True,
+                'timestamp': time.time()
+            })
+        return
+
+    start_time = time.time()
+    text_request = {
+        'question': user_message,
+        'subject': settings_data.get('subject', 'General'),
+        'language': settings_data.get('language', 'English'),
+        'level': settings_data.get('level', 'middle_school'),
+        'max_tokens': max_tokens,
+        'response_style': settings_data.get('response_style', 'regular'),
+        'deterministic': deterministic,
+        'stream_chunk_tokens': getattr(settings, 'stream_chunk_tokens', 1),
+        'client_id': sid,
+        'request_id': message_id,
+        'new_conversation': bool(settings_data.get('new_conversation', False)),
+        'profile': bool(settings_data.get('profile', False)),
+        'deadline_ms': settings_data.get('deadline_ms', settings.generation_deadline_ms)
+    }
+
+    generation_failed = False
+    truncated = fitted = False
+    response = ""
+    emit_time = 0.0
+    first_chunk = True
+    if session is not None:
+        session.busy = True
+    try:
+        handle = runtime.start_text_generation(message_id, text_request, session, cancel_event)
+        async for event in iter_events(handle):
+            if event[0] == 'chunk':
+                if cancel_event.is_set():
+                    continue
+                emit_start = time.perf_counter()
+                if first_chunk:
+                    metrics.FIRST_CHUNK_SECONDS.observe(emit_start - received)
+                    first_chunk = False
+                await channel.send('text_response_chunk', {
+                    'type': 'text_response_chunk',
+                    'message_id': message_id,
+                    'content': event[1],
+                    'timestamp': time.time()
+                })
+                emit_time += time.perf_counter() - emit_start
+            elif event[0] == 'complete':
+                response = event[1]
+                truncated = bool(event[2].get('truncated'))
+                fitted = bool(event[2].get('fitted'))
+                if (runtime.inference_client is not None and session is not None
+                        and event[2].get('session_turns') and not event[2].get('cancelled')):
+                    session.mark_turn()
+            elif event[0] == 'error':
+                raise RuntimeError(event[1])
+        logger.info(f"✅ AI response generated in {time.time() - start_time:.2f}s ({len(response)} characters)"
+                    f"{' [deadline]' if truncated else ''}")
+    except ConnectionError:
+        raise
+    except Exception as e:
+        logger.error(f"❌ AI generation failed: {e}")
+        generation_failed = True
+        response = f"Error generating response: {str(e)}"
+        await channel.send('text_response_chunk', {
+            'type': 'text_response_chunk',
+            'message_id': message_id,
+            'content': response,
+            'timestamp': time.time()
+        })
+    finally:
+        runtime.admission.release(ticket)
+        runtime.cancels.release(message_id)
+        if session is not None:
+            session.busy = False
+        metrics.EMIT.observe(emit_time)
+        outcome = 'error' if generation_failed else 'cancelled' if cancel_event.is_set() else 'ok'
+        metrics.REQUESTS.labels('text', outcome).inc()
+        metrics.REQUEST_SECONDS.labels('text').observe(time.perf_counter() - received)
+
+    if cancel_event.is_set():
+        # A partial answer is not cached and not part of the conversation
+        await channel.send('text_response_complete', {
+            'type': 'text_response_complete',
+            'message_id': message_id,
+            'cancelled': True,
+            'timestamp': time.time()
+        })
+        return
+
+    if session is not None and not generation_failed:
+        runtime.session_store.commit(session)
+    # Answers cut short by a deadline (or given a smaller budget to fit it) depend on
+    # this machine's speed, so they aren't cached under the client's max_tokens
+    cacheable = not generation_failed and not truncated and not fitted
+    if cache_key is not None and cacheable and response:
+        runtime.answer_cache.put(cache_key, response)
+    if question_vector is not None and cacheable and response:
+        runtime.semantic_cache.insert(question_vector, partition, response, question=user_message)
+
+    await channel.send('text_response_complete', {
+        'type': 'text_response_complete',
+        'message_id': message_id,
+        'truncated': truncated,
+        'timestamp': time.time()
+    })
+
+
+@sio.event
+async def ask_image_question(sid, data):
+    channel = runtime.channels.get(sid)
+    if channel is None:
+        return
+    if runtime.trace_recorder is not None:
+        runtime.trace_recorder.record_event(sid, 'ask_image_question', data)
+    received = time.perf_counter()
+    try:
+        question = data['question']
+        if data.get('image') is not None:
+            image_input = memoryview(data['image'])
+        else:
+            image_input = data['image_url']
+        logger.info(f"🖼️ Processing image analysis for {sid}: {question[:50]}...")
+
+        if not await wait_for_models(sid, channel, 'image-analyzer'):
+            return
+        metrics.QUEUE.observe(time.perf_counter() - received)
+
+        ticket = await admit_request(sid, channel, 'image', 'image-analyzer', IMAGE_COST)
+        if ticket is None:
+            return
+        try:
+            await channel.send('image_analysis_start', {
+                'type': 'image_analysis_start',
+                'timestamp': time.time(),
+                'client_id': sid
+            })
+            result = await runtime.ask_image_question(image_input, question, bool(data.get('settings', {}).get('profile', False)))
+            await channel.send('image_analysis_result', {
+                'type': 'image_analysis_result',
+                'result': result,
+                'timestamp': time.time(),
+                'client_id': sid
+            })
+            metrics.REQUESTS.labels('image', 'ok').inc()
+            metrics.REQUEST_SECONDS.labels('image').observe(time.perf_counter() - received)
+        except ConnectionError:
+            raise
+        except Exception as e:
+            logger.error(f"❌ Error in image analysis for {sid}: {e}")
+            metrics.REQUESTS.labels('image', 'error').inc()
+            await channel.send('error', {
+                'type': 'error',
+                'message': f"Error analyzing image: {str(e)}",
+                'context': 'image-analyzer',
+                'timestamp': time.time(),
+                'client_id': sid
+            })
+        finally:
+            runtime.admission.release(ticket)
+    except ConnectionError:
+        pass
+    except Exception as e:
+        logger.exception(f"❌ Image analysis handler error for {sid}: {e}")
+
+
+@sio.event
+async def ask_image_batch(sid, data):
+    channel = runtime.channels.get(sid)
+    if channel is None:
+        return
+    if runtime.trace_recorder is not None:
+        runtime.trace_recorder.record_event(sid, 'ask_image_batch', data)
+    received = time.perf_counter()
+    try:
+        items = data.get('images') or []
+        if not items or len(items) > settings.image_batch_max_images:
+            await channel.send('error', {
+                'type': 'error',
+                'message': f"Send between 1 and {settings.image_batch_max_images} images per batch.",
+                'context': 'image-analyzer',
+                'timestamp': time.time(),
+                'client_id': sid
+            })
+            return
+        image_inputs = [memoryview(item['image']) if item.get('image') is not None else item['image_url']
+                        for item in items]
+        questions = [item['question'] for item in items]
+        logger.info(f"🖼️ Processing batch of {len(items)} images for {sid}")
+
+        if not await wait_for_models(sid, channel, 'image-analyzer'):
+            return
+        metrics.QUEUE.observe(time.perf_counter() - received)
+
+        ticket = await admit_request(sid, channel, 'image', 'image-analyzer', IMAGE_COST * len(items))
+        if ticket is None:
+            return
+        batch_id = str(uuid.uuid4())
+        try:
+            await channel.send('image_batch_start', {
+                'type': 'image_batch_start',
+                'batch_id': batch_id,
+                'count': len(items),
+                'timestamp': time.time(),
+                'client_id': sid
+            })
+            handle = runtime.start_image_batch(image_inputs, questions, int(data.get('max_tokens', 300)),
+                                               bool(data.get('settings', {}).get('profile', False)))
+            results = []
+            async for event in iter_events(handle):
+                if event[0] == 'chunk':
+                    await channel.send('image_batch_result', {
+                        'type': 'image_batch_result',
+                        'batch_id': batch_id,
+                        'index': event[1][0],
+                        'result': event[1][1],
+                        'timestamp': time.time()
+                    })
+                elif event[0] == 'complete':
+                    results = event[1]
+                elif event[0] == 'error':
+                    raise RuntimeError(event[1])
+            await channel.send('image_batch_complete', {
+                'type': 'image_batch_complete',
+                'batch_id': batch_id,
+                'results': results,
+                'timestamp': time.time(),
+                'client_id': sid
+            })
+            metrics.REQUESTS.labels('image', 'ok').inc()
+            metrics.REQUEST_SECONDS.labels('image').observe(time.perf_counter() - received)
+        except ConnectionError:
+            raise
+        except Exception as e:
+            logger.error(f"❌ Error in image batch for {sid}: {e}")
+            metrics.REQUESTS.labels('image', 'error').inc()
+            await channel.send('error', {
+                'type': 'error',
+                'message': f"Error analyzing images: {str(e)}",
+                'context': 'image-analyzer',
+                'timestamp': time.time(),
+                'client_id': sid
+            })
+        finally:
+            runtime.admission.release(ticket)
+    except ConnectionError:
+        pass
+    except Exception as e:
+        logger.exception(f"❌ Image batch handler error for {sid}: {e}")
+
+
+if __name__ == '__main__':
+    import uvicorn
+
+    print("🚀 Starting AI Tutor Backend (ASGI)")
+    print(f"📡 WebSocket endpoint: ws://localhost:{settings.asgi_port}/socket.io/")
+    print(f"🔍 Health check: http://localhost:{settings.asgi_port}/health")
+    uvicorn.run(app, host='0.0.0.0', port=settings.asgi_port, log_level="info")
@@ -0,0 +1,135 @@
+"""
+Connection scaling benchmark - compare the eventlet (app.py) and ASGI (asgi_app.py) servers
+
+    python bench_connections.py --url http://localhost:5000 --clients 50 100 200
+    python bench_connections.py --url http://localhost:5001 --clients 50 100 200 --json
+
+Opens N Socket.IO clients at once, then measures connect time and ping/pong
+round trips while every client is connected. The models do not need to be
+loaded, so this isolates the server's connection handling.
+"""
+import argparse
+import json
+import threading
+import time
+from typing import List
+
+import socketio
+
+
+def percentile(values: List[float], pct: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, int(round(pct / 100 * (len(ordered) - 1))))
+    return ordered[index]
+
+
+def summarize(values: List[float]) -> dict:
+    return {
+        'p50_ms': round(percentile(values, 50) * 1000, 2),
+        'p95_ms': round(percentile(values, 95) * 1000, 2),
+        'p99_ms': round(percentile(values, 99) * 1000, 2),
+        'max_ms': round(max(values) * 1000, 2) if values else 0.0,
+    }
+
+
+class PingClient:
+    def __init__(self, url: str, transports: List[str]):
+        self.url = url
+        self.transports = transports
+        self.sio = socketio.Client(reconnection=False)
+        self.connect_time = None
+        self.round_trips: List[float] = []
+        self.error = None
+        self._pong = threading.Event()
+        self.sio.on('pong', lambda data=None: self._pong.set())
+
+    def connect(self):
+        start = time.perf_counter()
+        try:
+            self.sio.connect(self.url, transports=self.transports, wait_timeout=30)
+            self.connect_time = time.perf_counter() - start
+        except Exception as e:
+            self.error = str(e)
+
+    def ping(self, count: int, timeout: float = 10.0):
+        for _ in range(count):
+            if self.error:
+                return
+            self._pong.clear()
+            start = time.perf_counter()
+            self.sio.emit('ping', {'timestamp': time.time()})
+            if not self._pong.wait(timeout):
+                self.error = 'pong timeout'
+                return
+            self.round_trips.append(time.perf_counter() - start)
+
+    def close(self):
+        try:
+            self.sio.disconnect()
+        except Exception:
+            pass
+
+
+def run_level(url: str, clients: int, pings: int, transports: List[str]) -> dict:
+    pool = [PingClient(url, transports) for _ in range(clients)]
+
+    def run_all(method, *args, timeout=None):
+        threads = [threading.Thread(target=getattr(c, method), args=args, daemon=True) for c in pool]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join(timeout)
+
+    start = time.perf_counter()
+    run_all('connect')
+    connect_wall = time.perf_counter() - start
+
+    start = time.perf_counter()
+    run_all('ping', pings)
+    ping_wall = time.perf_counter() - start
+
+    # A polling client's disconnect can block until its pending long-poll returns; don't wait for it
+    run_all('close', timeout=1.0)
+
+    connect_times = [c.connect_time for c in pool if c.connect_time is not None]
+    round_trips = [rtt for c in pool for rtt in c.round_trips]
+    return {
+        'clients': clients,
+        'connected': len(connect_times),
+        'errors': sum(1 for c in pool if c.error),
+        'connect_wall_s': round(connect_wall, 3),
+        'connect': summarize(connect_times),
+        'ping': summarize(round_trips),
+        'pings_per_s': round(len(round_trips) / ping_wall, 1) if ping_wall > 0 else 0.0,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Socket.IO connection scaling benchmark")
+    parser.add_argument('--url', default='http://localhost:5000')
+    parser.add_argument('--clients', type=int, nargs='+', default=[10, 50, 100])
+    parser.add_argument('--pings', type=int, default=20, help="Round trips per client")
+    parser.add_argument('--transport', choices=['polling', 'websocket'], default=None,
+                        help="Force one transport (websocket needs the websocket-client package)")
+    parser.add_argument('--json', action='store_true', help="Print results as JSON")
+    args = parser.parse_args()
+
+    transports = [args.transport] if args.transport else ['polling', 'websocket']
+    results = []
+    for clients in args.clients:
+        result = run_level(args.url, clients, args.pings, transports)
+        results.append(result)
+        if not args.json:
+            print(f"👥 {clients:4d} clients | connected {result['connected']} "
+                  f"(errors {result['errors']}) | connect p50 {result['connect']['p50_ms']}ms "
+                  f"p95 {result['connect']['p95_ms']}ms | ping p50 {result['ping']['p50_ms']}ms "
+                  f"p99 {result['ping']['p99_ms']}ms | {result['pings_per_s']} pings/s")
+
+    if args.json:
+        print(json.dumps({'url': args.url, 'transports': transports, 'results': results}, indent=2))
+
+
+if __name__ == '__main__':
+    main()
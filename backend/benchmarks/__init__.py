@@ -0,0 +1,12 @@
+"""
+Offline microbenchmarks for the AITutor generation pipeline
+
+    python -m benchmarks run --model tiny --output before.json
+    python -m benchmarks run --model cached --dtypes float32 int8 --threads 2 4 --output after.json
+    python -m benchmarks compare before.json after.json
+    python -m benchmarks ingest --workers 1 2 4
+
+`tiny` builds a random-weight Gemma3n with a byte-level tokenizer locally
+(no network or cached checkpoint); `cached` loads the real model from the
+Hugging Face cache. Run from the backend directory.
+"""
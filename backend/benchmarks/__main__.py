@@ -0,0 +1,186 @@
+"""
+python -m benchmarks run|compare (see benchmarks/__init__.py)
+"""
+import argparse
+import json
+import logging
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+import torch
+
+from benchmarks.cases import DTYPES, run_suite
+from benchmarks.measure import environment
+
+# Metric -> True when higher is better
+METRICS = {
+    'load_s': False, 'prefill_s': False, 'prefill_tok_s': True, 'ttft_s': False, 'decode_tok_s': True,
+    'total_s': False, 'preprocess_s': False, 'vision_tower_s': False, 'question_s': False,
+    'question_cached_s': False, 'peak_rss_mb': False, 'images_s': True, 'mb_s': True, 'latency_s': False,
+}
+KEY_FIELDS = ('case', 'dtype', 'threads', 'prompt_length', 'max_tokens', 'loader')
+
+
+def _log(message: str):
+    print(message, file=sys.stderr, flush=True)
+
+
+def _run_each_dtype(args, threads) -> list:
+    """One child process per dtype, so load time and peak RSS are not skewed by the previous model"""
+    results = []
+    with tempfile.TemporaryDirectory() as workdir:
+        for dtype in args.dtypes:
+            output = os.path.join(workdir, f"{dtype}.json")
+            command = [
+                sys.executable, '-m', 'benchmarks', 'run',
+                '--model', args.model, '--model-id', args.model_id, '--dtypes', dtype,
+                '--threads', *map(str, threads),
+                '--prompt-lengths', *map(str, args.prompt_lengths),
+                '--max-tokens', *map(str, args.max_tokens),
+                '--repeat', str(args.repeat), '--output', output,
+            ] + (['--no-image'] if args.no_image else [])
+            subprocess.run(command, check=True, cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+            with open(output) as f:
+                results += json.load(f)['results']
+    return results
+
+
+def run(args):
+    threads = args.threads or [torch.get_num_threads()]
+    started = time.time()
+    if len(args.dtypes) > 1:
+        results = _run_each_dtype(args, threads)
+    else:
+        results = run_suite(
+            model=args.model,
+            dtypes=args.dtypes,
+            threads=threads,
+            prompt_lengths=args.prompt_lengths,
+            max_tokens=args.max_tokens,
+            repeat=args.repeat,
+            image=not args.no_image,
+            model_id=args.model_id,
+            log=_log
+        )
+    report = {
+        'environment': environment(),
+        'config': {
+            'model': args.model if args.model == 'tiny' else args.model_id,
+            'dtypes': args.dtypes,
+            'threads': threads,
+            'prompt_lengths': args.prompt_lengths,
+            'max_tokens': args.max_tokens,
+            'repeat': args.repeat,
+            'image': not args.no_image,
+        },
+        'started': started,
+        'duration_s': round(time.time() - started, 1),
+        'results': results,
+    }
+    _write(report, args.output)
+
+
+def _write(report: dict, output):
+    text = json.dumps(report, indent=2)
+    if output:
+        with open(output, 'w') as f:
+            f.write(text + '\n')
+        _log(f"💾 Results written to {output}")
+    else:
+        print(text)
+
+
+def ingest(args):
+    """Image decode + preprocessing throughput on a synthetic corpus (no model needed)"""
+    from benchmarks.ingest import run_ingest
+    from benchmarks.tiny import TinyProcessor
+
+    started = time.time()
+    results = run_ingest(TinyProcessor().image_processor, args.workers, args.images, log=_log)
+    _write({
+        'environment': environment(),
+        'config': {'workers': args.workers, 'images': args.images},
+        'started': started,
+        'duration_s': round(time.time() - started, 1),
+        'results': results,
+    }, args.output)
+
+
+def _median(value):
+    return value.get('median') if isinstance(value, dict) else value
+
+
+def compare(args):
+    """Median of every metric in `new` relative to `base`, matched by case parameters"""
+    with open(args.base) as f:
+        base = json.load(f)
+    with open(args.new) as f:
+        new = json.load(f)
+
+    def index(report):
+        return {tuple(r.get(k) for k in KEY_FIELDS): r for r in report['results']}
+
+    base_results = index(base)
+    print(f"base {base['environment'].get('git_revision')} -> new {new['environment'].get('git_revision')}")
+    regressions = 0
+    for key, result in index(new).items():
+        previous = base_results.get(key)
+        if previous is None:
+            continue
+        label = " ".join(f"{k}={v}" for k, v in zip(KEY_FIELDS, key) if v is not None)
+        for metric, higher_is_better in METRICS.items():
+            old_value, new_value = _median(previous.get(metric)), _median(result.get(metric))
+            if not old_value or new_value is None:
+                continue
+            change = (new_value - old_value) / old_value
+            worse = change < -args.threshold if higher_is_better else change > args.threshold
+            better = change > args.threshold if higher_is_better else change < -args.threshold
+            regressions += worse
+            marker = "🔴" if worse else "🟢" if better else "  "
+            print(f"{marker} {label:55s} {metric:18s} {old_value:12.4f} -> {new_value:12.4f} ({change:+.1%})")
+    if args.fail_on_regression and regressions:
+        sys.exit(1)
+
+
+def main():
+    parser = argparse.ArgumentParser(prog="python -m benchmarks", description="AITutor generation pipeline benchmarks")
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    run_parser = commands.add_parser('run', help="Run the benchmark suite")
+    run_parser.add_argument('--model', choices=['tiny', 'cached'], default='tiny',
+                            help="tiny: random-weight Gemma3n built locally; cached: the real model from the HF cache")
+    run_parser.add_argument('--model-id', default="google/gemma-3n-e2b-it")
+    run_parser.add_argument('--dtypes', nargs='+', choices=DTYPES, default=['float32'])
+    run_parser.add_argument('--threads', type=int, nargs='+', help="torch thread counts (default: current)")
+    run_parser.add_argument('--prompt-lengths', type=int, nargs='+', default=[128, 512])
+    run_parser.add_argument('--max-tokens', type=int, nargs='+', default=[32, 128])
+    run_parser.add_argument('--repeat', type=int, default=3)
+    run_parser.add_argument('--no-image', action='store_true', help="Skip the image-question benchmark")
+    run_parser.add_argument('--output', help="Write JSON here instead of stdout")
+
+    ingest_parser = commands.add_parser('ingest', help="Benchmark image decoding and preprocessing")
+    ingest_parser.add_argument('--workers', type=int, nargs='+', default=[1, 2, 4])
+    ingest_parser.add_argument('--images', type=int, default=16, help="Size of the synthetic corpus")
+    ingest_parser.add_argument('--output', help="Write JSON here instead of stdout")
+
+    compare_parser = commands.add_parser('compare', help="Compare two result files")
+    compare_parser.add_argument('base')
+    compare_parser.add_argument('new')
+    compare_parser.add_argument('--threshold', type=float, default=0.05, help="Relative change that counts (default 5%%)")
+    compare_parser.add_argument('--fail-on-regression', action='store_true', help="Exit 1 if anything got worse")
+
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.WARNING)
+    if args.command == 'run':
+        run(args)
+    elif args.command == 'ingest':
+        ingest(args)
+    else:
+        compare(args)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,242 @@
+"""
+Benchmark cases: prefill, streamed generation and image questions
+"""
+import gc
+import io
+import logging
+import time
+from types import SimpleNamespace
+from typing import List
+
+import torch
+
+from benchmarks.measure import current_rss_mb, peak_rss_mb, reset_peak_rss, summarize
+
+logger = logging.getLogger(__name__)
+
+DTYPES = ("float32", "bfloat16", "float16", "int8", "int4")
+
+# Filler for prompts of a given length: the kind of passage students paste in
+PASSAGE = (
+    "Photosynthesis is the process by which green plants use sunlight, water and carbon dioxide "
+    "to make glucose and oxygen. It takes place mainly in the chloroplasts of leaf cells, where the "
+    "pigment chlorophyll absorbs light energy. The light-dependent reactions split water molecules "
+    "and release oxygen, while the Calvin cycle uses the stored energy to fix carbon dioxide into sugar. "
+)
+
+
+def load_tutor(model: str, dtype: str, model_id: str = "google/gemma-3n-e2b-it"):
+    """An AITutor around the tiny or cached model in `dtype` (int8/int4 go through quantization.py)"""
+    from ai_tutor import AITutor
+    from quantization import pack_model, quantize_model
+
+    if dtype not in DTYPES:
+        raise ValueError(f"Unknown dtype {dtype!r} (expected one of {', '.join(DTYPES)})")
+    quantized = dtype in ("int8", "int4")
+    torch_dtype = torch.bfloat16 if quantized else getattr(torch, dtype)
+
+    if model == "tiny":
+        from benchmarks.tiny import TinyProcessor, build_tiny_model
+        network = build_tiny_model().to(torch_dtype)
+        processor = TinyProcessor()
+    else:
+        from transformers import AutoProcessor, Gemma3nForConditionalGeneration
+        network = Gemma3nForConditionalGeneration.from_pretrained(
+            model_id,
+            torch_dtype=torch_dtype,
+            device_map="auto" if torch.cuda.is_available() else None,
+            low_cpu_mem_usage=True,
+            local_files_only=True
+        ).eval()
+        processor = AutoProcessor.from_pretrained(model_id, local_files_only=True)
+
+    if quantized:
+        quantize_model(network, dtype)
+        pack_model(network)
+
+    # Caches and speculation off, so every run measures the same work
+    settings = SimpleNamespace(prefix_cache_max_mb=0, image_cache_max_mb=512, prompt_lookup_enabled=False)
+    tutor = AITutor(model_id, "", settings=settings)
+    tutor.model = network
+    tutor.processor = processor
+    return tutor
+
+
+def unload(tutor):
+    tutor.model = None
+    gc.collect()
+
+
+def prompt_ids(tutor, length: int) -> List[int]:
+    """Token ids of a tutor prompt padded with passage text to about `length` tokens"""
+    tokenizer = tutor.processor.tokenizer
+    base = len(tutor.encode_messages(tutor.build_messages("", "Science", "English", "middle_school")))
+    filler = tokenizer.encode(PASSAGE, add_special_tokens=False)
+    needed = max(1, length - base)
+    filler = (filler * (needed // len(filler) + 1))[:needed]
+    question = tokenizer.decode(filler, skip_special_tokens=True)
+    return tutor.encode_messages(tutor.build_messages(question, "Science", "English", "middle_school"))
+
+
+def _inputs(tutor, ids: List[int]) -> dict:
+    device = tutor.model.device
+    return {
+        "input_ids": torch.tensor([ids], device=device),
+        "attention_mask": torch.ones((1, len(ids)), dtype=torch.long, device=device),
+    }
+
+
+def _sync(tutor):
+    if str(tutor.model.device).startswith("cuda"):
+        torch.cuda.synchronize()
+
+
+def bench_prefill(tutor, ids: List[int], repeat: int) -> dict:
+    """One forward pass over the whole prompt into an empty KV cache"""
+    from transformers import DynamicCache
+
+    timings = []
+    reset_peak_rss()
+    for _ in range(repeat):
+        start = time.perf_counter()
+        with torch.inference_mode():
+            tutor.model(**_inputs(tutor, ids), past_key_values=DynamicCache(), use_cache=True, logits_to_keep=1)
+        _sync(tutor)
+        timings.append(time.perf_counter() - start)
+    return {
+        'prefill_s': summarize(timings),
+        'prefill_tok_s': round(len(ids) / summarize(timings)['median'], 2),
+        'peak_rss_mb': peak_rss_mb(),
+    }
+
+
+def bench_generation(tutor, ids: List[int], max_tokens: int, repeat: int) -> dict:
+    """Greedy streamed generation of exactly `max_tokens` tokens: TTFT and decode speed"""
+    from streaming import CallbackStreamer
+
+    ttfts, decode_speeds, totals = [], [], []
+    reset_peak_rss()
+    for _ in range(repeat):
+        streamer = CallbackStreamer(tutor.processor.tokenizer, lambda text: None)
+        start = time.time()
+        with torch.inference_mode():
+            tutor.model.generate(
+                **_inputs(tutor, ids),
+                max_new_tokens=max_tokens,
+                min_new_tokens=max_tokens,
+                do_sample=False,
+                temperature=None,
+                top_p=None,
+                top_k=None,
+                streamer=streamer,
+                pad_token_id=tutor.processor.tokenizer.eos_token_id
+            )
+        _sync(tutor)
+        end = time.time()
+        first = streamer.first_token_time or end
+        ttfts.append(first - start)
+        totals.append(end - start)
+        if streamer.tokens_generated > 1 and end > first:
+            decode_speeds.append((streamer.tokens_generated - 1) / (end - first))
+    return {
+        'ttft_s': summarize(ttfts),
+        'decode_tok_s': summarize(decode_speeds, digits=2),
+        'total_s': summarize(totals),
+        'peak_rss_mb': peak_rss_mb(),
+    }
+
+
+def synthetic_image(seed: int, size=(1024, 768)) -> bytes:
+    """A JPEG with random shapes (different for every seed, so it never hits the image cache)"""
+    from PIL import Image, ImageDraw
+
+    generator = torch.Generator().manual_seed(seed)
+    image = Image.new('RGB', size, tuple(torch.randint(0, 256, (3,), generator=generator).tolist()))
+    draw = ImageDraw.Draw(image)
+    for _ in range(40):
+        x0, y0 = torch.randint(0, size[0], (1,), generator=generator).item(), torch.randint(0, size[1], (1,), generator=generator).item()
+        x1, y1 = x0 + torch.randint(20, 300, (1,), generator=generator).item(), y0 + torch.randint(20, 300, (1,), generator=generator).item()
+        draw.rectangle([x0, y0, x1, y1], fill=tuple(torch.randint(0, 256, (3,), generator=generator).tolist()))
+    buffer = io.BytesIO()
+    image.save(buffer, format='JPEG', quality=90)
+    return buffer.getvalue()
+
+
+def bench_image(tutor, repeat: int, question: str = "What shapes and colours are in this picture?") -> dict:
+    """Preprocessing, the vision tower alone, and full image questions with and without the image cache"""
+    preprocess, vision, cold, warm = [], [], [], []
+    reset_peak_rss()
+    for index in range(repeat):
+        data = synthetic_image(index)
+
+        start = time.perf_counter()
+        pixel_values = tutor.image_ingest.load(data)
+        preprocess.append(time.perf_counter() - start)
+
+        pixel_values = pixel_values.to(tutor.model.device, dtype=tutor.model.dtype)
+        start = time.perf_counter()
+        with torch.inference_mode():
+            tutor.model.model.get_image_features(pixel_values)
+        _sync(tutor)
+        vision.append(time.perf_counter() - start)
+
+        start = time.perf_counter()
+        tutor.ask_image_question(data, question)
+        cold.append(time.perf_counter() - start)
+
+        # Same image again: decoded pixels and vision features come from the cache
+        start = time.perf_counter()
+        tutor.ask_image_question(data, question)
+        warm.append(time.perf_counter() - start)
+    return {
+        'preprocess_s': summarize(preprocess),
+        'vision_tower_s': summarize(vision),
+        'question_s': summarize(cold),
+        'question_cached_s': summarize(warm),
+        'peak_rss_mb': peak_rss_mb(),
+    }
+
+
+def run_suite(model: str, dtypes: List[str], threads: List[int], prompt_lengths: List[int],
+              max_tokens: List[int], repeat: int, image: bool, model_id: str, log=print) -> List[dict]:
+    results = []
+    for dtype in dtypes:
+        reset_peak_rss()
+        start = time.perf_counter()
+        tutor = load_tutor(model, dtype, model_id)
+        load = {'case': 'load', 'dtype': dtype, 'load_s': round(time.perf_counter() - start, 3),
+                'rss_mb': current_rss_mb(), 'peak_rss_mb': peak_rss_mb()}
+        results.append(load)
+        log(f"📦 {dtype}: loaded in {load['load_s']:.1f}s (RSS {load['rss_mb']}MB)")
+
+        for thread_count in threads:
+            torch.set_num_threads(thread_count)
+            common = {'dtype': dtype, 'threads': thread_count}
+
+            # Warm up kernels and allocator before measuring
+            bench_generation(tutor, prompt_ids(tutor, min(prompt_lengths)), 4, 1)
+
+            for length in prompt_lengths:
+                ids = prompt_ids(tutor, length)
+                result = {'case': 'prefill', **common, 'prompt_length': length, 'prompt_tokens': len(ids),
+                          **bench_prefill(tutor, ids, repeat)}
+                results.append(result)
+                log(f"⏱️ {dtype} x{thread_count} prefill {len(ids):5d} tok: "
+                    f"{result['prefill_s']['median'] * 1000:.1f}ms ({result['prefill_tok_s']} tok/s)")
+
+                for tokens in max_tokens:
+                    result = {'case': 'generate', **common, 'prompt_length': length, 'prompt_tokens': len(ids),
+                              'max_tokens': tokens, **bench_generation(tutor, ids, tokens, repeat)}
+                    results.append(result)
+                    log(f"⚡ {dtype} x{thread_count} generate {len(ids):5d}+{tokens:4d}: TTFT "
+                        f"{result['ttft_s']['median'] * 1000:.1f}ms, decode "
+                        f"{result['decode_tok_s'].get('median', 0)} tok/s, peak RSS {result['peak_rss_mb']}MB")
+
+            if image:
+                result = {'case': 'image', **common, **bench_image(tutor, repeat)}
+                results.append(result)
+                log(f"🖼️ {dtype} x{thread_count} image: vision {result['vision_tower_s']['median']:.3f}s, "
+                    f"question {result['question_s']['median']:.2f}s (cached {result['question_cached_s']['median']:.2f}s)")
+
+        unload(tutor)
+    return results
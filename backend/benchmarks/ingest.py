@@ -0,0 +1,82 @@
+"""
+Image ingestion throughput: full decode + processor versus the ingest pool
+"""
+import io
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, List, Tuple
+
+from PIL import Image
+
+from benchmarks.cases import synthetic_image
+from benchmarks.measure import summarize
+
+# (name, size, format) per image kind in the corpus: phone photos, screenshots and small crops
+CORPUS = (
+    ('photo_12mp', (4032, 3024), 'JPEG'),
+    ('photo_1080p', (1920, 1080), 'JPEG'),
+    ('screenshot_1080p', (1920, 1080), 'PNG'),
+    ('crop_small', (640, 480), 'JPEG'),
+)
+
+
+def synthetic_corpus(count: int) -> List[Tuple[str, bytes]]:
+    """`count` distinct encoded images cycling through the CORPUS kinds"""
+    corpus = []
+    for index in range(count):
+        name, size, image_format = CORPUS[index % len(CORPUS)]
+        data = synthetic_image(index, size)
+        if image_format != 'JPEG':
+            buffer = io.BytesIO()
+            Image.open(io.BytesIO(data)).save(buffer, format=image_format)
+            data = buffer.getvalue()
+        corpus.append((name, data))
+    return corpus
+
+
+def _throughput(corpus: List[Tuple[str, bytes]], load: Callable[[bytes], object], workers: int) -> dict:
+    """Images/s and MB/s loading the whole corpus with `workers` threads, plus per-image latency"""
+    latencies = []
+
+    def timed(data):
+        start = time.perf_counter()
+        load(data)
+        latencies.append(time.perf_counter() - start)
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        list(pool.map(timed, [data for _, data in corpus]))
+    elapsed = time.perf_counter() - start
+    latencies.sort()
+    return {
+        'images_s': round(len(corpus) / elapsed, 2),
+        'mb_s': round(sum(len(data) for _, data in corpus) / 1024**2 / elapsed, 2),
+        'latency_s': summarize(latencies),
+        'latency_p95_s': round(latencies[min(len(latencies) - 1, int(len(latencies) * 0.95))], 4),
+    }
+
+
+def run_ingest(image_processor, workers: List[int], count: int = 16, log: Callable[[str], None] = print) -> list:
+    """The baseline (full decode, processor) and the ingest pool with and without draft decoding"""
+    from image_ingest import ImageIngestor
+
+    corpus = synthetic_corpus(count)
+    log(f"🖼️ Corpus: {count} images, {sum(len(data) for _, data in corpus) / 1024**2:.1f}MB")
+
+    def baseline(data):
+        image = Image.open(io.BytesIO(data)).convert('RGB')
+        return image_processor(image, return_tensors="pt")["pixel_values"]
+
+    results = []
+    for worker_count in workers:
+        results.append({'case': 'ingest', 'loader': 'baseline', 'threads': worker_count,
+                        **_throughput(corpus, baseline, worker_count)})
+        log(f"  baseline   workers={worker_count}: {results[-1]['images_s']} images/s")
+        for draft in (False, True):
+            ingestor = ImageIngestor(image_processor, workers=worker_count, draft=draft)
+            result = _throughput(corpus, ingestor.load, worker_count)
+            results.append({'case': 'ingest', 'loader': 'draft' if draft else 'resize', 'threads': worker_count,
+                            **result, 'stats': ingestor.get_stats()})
+            log(f"  {results[-1]['loader']:10s} workers={worker_count}: {result['images_s']} images/s")
+            ingestor.shutdown()
+    return results
@@ -0,0 +1,81 @@
+"""
+Timing, memory and environment helpers
+"""
+import os
+import platform
+import resource
+import statistics
+import subprocess
+import sys
+from typing import Dict, List, Optional
+
+
+def reset_peak_rss() -> bool:
+    """Reset the kernel's peak-RSS counter (Linux) so the next reading covers one case only"""
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+        return True
+    except OSError:
+        return False
+
+
+def _status_mb(field: str) -> Optional[float]:
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith(field + ':'):
+                    return round(int(line.split()[1]) / 1024, 1)
+    except OSError:
+        pass
+    return None
+
+
+def current_rss_mb() -> Optional[float]:
+    return _status_mb('VmRSS')
+
+
+def peak_rss_mb() -> float:
+    """Peak RSS since the last reset (or since the process started where resets are unsupported)"""
+    peak = _status_mb('VmHWM')
+    if peak is not None:
+        return peak
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return round(maxrss / 1024**2 if sys.platform == 'darwin' else maxrss / 1024, 1)
+
+
+def summarize(values: List[float], digits: int = 4) -> Dict[str, float]:
+    """Median / min / max of repeated measurements"""
+    if not values:
+        return {}
+    return {
+        'median': round(statistics.median(values), digits),
+        'min': round(min(values), digits),
+        'max': round(max(values), digits),
+    }
+
+
+def git_revision() -> Optional[str]:
+    try:
+        return subprocess.run(
+            ['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True, check=True,
+            cwd=os.path.dirname(os.path.abspath(__file__))
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def environment() -> dict:
+    import torch
+    import transformers
+    return {
+        'git_revision': git_revision(),
+        'python': platform.python_version(),
+        'torch': torch.__version__,
+        'transformers': transformers.__version__,
+        'platform': platform.platform(),
+        'processor': platform.processor() or platform.machine(),
+        'cpu_count': os.cpu_count(),
+        'cuda': torch.cuda.get_device_name() if torch.cuda.is_available() else None,
+        'peak_rss_resettable': reset_peak_rss(),
+    }
@@ -0,0 +1,125 @@
+"""
+A random-weight Gemma3n and a byte-level processor that need no downloads
+"""
+import re
+from typing import List
+
+import torch
+from transformers import BatchFeature, Gemma3nConfig, Gemma3nForConditionalGeneration, SiglipImageProcessor
+
+SPECIAL_TOKENS = {
+    "<pad>": 0, "<eos>": 1, "<bos>": 2,
+    "<start_of_turn>": 105, "<end_of_turn>": 106,
+    "<start_of_image>": 255999, "<end_of_image>": 262144, "<image_soft_token>": 262145,
+}
+BYTE_OFFSET = 1000
+IMAGE_SOFT_TOKENS = 256
+
+
+def tiny_config() -> Gemma3nConfig:
+    """Small text decoder with the real vocabulary and special token ids (the vision tower is full size)"""
+    text_config = dict(
+        vocab_size=262400, vocab_size_per_layer_input=262144, hidden_size=128, hidden_size_per_layer_input=16,
+        intermediate_size=512, num_hidden_layers=4, num_attention_heads=4, num_key_value_heads=1, head_dim=32,
+        num_kv_shared_layers=2, laurel_rank=16, sliding_window=512, activation_sparsity_pattern=[0.0] * 4,
+        layer_types=["sliding_attention", "full_attention", "sliding_attention", "full_attention"],
+    )
+    audio_config = dict(hidden_size=32, conf_num_attention_heads=2, conf_num_hidden_layers=1, sscp_conv_channel_size=(8, 8))
+    return Gemma3nConfig(text_config=text_config, audio_config=audio_config)
+
+
+def build_tiny_model(seed: int = 0) -> Gemma3nForConditionalGeneration:
+    torch.manual_seed(seed)
+    model = Gemma3nForConditionalGeneration(tiny_config()).eval()
+    model.generation_config.eos_token_id = [SPECIAL_TOKENS["<eos>"], SPECIAL_TOKENS["<end_of_turn>"]]
+    return model
+
+
+class ByteTokenizer:
+    """UTF-8 bytes as token ids, plus the Gemma special tokens"""
+
+    eos_token_id = SPECIAL_TOKENS["<eos>"]
+    pad_token_id = SPECIAL_TOKENS["<pad>"]
+    bos_token_id = SPECIAL_TOKENS["<bos>"]
+    padding_side = "left"
+
+    _special = re.compile("|".join(re.escape(token) for token in SPECIAL_TOKENS))
+    _names = {token_id: token for token, token_id in SPECIAL_TOKENS.items()}
+
+    def encode(self, text: str, add_special_tokens: bool = False) -> List[int]:
+        ids, position = [], 0
+        for match in self._special.finditer(text):
+            ids += [BYTE_OFFSET + b for b in text[position:match.start()].encode('utf-8')]
+            ids.append(SPECIAL_TOKENS[match.group()])
+            position = match.end()
+        ids += [BYTE_OFFSET + b for b in text[position:].encode('utf-8')]
+        return ids
+
+    def __call__(self, text: str, add_special_tokens: bool = False, return_tensors=None, **kwargs):
+        ids = self.encode(text)
+        if return_tensors == "pt":
+            return BatchFeature({"input_ids": torch.tensor([ids]), "attention_mask": torch.ones(1, len(ids), dtype=torch.long)})
+        return {"input_ids": ids}
+
+    def decode(self, ids, skip_special_tokens: bool = False, **kwargs) -> str:
+        if hasattr(ids, 'tolist'):
+            ids = ids.tolist()
+        pieces, data = [], bytearray()
+        for token_id in ids:
+            if BYTE_OFFSET <= token_id < BYTE_OFFSET + 256:
+                data.append(token_id - BYTE_OFFSET)
+                continue
+            pieces.append(data.decode('utf-8', errors='replace'))
+            data = bytearray()
+            if not skip_special_tokens:
+                pieces.append(self._names.get(token_id, ""))
+        pieces.append(data.decode('utf-8', errors='replace'))
+        return "".join(pieces)
+
+    def batch_decode(self, sequences, **kwargs) -> List[str]:
+        return [self.decode(ids, **kwargs) for ids in sequences]
+
+    def convert_tokens_to_ids(self, token: str) -> int:
+        return SPECIAL_TOKENS.get(token, self.pad_token_id)
+
+
+class TinyProcessor:
+    """The subset of Gemma3nProcessor that AITutor uses, with the same chat format"""
+
+    image_token = "<image_soft_token>"
+    full_image_sequence = "\n\n<start_of_image>" + "<image_soft_token>" * IMAGE_SOFT_TOKENS + "<end_of_image>\n\n"
+
+    def __init__(self):
+        self.tokenizer = ByteTokenizer()
+        self.image_processor = SiglipImageProcessor(
+            size={"height": 768, "width": 768}, image_mean=[0.5] * 3, image_std=[0.5] * 3
+        )
+
+    def render(self, messages: list, add_generation_prompt: bool = True) -> str:
+        text, system = "<bos>", ""
+        for message in messages:
+            content = "".join(
+                part["text"] if part["type"] == "text" else self.image_token for part in message["content"]
+            )
+            if message["role"] == "system":
+                system = content + "\n\n"
+                continue
+            role = "model" if message["role"] == "assistant" else "user"
+            text += f"<start_of_turn>{role}\n{system}{content}<end_of_turn>\n"
+            system = ""
+        if add_generation_prompt:
+            text += "<start_of_turn>model\n"
+        return text
+
+    def apply_chat_template(self, messages: list, add_generation_prompt: bool = True, tokenize: bool = False,
+                            return_dict: bool = False, return_tensors=None, **kwargs):
+        text = self.render(messages, add_generation_prompt)
+        if not tokenize:
+            return text
+        return self.tokenizer(text, return_tensors="pt")
+
+    def decode(self, ids, **kwargs) -> str:
+        return self.tokenizer.decode(ids, **kwargs)
+
+    def batch_decode(self, sequences, **kwargs) -> List[str]:
+        return self.tokenizer.batch_decode(sequences, **kwargs)
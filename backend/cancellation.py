@@ -0,0 +1,63 @@
+"""
+Cancelling text generations nobody is waiting for any more
+
+Every streamed answer registers an event under its message_id. A
+`cancel_generation` socket event or the client disconnecting sets it, and
+generation checks it once per decode step (streaming.CancelledCriteria for
+model.generate, the batch scheduler before it keeps a row) so the model
+stops within one token and its KV cache is freed.
+"""
+import threading
+from typing import Dict, List, Optional, Tuple
+
+
+class CancelRegistry:
+    """Cancel events of the generations in flight, by request id and owning client"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._requests: Dict[str, Tuple[Optional[str], threading.Event]] = {}
+        self.cancelled = 0
+
+    def register(self, request_id: str, client_id: Optional[str] = None) -> threading.Event:
+        event = threading.Event()
+        with self._lock:
+            self._requests[request_id] = (client_id, event)
+        return event
+
+    def get(self, request_id: str) -> Optional[threading.Event]:
+        with self._lock:
+            entry = self._requests.get(request_id)
+        return entry[1] if entry is not None else None
+
+    def release(self, request_id: str):
+        with self._lock:
+            self._requests.pop(request_id, None)
+
+    def cancel(self, request_id: str, client_id: Optional[str] = None) -> bool:
+        """Cancel one generation; with a client_id, only if that client started it"""
+        with self._lock:
+            entry = self._requests.get(request_id)
+            if entry is None or (client_id is not None and entry[0] != client_id):
+                return False
+            if entry[1].is_set():
+                return False
+            entry[1].set()
+            self.cancelled += 1
+        return True
+
+    def cancel_client(self, client_id: str) -> List[str]:
+        """Cancel everything a client has in flight; returns the request ids"""
+        with self._lock:
+            owned = [(request_id, event) for request_id, (owner, event) in self._requests.items()
+                     if owner == client_id and not event.is_set()]
+            for _, event in owned:
+                event.set()
+            self.cancelled += len(owned)
+        return [request_id for request_id, _ in owned]
+
+    def get_stats(self) -> dict:
+        with self._lock:
+            active = len(self._requests)
+        return {'active': active, 'cancelled': self.cancelled}
+
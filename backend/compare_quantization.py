@@ -0,0 +1,186 @@
+"""
+Quality and speed of the CPU quantization modes on a fixed question set
+
+    python compare_quantization.py                       # none vs int8 vs int4
+    python compare_quantization.py --modes none int8 --max-tokens 128 --json
+
+Each mode runs in a fresh process (so load time and memory are not polluted by
+the previous model) and answers the same questions with greedy decoding. The
+first mode is the reference; the others are scored against its answers:
+
+    exact        - answers identical to the reference
+    prefix       - mean fraction of the reference answer reproduced before diverging
+    token_acc    - teacher-forced next-token accuracy on the reference answers
+    ref_ppl      - perplexity of the reference answers under the mode's model
+
+The first run of a quantized mode writes its snapshot; run twice to see warm load times.
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+QUESTIONS = [
+    ("Mathematics", "What is the Pythagorean theorem and how do I use it?"),
+    ("Mathematics", "How do I solve 3x + 7 = 22?"),
+    ("Mathematics", "What is the difference between a prime number and a composite number?"),
+    ("Science", "Why is the sky blue?"),
+    ("Science", "Explain photosynthesis in simple terms."),
+    ("Science", "What happens to water molecules when water boils?"),
+    ("History", "What were the main causes of World War I?"),
+    ("English", "What is the difference between a metaphor and a simile?"),
+    ("Geography", "Why are there seasons on Earth?"),
+    ("Computer Science", "What is an algorithm? Give an everyday example."),
+]
+
+
+def _run_mode(mode: str, max_tokens: int, reference_path: str = None):
+    """Child process: load with `mode`, answer every question and print one JSON line"""
+    import torch
+    from ai_tutor import AITutor
+    from config import get_settings
+    from weight_snapshot import _memory_mb
+
+    settings = get_settings()
+    settings.cpu_quantization = mode
+    tutor = AITutor(settings.hf_model_id, settings.hf_token, settings=settings)
+    start = time.perf_counter()
+    tutor.initialize()
+    load_seconds = time.perf_counter() - start
+
+    results = []
+    for subject, question in QUESTIONS:
+        first_chunk = []
+        start = time.perf_counter()
+        answer = tutor.ask_ai_tutor(
+            question, subject=subject, max_tokens=max_tokens, deterministic=True,
+            on_chunk=lambda text: first_chunk or first_chunk.append(time.perf_counter())
+        )
+        elapsed = time.perf_counter() - start
+        tokens = len(tutor.processor.tokenizer.encode(answer, add_special_tokens=False))
+        ttft = first_chunk[0] - start if first_chunk else elapsed
+        results.append({
+            'question': question,
+            'answer': answer,
+            'tokens': tokens,
+            'seconds': round(elapsed, 3),
+            'ttft_seconds': round(ttft, 3),
+            'decode_tok_s': round((tokens - 1) / (elapsed - ttft), 2) if tokens > 1 and elapsed > ttft else 0.0,
+        })
+
+    if reference_path:
+        with open(reference_path) as f:
+            reference = json.load(f)
+        correct = total = 0
+        nll = 0.0
+        for (subject, question), ref in zip(QUESTIONS, reference):
+            messages = tutor.build_messages(question, subject, "English", "middle_school", "regular")
+            prompt_ids = tutor.encode_messages(messages)
+            answer_ids = tutor.processor.tokenizer.encode(ref['answer'], add_special_tokens=False)
+            if not answer_ids:
+                continue
+            ids = torch.tensor([prompt_ids + answer_ids])
+            with torch.inference_mode():
+                logits = tutor.model(input_ids=ids).logits[0, len(prompt_ids) - 1:-1].float()
+            targets = torch.tensor(answer_ids)
+            correct += (logits.argmax(-1) == targets).sum().item()
+            nll += torch.nn.functional.cross_entropy(logits, targets, reduction='sum').item()
+            total += len(answer_ids)
+        teacher_forced = {
+            'token_acc': round(correct / total, 4) if total else None,
+            'ref_ppl': round(float(torch.exp(torch.tensor(nll / total))), 3) if total else None,
+        }
+    else:
+        teacher_forced = {}
+
+    memory = _memory_mb()
+    print(json.dumps({
+        'mode': mode,
+        'load_seconds': round(load_seconds, 2),
+        'startup_timings': {k: round(v, 3) for k, v in tutor.startup_timings.items()},
+        'rss_mb': memory['rss'],
+        'anon_mb': memory['anon'],
+        'answers': results,
+        **teacher_forced,
+    }))
+
+
+def _prefix_fraction(answer: str, reference: str) -> float:
+    if not reference:
+        return 1.0
+    matched = 0
+    for a, b in zip(answer, reference):
+        if a != b:
+            break
+        matched += 1
+    return matched / len(reference)
+
+
+def summarize(run: dict, reference: dict) -> dict:
+    answers = run['answers']
+    tokens = sum(a['tokens'] for a in answers)
+    seconds = sum(a['seconds'] for a in answers)
+    summary = {
+        'mode': run['mode'],
+        'load_s': run['load_seconds'],
+        'rss_mb': run['rss_mb'],
+        'ttft_s': round(sum(a['ttft_seconds'] for a in answers) / len(answers), 3),
+        'decode_tok_s': round(sum(a['decode_tok_s'] for a in answers) / len(answers), 2),
+        'overall_tok_s': round(tokens / seconds, 2) if seconds else 0.0,
+    }
+    if reference is not run:
+        pairs = list(zip(answers, reference['answers']))
+        summary['exact'] = round(sum(a['answer'] == r['answer'] for a, r in pairs) / len(pairs), 3)
+        summary['prefix'] = round(sum(_prefix_fraction(a['answer'], r['answer']) for a, r in pairs) / len(pairs), 3)
+        summary['token_acc'] = run.get('token_acc')
+        summary['ref_ppl'] = run.get('ref_ppl')
+    return summary
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare CPU quantization modes on a fixed question set")
+    parser.add_argument('--modes', nargs='+', default=['none', 'int8', 'int4'],
+                        help="The first mode is the quality reference")
+    parser.add_argument('--max-tokens', type=int, default=200)
+    parser.add_argument('--json', action='store_true', help="Print full results (including answers) as JSON")
+    parser.add_argument('--child', help=argparse.SUPPRESS)
+    parser.add_argument('--reference', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        _run_mode(args.child, args.max_tokens, args.reference)
+        return
+
+    runs = []
+    with tempfile.TemporaryDirectory() as workdir:
+        reference_path = os.path.join(workdir, 'reference.json')
+        for index, mode in enumerate(args.modes):
+            command = [sys.executable, __file__, '--child', mode, '--max-tokens', str(args.max_tokens)]
+            if index > 0:
+                command += ['--reference', reference_path]
+            print(f"🔄 Running {mode}...", file=sys.stderr)
+            output = subprocess.run(command, capture_output=True, text=True, check=True).stdout
+            runs.append(json.loads(output.strip().splitlines()[-1]))
+            if index == 0:
+                with open(reference_path, 'w') as f:
+                    json.dump(runs[0]['answers'], f)
+
+    summaries = [summarize(run, runs[0]) for run in runs]
+    if args.json:
+        print(json.dumps({'max_tokens': args.max_tokens, 'summary': summaries, 'runs': runs}, indent=2))
+        return
+
+    for s in summaries:
+        quality = ""
+        if 'exact' in s:
+            quality = (f" | exact {s['exact']:.0%} prefix {s['prefix']:.0%} "
+                       f"token acc {s['token_acc']} ref ppl {s['ref_ppl']}")
+        print(f"📊 {s['mode']:5s} | load {s['load_s']:6.1f}s | RSS {s['rss_mb']:8.1f}MB | "
+              f"TTFT {s['ttft_s']:.2f}s | decode {s['decode_tok_s']:6.2f} tok/s{quality}")
+
+
+if __name__ == '__main__':
+    main()
@@ -20,8 +20,105 @@ class Settings(BaseSettings):
     temperature: float = 0.7
     do_sample: bool = True
     
+    # Streaming settings
+    stream_chunk_tokens: int = 1  # Emit a text_response_chunk every N generated tokens
+    
+    # Continuous-batching scheduler settings
+    batch_scheduler_enabled: bool = True
+    max_batch_size: int = 8      # Sequences decoded together
+    max_prefill_batch: int = 4   # New sequences admitted per scheduler iteration
+    
     # Cache settings
     model_cache_dir: str = "./models_cache"
+    prefix_cache_max_mb: float = 256  # KV cache budget for system prompt prefixes (0 disables)
+    
+    # Answer cache settings
+    answer_cache_enabled: bool = True
+    answer_cache_max_entries: int = 1024     # In-memory LRU size
+    answer_cache_ttl_seconds: float = 86400  # 0 = never expire
+    answer_cache_db_path: str = ""           # SQLite file for the on-disk tier (empty = memory only)
+    
+    # Semantic (paraphrase) answer cache settings
+    semantic_cache_enabled: bool = False     # Opt-in: validate the threshold on your own paraphrase pairs first
+    semantic_cache_threshold: float = 0.92   # Minimum cosine similarity to reuse an answer
+    semantic_cache_max_entries: int = 4096
+    semantic_cache_dir: str = ""             # Directory for the memory-mapped index (empty = memory only)
+    semantic_cache_embedding: str = "input"  # "input" (token embeddings) or "hidden" (a full LM forward pass)
+    
+    # Multi-turn session settings
+    sessions_enabled: bool = True
+    session_cache_max_mb: float = 1024       # KV memory shared by all conversations
+    session_idle_seconds: float = 1800       # Drop conversations idle this long (0 = never)
+    session_max_tokens: int = 4096           # Start a new conversation once the transcript is this long
+    
+    # Inference worker settings
+    inference_worker_enabled: bool = True    # Run the model in a separate process
+    inference_worker_address: str = ""       # host:port of a standalone worker (empty = launch one)
+    inference_worker_authkey: str = ""       # Shared secret for a standalone worker
+    inference_worker_restart_delay: float = 2.0
+    inference_worker_max_failed_starts: int = 3
+    
+    # Image cache settings (decoded pixels + vision tower output, keyed by content hash)
+    image_cache_max_mb: float = 512          # 0 disables the cache
+    
+    # ask_image_batch: images per event, and answers decoded together in one batch
+    image_batch_max_images: int = 8
+    image_batch_size: int = 4
+    
+    # Image ingestion (image_ingest.py): decode/preprocess pool and limits checked before decoding
+    image_ingest_workers: int = 2
+    image_max_mb: float = 20
+    image_max_megapixels: float = 50
+    image_draft_decode: bool = True          # Decode JPEGs at reduced scale close to the model's input size
+    
+    # Pre-converted CPU weights, memory-mapped on later starts (weight_snapshot.py)
+    weight_snapshot_enabled: bool = False
+    weight_snapshot_dir: str = ""            # Empty = ~/.cache/ai_tutor/snapshots
+    cpu_quantization: str = "none"           # none, int8 (dynamic) or int4 (weight-only); persisted as a snapshot
+    
+    # Speculative decoding: a small draft model proposes tokens the main model verifies in one pass
+    draft_model_id: str = ""                 # e.g. a small Gemma 3 checkpoint in the HF cache (empty disables)
+    speculative_tokens: int = 5              # Draft tokens proposed per verification step
+    speculative_min_acceptance: float = 0.35 # Switch the draft off below this mean acceptance rate...
+    speculative_window: int = 8              # ...over this many recent requests
+    prompt_lookup_enabled: bool = False      # Without a draft: copy continuations from long pasted questions (runs unbatched)
+    prompt_lookup_min_tokens: int = 150      # Question length that switches prompt lookup on
+    prompt_lookup_tokens: int = 10           # Tokens proposed per match
+    prompt_lookup_max_ngram: int = 3         # Longest n-gram matched against the prompt
+    
+    # Requests received while the model loads wait in a bounded queue
+    pending_queue_max_size: int = 32
+    pending_request_timeout: float = 600.0   # Seconds a queued request waits before giving up
+    
+    # Admission control once the model is up: how many generations run at once and who goes next
+    admission_max_concurrent: int = 0        # 0 = batch size with the batch scheduler, else 1
+    admission_max_queue: int = 32            # Waiting requests beyond this get a `busy` event
+    admission_max_per_client: int = 2        # Questions one client may have waiting or running
+    admission_shortest_first: bool = False   # Smallest max_tokens first instead of fair order
+    admission_position_interval: float = 2.0 # Seconds between queue_position updates
+    
+    # Latency budget per answer (settings.deadline_ms overrides it); 0 = no deadline
+    generation_deadline_ms: int = 0
+    
+    # ASGI server settings (asgi_app.py, an asyncio alternative to the eventlet server)
+    asgi_port: int = 5001
+    asgi_send_queue_size: int = 64           # Outgoing events buffered per connection
+    asgi_send_timeout: float = 30.0          # Disconnect a client that stops reading for this long
+    
+    # Request traces for load_test.py replay (anonymized unless question text is included)
+    trace_file: str = ""                     # JSONL file to append to (empty disables recording)
+    trace_include_text: bool = False         # Also store question text
+    
+    # Prometheus text-format metrics at /metrics (per-stage latency histograms, tokens, caches, memory)
+    metrics_enabled: bool = True
+    
+    # Per-request torch.profiler traces (Chrome trace JSON) for diagnosing slow requests
+    profiling_enabled: bool = False          # Allow profiling at all (requests ask with settings.profile)
+    profiling_sample_rate: float = 0.0       # Also profile this fraction of requests (0.01 = 1 in 100)
+    profiling_dir: str = ""                  # Where traces go (empty = backend/profiles)
+    profiling_max_files: int = 20            # Keep only the newest traces...
+    profiling_max_mb: float = 200.0          # ...within this much disk space
+    profiling_top_ops: int = 15              # Operators listed in each summary
     
     class Config:
         env_file = ".env"
@@ -79,8 +176,130 @@ class Settings(BaseSettings):
                             self.max_new_tokens = int(value)
                         elif key == 'TEMPERATURE':
                             self.temperature = float(value)
+                        elif key == 'STREAM_CHUNK_TOKENS':
+                            self.stream_chunk_tokens = int(value)
+                        elif key == 'BATCH_SCHEDULER_ENABLED':
+                            self.batch_scheduler_enabled = value.lower() in ('1', 'true', 'yes')
+                        elif key == 'MAX_BATCH_SIZE':
+                            self.max_batch_size = int(value)
+                        elif key == 'MAX_PREFILL_BATCH':
+                            self.max_prefill_batch = int(value)
                         elif key == 'MODEL_CACHE_DIR':
                             self.model_cache_dir = value
+                        elif key == 'PREFIX_CACHE_MAX_MB':
+                            self.prefix_cache_max_mb = float(value)
+                        elif key == 'ANSWER_CACHE_ENABLED':
+                            self.answer_cache_enabled = value.lower() in ('1', 'true', 'yes')
+                        elif key == 'ANSWER_CACHE_MAX_ENTRIES':
+                            self.answer_cache_max_entries = int(value)
+                        elif key == 'ANSWER_CACHE_TTL_SECONDS':
+                            self.answer_cache_ttl_seconds = float(value)
+                        elif key == 'ANSWER_CACHE_DB_PATH':
+                            self.answer_cache_db_path = value
+                        elif key == 'SEMANTIC_CACHE_ENABLED':
+                            self.semantic_cache_enabled = value.lower() in ('1', 'true', 'yes')
+                        elif key == 'SEMANTIC_CACHE_THRESHOLD':
+                            self.semantic_cache_threshold = float(value)
+                        elif key == 'SEMANTIC_CACHE_MAX_ENTRIES':
+                            self.semantic_cache_max_entries = int(value)
+                        elif key == 'SEMANTIC_CACHE_DIR':
+                            self.semantic_cache_dir = value
+                        elif key == 'SEMANTIC_CACHE_EMBEDDING':
+                            self.semantic_cache_embedding = value
+                        elif key == 'SESSIONS_ENABLED':
+                            self.sessions_enabled = value.lower() in ('1', 'true', 'yes')
+                        elif key == 'SESSION_CACHE_MAX_MB':
+                            self.session_cache_max_mb = float(value)
+                        elif key == 'SESSION_IDLE_SECONDS':
+                            self.session_idle_seconds = float(value)
+                        elif key == 'SESSION_MAX_TOKENS':
+                            self.session_max_tokens = int(value)
+                        elif key == 'INFERENCE_WORKER_ENABLED':
+                            self.inference_worker_enabled = value.lower() in ('1', 'true', 'yes')
+                        elif key == 'INFERENCE_WORKER_ADDRESS':
+                            self.inference_worker_address = value
+                        elif key == 'INFERENCE_WORKER_AUTHKEY':
+                            self.inference_worker_authkey = value
+                        elif key == 'INFERENCE_WORKER_RESTART_DELAY':
+                            self.inference_worker_restart_delay = float(value)
+                        elif key == 'INFERENCE_WORKER_MAX_FAILED_STARTS':
+                            self.inference_worker_max_failed_starts = int(value)
+                        elif key == 'IMAGE_CACHE_MAX_MB':
+                            self.image_cache_max_mb = float(value)
+                        elif key == 'IMAGE_BATCH_MAX_IMAGES':
+                            self.image_batch_max_images = int(value)
+                        elif key == 'IMAGE_BATCH_SIZE':
+                            self.image_batch_size = int(value)
+                        elif key == 'IMAGE_INGEST_WORKERS':
+                            self.image_ingest_workers = int(value)
+                        elif key == 'IMAGE_MAX_MB':
+                            self.image_max_mb = float(value)
+                        elif key == 'IMAGE_MAX_MEGAPIXELS':
+                            self.image_max_megapixels = float(value)
+                        elif key == 'IMAGE_DRAFT_DECODE':
+                            self.image_draft_decode = value.lower() in ('1', 'true', 'yes')
+                        elif key == 'WEIGHT_SNAPSHOT_ENABLED':
+                            self.weight_snapshot_enabled = value.lower() in ('1', 'true', 'yes')
+                        elif key == 'WEIGHT_SNAPSHOT_DIR':
+                            self.weight_snapshot_dir = value
+                        elif key == 'CPU_QUANTIZATION':
+                            self.cpu_quantization = value
+                        elif key == 'DRAFT_MODEL_ID':
+                            self.draft_model_id = value
+                        elif key == 'SPECULATIVE_TOKENS':
+                            self.speculative_tokens = int(value)
+                        elif key == 'SPECULATIVE_MIN_ACCEPTANCE':
+                            self.speculative_min_acceptance = float(value)
+                        elif key == 'SPECULATIVE_WINDOW':
+                            self.speculative_window = int(value)
+                        elif key == 'PROMPT_LOOKUP_ENABLED':
+                            self.prompt_lookup_enabled = value.lower() in ('1', 'true', 'yes')
+                        elif key == 'PROMPT_LOOKUP_MIN_TOKENS':
+                            self.prompt_lookup_min_tokens = int(value)
+                        elif key == 'PROMPT_LOOKUP_TOKENS':
+                            self.prompt_lookup_tokens = int(value)
+                        elif key == 'PROMPT_LOOKUP_MAX_NGRAM':
+                            self.prompt_lookup_max_ngram = int(value)
+                        elif key == 'PENDING_QUEUE_MAX_SIZE':
+                            self.pending_queue_max_size = int(value)
+                        elif key == 'PENDING_REQUEST_TIMEOUT':
+                            self.pending_request_timeout = float(value)
+                        elif key == 'ADMISSION_MAX_CONCURRENT':
+                            self.admission_max_concurrent = int(value)
+                        elif key == 'ADMISSION_MAX_QUEUE':
+                            self.admission_max_queue = int(value)
+                        elif key == 'ADMISSION_MAX_PER_CLIENT':
+                            self.admission_max_per_client = int(value)
+                        elif key == 'ADMISSION_SHORTEST_FIRST':
+                            self.admission_shortest_first = value.lower() in ('1', 'true', 'yes')
+                        elif key == 'ADMISSION_POSITION_INTERVAL':
+                            self.admission_position_interval = float(value)
+                        elif key == 'GENERATION_DEADLINE_MS':
+                            self.generation_deadline_ms = int(value)
+                        elif key == 'ASGI_PORT':
+                            self.asgi_port = int(value)
+                        elif key == 'ASGI_SEND_QUEUE_SIZE':
+                            self.asgi_send_queue_size = int(value)
+                        elif key == 'ASGI_SEND_TIMEOUT':
+                            self.asgi_send_timeout = float(value)
+                        elif key == 'TRACE_FILE':
+                            self.trace_file = value
+                        elif key == 'TRACE_INCLUDE_TEXT':
+                            self.trace_include_text = value.lower() in ('1', 'true', 'yes')
+                        elif key == 'METRICS_ENABLED':
+                            self.metrics_enabled = value.lower() in ('1', 'true', 'yes')
+                        elif key == 'PROFILING_ENABLED':
+                            self.profiling_enabled = value.lower() in ('1', 'true', 'yes')
+                        elif key == 'PROFILING_SAMPLE_RATE':
+                            self.profiling_sample_rate = float(value)
+                        elif key == 'PROFILING_DIR':
+                            self.profiling_dir = value
+                        elif key == 'PROFILING_MAX_FILES':
+                            self.profiling_max_files = int(value)
+                        elif key == 'PROFILING_MAX_MB':
+                            self.profiling_max_mb = float(value)
+                        elif key == 'PROFILING_TOP_OPS':
+                            self.profiling_top_ops = int(value)
                             
         except Exception as e:
             print(f"Error loading .env file: {e}")
@@ -0,0 +1,102 @@
+"""
+Deadline-aware generation: keep answers inside a wall-clock budget
+
+A request carries `deadline_ms` (or gets the server's default), counted from
+when its generation starts. Once most of the budget is spent, decoding stops
+at the next sentence end; at the deadline it stops wherever it is. Either
+way the answer is marked truncated. The token budget is also capped to what
+this machine can decode in the time, measured from recent answers, so slow
+hardware doesn't reserve (or get charged for) tokens it can never produce.
+"""
+import re
+import threading
+import time
+from typing import Callable, Optional
+
+# Text that ends a sentence (or a line), ignoring closing quotes/brackets and markdown;
+# "1." and "3.5" don't count so numbered lists aren't cut right after the number
+SENTENCE_END = re.compile(r'(?:(?<![0-9])[.!?…]|[。！？])["\'”’)\]*_]*\s*$|\n\s*$')
+
+
+class Deadline:
+    """Wall-clock budget for one answer"""
+
+    def __init__(self, budget_seconds: float, soft_fraction: float = 0.75):
+        self.budget = budget_seconds
+        self.soft_fraction = soft_fraction
+        self.start()
+        self.truncated = False
+        # Set when fit_tokens lowered the token budget: the answer's length then depends on this machine
+        self.fitted = False
+
+    @classmethod
+    def from_request(cls, request: dict, default_ms: float = 0) -> Optional['Deadline']:
+        """The request's `deadline_ms`, else the default; None when neither is set (or <= 0)"""
+        deadline_ms = request.get('deadline_ms')
+        if deadline_ms is None:
+            deadline_ms = default_ms
+        try:
+            deadline_ms = float(deadline_ms)
+        except (TypeError, ValueError):
+            return None
+        return cls(deadline_ms / 1000.0) if deadline_ms > 0 else None
+
+    def start(self):
+        """(Re)start the clock; generation calls this once the request has the model, so queueing doesn't count"""
+        self.started = time.monotonic()
+        self.soft_at = self.started + self.budget * self.soft_fraction
+        self.hard_at = self.started + self.budget
+
+    def remaining(self) -> float:
+        return max(0.0, self.hard_at - time.monotonic())
+
+    def fit_tokens(self, max_tokens: int, rate: 'DecodeRate') -> int:
+        """max_tokens capped to what `rate` can decode in the budget (marks the deadline fitted if lowered)"""
+        fitted = rate.fit(max_tokens, self.budget)
+        if fitted < max_tokens:
+            self.fitted = True
+        return fitted
+
+    def note_length(self, tokens: int, max_tokens: int):
+        """After generation: an answer that ran into a fitted budget was cut short too"""
+        if self.fitted and tokens >= max_tokens:
+            self.truncated = True
+
+    def should_stop(self, tail: Callable[[], str]) -> bool:
+        """
+        Check once per decode step; `tail()` returns the end of the answer so far
+        and is only called once the soft deadline has passed.
+        """
+        now = time.monotonic()
+        if now < self.soft_at:
+            return False
+        if now >= self.hard_at or SENTENCE_END.search(tail()):
+            self.truncated = True
+        return self.truncated
+
+
+class DecodeRate:
+    """Moving average of per-answer decode speed (tokens/second) on this machine"""
+
+    def __init__(self, alpha: float = 0.2, headroom: float = 1.5):
+        self.alpha = alpha
+        # Token cap = rate * time left * headroom, so the deadline (at a sentence end) normally stops first
+        self.headroom = headroom
+        self.tokens_per_second: Optional[float] = None
+        self._lock = threading.Lock()
+
+    def observe(self, tokens: int, seconds: float):
+        if tokens < 8 or seconds <= 0:
+            return
+        rate = tokens / seconds
+        with self._lock:
+            if self.tokens_per_second is None:
+                self.tokens_per_second = rate
+            else:
+                self.tokens_per_second += self.alpha * (rate - self.tokens_per_second)
+
+    def fit(self, max_tokens: int, seconds: float, minimum: int = 50) -> int:
+        """max_tokens capped to what can be decoded in `seconds` (unchanged until a rate is known)"""
+        if self.tokens_per_second is None:
+            return max_tokens
+        return max(minimum, min(max_tokens, int(self.tokens_per_second * seconds * self.headroom)))
@@ -6,10 +6,11 @@ from transformers import AutoProcessor, AutoModelForImageTextToText
 from typing import Optional
 import logging
 import base64
-import io
 from PIL import Image
 import requests
 
+from image_ingest import decode_image, processor_target_size
+
 logger = logging.getLogger(__name__)
 
 class ImageAnalyzer:
@@ -140,24 +141,27 @@ class ImageAnalyzer:
             return f"❌ Error analyzing image: {str(e)}"
 
     def _load_image(self, image_input: str) -> Image.Image:
-        """Load image from URL, file path, or base64 data"""
+        """Load image from URL, file path, or base64 data (size-checked, JPEGs decoded near the model's input size)"""
         try:
             # Check if it's base64 data
             if image_input.startswith('data:image'):
                 # Extract base64 data
                 base64_data = image_input.split(',')[1]
                 image_data = base64.b64decode(base64_data)
-                return Image.open(io.BytesIO(image_data)).convert('RGB')
             
             # Check if it's a URL
             elif image_input.startswith(('http://', 'https://')):
                 response = requests.get(image_input, timeout=10)
                 response.raise_for_status()
-                return Image.open(io.BytesIO(response.content)).convert('RGB')
+                image_data = response.content
             
             # Assume it's a file path
             else:
-                return Image.open(image_input).convert('RGB')
+                with open(image_input, 'rb') as f:
+                    image_data = f.read()
+            
+            target_size = processor_target_size(self.processor.image_processor)
+            return decode_image(image_data, target_size)
                 
         except Exception as e:
             logger.error(f"❌ Failed to load image: {e}")
@@ -0,0 +1,127 @@
+"""
+Content-addressed cache of preprocessed images and their vision-encoder features
+"""
+import hashlib
+import logging
+import threading
+from collections import OrderedDict
+from typing import Optional
+
+import torch
+
+logger = logging.getLogger(__name__)
+
+
+def image_content_key(data) -> str:
+    """Hash of the encoded image bytes, so the same file hits no matter how it was sent"""
+    return hashlib.blake2b(data, digest_size=20).hexdigest()
+
+
+def _tensor_nbytes(tensor: Optional[torch.Tensor]) -> int:
+    return tensor.numel() * tensor.element_size() if tensor is not None else 0
+
+
+class ImageEntry:
+    """Processor output for one image plus (once computed) its vision tower embeddings"""
+
+    def __init__(self, key: str, pixel_values: torch.Tensor):
+        self.key = key
+        self.pixel_values = pixel_values
+        self.image_features: Optional[torch.Tensor] = None
+        self.hits = 0
+
+    @property
+    def nbytes(self) -> int:
+        return _tensor_nbytes(self.pixel_values) + _tensor_nbytes(self.image_features)
+
+
+class ImageFeatureCache:
+    """
+    LRU store of ImageEntry objects keyed by content hash, bounded by bytes.
+
+    A pixel hit skips decoding and resizing the image; a feature hit also
+    skips the vision tower, leaving only text prefill and decode.
+    """
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self._entries: "OrderedDict[str, ImageEntry]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.total_bytes = 0
+        self.pixel_hits = 0
+        self.pixel_misses = 0
+        self.feature_hits = 0
+        self.feature_misses = 0
+        self.evictions = 0
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_bytes > 0
+
+    def get(self, key: str) -> Optional[ImageEntry]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.pixel_misses += 1
+                return None
+            self._entries.move_to_end(key)
+            entry.hits += 1
+            self.pixel_hits += 1
+            return entry
+
+    def put(self, key: str, pixel_values: torch.Tensor) -> ImageEntry:
+        entry = ImageEntry(key, pixel_values)
+        if not self.enabled:
+            return entry
+        with self._lock:
+            previous = self._entries.pop(key, None)
+            if previous is not None:
+                self.total_bytes -= previous.nbytes
+            self._entries[key] = entry
+            self.total_bytes += entry.nbytes
+            self._evict()
+        return entry
+
+    def attach_features(self, entry: ImageEntry, image_features: torch.Tensor):
+        """Store the vision tower output for an entry and re-check the byte budget"""
+        with self._lock:
+            self.feature_misses += 1
+            cached = self._entries.get(entry.key) is entry
+            if cached:
+                self.total_bytes -= entry.nbytes
+            entry.image_features = image_features
+            if cached:
+                self.total_bytes += entry.nbytes
+                self._evict()
+
+    def record_feature_hit(self):
+        with self._lock:
+            self.feature_hits += 1
+
+    def _evict(self):
+        while self.total_bytes > self.max_bytes and self._entries:
+            _, evicted = self._entries.popitem(last=False)
+            self.total_bytes -= evicted.nbytes
+            self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.total_bytes = 0
+
+    def get_stats(self) -> dict:
+        with self._lock:
+            pixel_lookups = self.pixel_hits + self.pixel_misses
+            feature_lookups = self.feature_hits + self.feature_misses
+            return {
+                'entries': len(self._entries),
+                'memory_mb': round(self.total_bytes / 1024**2, 2),
+                'budget_mb': round(self.max_bytes / 1024**2, 2),
+                'pixel_hits': self.pixel_hits,
+                'pixel_misses': self.pixel_misses,
+                'pixel_hit_rate': round(self.pixel_hits / pixel_lookups, 3) if pixel_lookups else 0.0,
+                'feature_hits': self.feature_hits,
+                'feature_misses': self.feature_misses,
+                'feature_hit_rate': round(self.feature_hits / feature_lookups, 3) if feature_lookups else 0.0,
+                'evictions': self.evictions,
+            }
@@ -0,0 +1,870 @@
+"""
+Inference worker process hosting the tutor model, and the web-side client that talks to it
+
+The web server never runs torch itself in this mode: it sends requests over a
+multiprocessing connection and receives streamed chunks back, so pings, /health
+and other clients stay responsive while the worker generates. Image bytes are
+passed through shared memory instead of being pickled into the pipe.
+
+Run standalone (e.g. for benchmarking, or to keep the model warm across web
+server restarts):
+
+    python inference_worker.py --listen 127.0.0.1:6001
+    python inference_worker.py --benchmark --questions 5 --max-tokens 128
+"""
+import argparse
+import ipaddress
+import logging
+import os
+import queue
+import socket
+import subprocess
+import sys
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from multiprocessing import resource_tracker, shared_memory
+from multiprocessing.connection import Client, Listener
+from pathlib import Path
+from typing import Callable, Optional
+
+import metrics
+from cancellation import CancelRegistry
+from deadline import Deadline
+
+logger = logging.getLogger(__name__)
+
+AUTHKEY_ENV = "AI_TUTOR_WORKER_AUTHKEY"
+
+
+def parse_address(address: str):
+    host, _, port = address.rpartition(":")
+    return (host or "127.0.0.1", int(port))
+
+
+def is_loopback(host: str) -> bool:
+    if host == "localhost":
+        return True
+    try:
+        return ipaddress.ip_address(host).is_loopback
+    except ValueError:
+        return False
+
+
+def uses_scheduler(tutor, scheduler, request: dict) -> bool:
+    """
+    Whether a text request is batched by the scheduler. Assisted decoding (draft
+    model, or prompt lookup for long questions) and profiled requests aren't;
+    callers run those one at a time, like image requests.
+    """
+    if scheduler is None:
+        return False
+    if bool(request.get('profile', False)) and tutor.profiler.enabled:
+        return False
+    return tutor.speculation_mode(request['question']) is None
+
+
+def generate_text_answer(
+    tutor,
+    scheduler,
+    request: dict,
+    on_chunk: Callable[[str], None],
+    sleep: Callable[[float], None] = time.sleep,
+    session=None,
+    cancel_event: Optional[threading.Event] = None,
+    deadline: Optional[Deadline] = None
+) -> str:
+    """
+    Answer one text question, through the batch scheduler when uses_scheduler() says so.
+
+    Setting cancel_event stops generation within one decode step; the text so
+    far is returned and the session is left as it was. With a deadline the
+    token budget is capped to what fits in it at the measured decode speed
+    (deadline.fitted), and the answer ends early (deadline.truncated) if time
+    runs out or it reaches that cap.
+    """
+    from scheduler import GenerationRequest
+
+    question = request['question']
+    subject = request.get('subject', 'General')
+    language = request.get('language', 'English')
+    level = request.get('level', 'middle_school')
+    response_style = request.get('response_style', 'regular')
+    max_tokens = int(request.get('max_tokens', 256))
+    deterministic = bool(request.get('deterministic', False))
+    stream_chunk_tokens = int(request.get('stream_chunk_tokens', 1))
+    profile = bool(request.get('profile', False)) and tutor.profiler.enabled
+
+    if deadline is not None:
+        max_tokens = max(50, min(2048, max_tokens))
+        fitted = deadline.fit_tokens(max_tokens, tutor.decode_rate)
+        if fitted < max_tokens:
+            logger.info(f"⏱️ Token budget {max_tokens} -> {fitted} to fit {deadline.budget:.1f}s "
+                        f"at {tutor.decode_rate.tokens_per_second:.1f} tok/s")
+            max_tokens = fitted
+
+    if not uses_scheduler(tutor, scheduler, request):
+        # Holds tutor.model_lock, so the scheduler's step loop waits while this runs
+        return tutor.ask_ai_tutor(
+            question=question,
+            subject=subject,
+            language=language,
+            level=level,
+            max_tokens=max_tokens,
+            response_style=response_style,
+            on_chunk=on_chunk,
+            stream_chunk_tokens=stream_chunk_tokens,
+            deterministic=deterministic,
+            session=session,
+            profile=profile,
+            request_id=request.get('request_id'),
+            cancel_event=cancel_event,
+            deadline=deadline
+        )
+
+    template_start = time.perf_counter()
+    if session is not None:
+        # Continue the conversation; the scheduler only prefills past the session's cached tokens
+        messages, input_ids, past_key_values = tutor.prepare_session_turn(
+            session, question, subject, language, level, response_style
+        )
+        prefix_messages = None
+    else:
+        messages = tutor.build_messages(question, subject, language, level, response_style)
+        input_ids, past_key_values = tutor.encode_messages(messages), None
+        prefix_messages = messages
+    metrics.TEMPLATE.observe(time.perf_counter() - template_start)
+
+    gen_request = scheduler.submit(GenerationRequest(
+        input_ids,
+        max_new_tokens=max(50, min(2048, max_tokens)),
+        do_sample=not deterministic,
+        stream_chunk_tokens=stream_chunk_tokens,
+        client_id=request.get('client_id'),
+        request_id=request.get('request_id'),
+        messages=prefix_messages,
+        past_key_values=past_key_values,
+        keep_cache=session is not None,
+        cancel_event=cancel_event,
+        deadline=deadline
+    ))
+
+    for event in gen_request.iter_events(sleep):
+        if event[0] == 'chunk':
+            on_chunk(event[1])
+        elif event[0] == 'complete':
+            if session is not None and not event[2]['cancelled']:
+                session.record_turn(
+                    messages + [{"role": "assistant", "content": [{"type": "text", "text": event[1]}]}],
+                    input_ids + gen_request.generated_ids,
+                    gen_request.final_cache
+                )
+            return event[1]
+        elif event[0] == 'error':
+            raise RuntimeError(event[1])
+
+
+# ----------------------------------------------------------------------
+# Worker process
+# ----------------------------------------------------------------------
+
+class InferenceWorker:
+    """
+    Owns the model, batch scheduler and conversation KV caches.
+
+    Messages are (kind, request_id, payload) tuples. Replies are
+    ('chunk', id, text), ('complete', id, result, stats) or ('error', id, message),
+    plus ('status', None, message, progress) / ('ready', None, info) while loading.
+    """
+
+    def __init__(self, settings):
+        self.settings = settings
+        self.tutor = None
+        self.scheduler = None
+        self.sessions = None
+        self.load_error: Optional[str] = None
+        self.startup_timings = {}
+        self.loaded = threading.Event()
+        self._conn = None
+        self._send_lock = threading.Lock()
+        # Direct generate and vision requests run one at a time; light requests don't wait behind them
+        self._generate_pool = ThreadPoolExecutor(max_workers=1, thread_name_prefix="worker-generate")
+        self._light_pool = ThreadPoolExecutor(max_workers=2, thread_name_prefix="worker-light")
+        self.cancels = CancelRegistry()
+        metrics.watch_model(lambda: self.tutor, lambda: self.scheduler)
+
+    # -- loading -------------------------------------------------------
+
+    def load(self):
+        try:
+            start = time.perf_counter()
+            from ai_tutor import AITutor
+            from scheduler import BatchScheduler
+            from sessions import SessionStore
+            self.startup_timings['imports'] = time.perf_counter() - start
+
+            self._status("🎓 Loading AI Tutor model...")
+            tutor = AITutor(self.settings.hf_model_id, self.settings.hf_token, self.settings)
+            tutor.initialize(on_progress=self._status)
+            self.startup_timings.update(tutor.startup_timings)
+
+            if getattr(self.settings, 'batch_scheduler_enabled', False):
+                self.scheduler = BatchScheduler(
+                    tutor,
+                    max_batch_size=self.settings.max_batch_size,
+                    max_prefill_batch=self.settings.max_prefill_batch
+                )
+                self.scheduler.start()
+
+            if getattr(self.settings, 'sessions_enabled', False):
+                self.sessions = SessionStore(
+                    max_bytes=int(self.settings.session_cache_max_mb * 1024**2),
+                    idle_seconds=self.settings.session_idle_seconds,
+                    max_tokens=self.settings.session_max_tokens
+                )
+                threading.Thread(target=self._sweep_sessions, name="session-sweep", daemon=True).start()
+
+            self.tutor = tutor
+            self.startup_timings['worker_load'] = time.perf_counter() - start
+            logger.info(f"✅ Inference worker ready (pid {os.getpid()}, {self.startup_timings['worker_load']:.1f}s)")
+        except Exception as e:
+            self.load_error = str(e)
+            logger.error(f"❌ Inference worker failed to load the model: {e}")
+        with self._send_lock:
+            self.loaded.set()
+            self._announce()
+
+    def _sweep_sessions(self, interval: float = 25.0):
+        """Expire idle conversations (and free their KV caches) even when no requests arrive"""
+        while True:
+            time.sleep(interval)
+            self.sessions.sweep()
+
+    def _announce(self):
+        """Tell the connected web server whether loading succeeded (caller holds the send lock)"""
+        if self._conn is None:
+            return
+        try:
+            if self.tutor is not None:
+                self._conn.send(('ready', None, self.info()))
+            else:
+                self._conn.send(('failed', None, self.load_error))
+        except (OSError, EOFError, BrokenPipeError):
+            self._conn = None
+
+    def info(self) -> dict:
+        return {
+            'pid': os.getpid(),
+            'embedding_dim': self.tutor.embedding_dim if self.tutor else None,
+            'batch_scheduler': self.scheduler is not None,
+            'sessions': self.sessions is not None,
+            'startup_timings': self.startup_timings,
+            'gpu_name': self._gpu_name(),
+        }
+
+    @staticmethod
+    def _gpu_name() -> Optional[str]:
+        import torch
+        return torch.cuda.get_device_name() if torch.cuda.is_available() else None
+
+    # -- connection ----------------------------------------------------
+
+    def serve(self, conn) -> bool:
+        """Handle one client connection; returns True if the client asked the worker to shut down"""
+        with self._send_lock:
+            self._conn = conn
+            if self.loaded.is_set():
+                self._announce()
+
+        try:
+            while True:
+                try:
+                    kind, request_id, payload = conn.recv()
+                except (EOFError, OSError):
+                    logger.info("🔌 Web server disconnected from inference worker")
+                    return False
+
+                if kind == 'shutdown':
+                    return True
+                self._dispatch(kind, request_id, payload)
+        finally:
+            with self._send_lock:
+                self._conn = None
+
+    def _dispatch(self, kind: str, request_id: str, payload: dict):
+        handler = getattr(self, f"_handle_{kind}", None)
+        if handler is None:
+            self._send('error', request_id, f"Unknown request type: {kind}")
+            return
+        if self.tutor is None and kind not in ('stats', 'metrics', 'cancel'):
+            self._send('error', request_id, 'AI models are still loading.')
+            return
+
+        if kind == 'text':
+            # Registered before the request is queued, so a cancel that follows right behind it finds it
+            self.cancels.register(request_id, payload.get('client_id'))
+        if kind == 'cancel':
+            self._run(handler, request_id, payload)
+        elif kind == 'text' and uses_scheduler(self.tutor, self.scheduler, payload):
+            # Waits on the scheduler's events; the scheduler thread does the work
+            threading.Thread(target=self._run, args=(handler, request_id, payload), daemon=True).start()
+        elif kind in ('text', 'image', 'image_batch'):
+            self._generate_pool.submit(self._run, handler, request_id, payload)
+        else:
+            self._light_pool.submit(self._run, handler, request_id, payload)
+
+    def _run(self, handler, request_id: str, payload: dict):
+        try:
+            handler(request_id, payload)
+        except Exception as e:
+            logger.error(f"❌ Worker request {request_id} failed: {e}")
+            self._send('error', request_id, str(e))
+
+    def _send(self, *message):
+        with self._send_lock:
+            if self._conn is None:
+                return
+            try:
+                self._conn.send(message)
+            except (OSError, EOFError, BrokenPipeError):
+                self._conn = None
+
+    def _status(self, message: str, progress: Optional[dict] = None):
+        logger.info(message)
+        self._send('status', None, message, progress)
+
+    # -- handlers ------------------------------------------------------
+
+    def _acquire_session(self, payload: dict):
+        if self.sessions is None or not payload.get('session_id'):
+            return None
+        session = self.sessions.get(
+            payload['session_id'],
+            tuple(payload.get('signature') or ()),
+            reset=bool(payload.get('new_conversation', False))
+        )
+        if session.busy:
+            return None
+        session.busy = True
+        return session
+
+    def _handle_text(self, request_id: str, payload: dict):
+        cancel_event = self.cancels.get(request_id)
+        deadline = Deadline.from_request(payload, self.settings.generation_deadline_ms)
+        session = self._acquire_session(payload)
+        try:
+            response = generate_text_answer(
+                self.tutor,
+                self.scheduler,
+                payload,
+                on_chunk=lambda text: self._send('chunk', request_id, text),
+                session=session,
+                cancel_event=cancel_event,
+                deadline=deadline
+            )
+        finally:
+            self.cancels.release(request_id)
+            if session is not None:
+                session.busy = False
+        if session is not None:
+            self.sessions.commit(session)
+        self._send('complete', request_id, response, {
+            'session_turns': session.turns if session else 0,
+            'cancelled': cancel_event is not None and cancel_event.is_set(),
+            'truncated': deadline is not None and deadline.truncated,
+            'fitted': deadline is not None and deadline.fitted
+        })
+
+    def _handle_image(self, request_id: str, payload: dict):
+        profile = bool(payload.get('profile', False))
+        if 'shm' not in payload:
+            result = self.tutor.ask_image_question(payload['image_url'], payload['question'], profile=profile)
+            self._send('complete', request_id, result, {})
+            return
+
+        shm = shared_memory.SharedMemory(name=payload['shm'])
+        # The web server owns (and unlinks) the segment
+        resource_tracker.unregister(shm._name, 'shared_memory')
+        view = shm.buf[:payload['size']]
+        try:
+            result = self.tutor.ask_image_question(view, payload['question'], profile=profile)
+        finally:
+            view.release()
+            shm.close()
+        self._send('complete', request_id, result, {})
+
+    def _handle_image_batch(self, request_id: str, payload: dict):
+        segments, image_inputs = [], []
+        try:
+            for item in payload['images']:
+                if 'shm' in item:
+                    shm = shared_memory.SharedMemory(name=item['shm'])
+                    resource_tracker.unregister(shm._name, 'shared_memory')
+                    segments.append(shm)
+                    image_inputs.append(shm.buf[:item['size']])
+                else:
+                    image_inputs.append(item['image_url'])
+            # Each answer streams back as a ('chunk', id, (index, text)) as soon as it is done
+            results = self.tutor.ask_image_batch(
+                image_inputs,
+                [item['question'] for item in payload['images']],
+                max_tokens=int(payload.get('max_tokens', 300)),
+                on_result=lambda index, text: self._send('chunk', request_id, (index, text)),
+                profile=bool(payload.get('profile', False))
+            )
+        finally:
+            for view in image_inputs:
+                if isinstance(view, memoryview):
+                    view.release()
+            for shm in segments:
+                shm.close()
+        self._send('complete', request_id, results, {})
+
+    def _handle_cancel(self, request_id: str, payload: dict):
+        self._send('complete', request_id, self.cancels.cancel(payload['request_id']), {})
+
+    def _handle_embed(self, request_id: str, payload: dict):
+        vector = self.tutor.embed_question(payload['question'], payload.get('mode', 'input'))
+        self._send('complete', request_id, vector, {})
+
+    def _handle_record_answer(self, request_id: str, payload: dict):
+        session = self._acquire_session(payload)
+        if session is not None:
+            try:
+                self.tutor.record_session_answer(session, payload['question'], payload['answer'], payload['settings'])
+            finally:
+                session.busy = False
+            self.sessions.commit(session)
+        self._send('complete', request_id, None, {})
+
+    def _handle_drop_session(self, request_id: str, payload: dict):
+        dropped = self.sessions.drop(payload['session_id']) if self.sessions is not None else False
+        self._send('complete', request_id, dropped, {})
+
+    def _handle_stats(self, request_id: str, payload: dict):
+        tutor = self.tutor
+        self._send('complete', request_id, {
+            'pid': os.getpid(),
+            'loaded': tutor is not None,
+            'batch_scheduler': self.scheduler.get_stats() if self.scheduler else None,
+            'prefix_cache': tutor.prefix_cache.get_stats() if tutor else None,
+            'image_cache': tutor.image_cache.get_stats() if tutor else None,
+            'image_ingest': tutor.image_ingest.get_stats() if tutor else None,
+            'speculative': tutor.speculative.get_stats() if tutor else None,
+            'profiler': tutor.profiler.get_stats() if tutor else None,
+            'sessions': self.sessions.get_stats() if self.sessions else None,
+        }, {})
+
+    def _handle_metrics(self, request_id: str, payload: dict):
+        self._send('complete', request_id, metrics.REGISTRY.collect(), {})
+
+
+def run_worker(address: str, authkey: Optional[bytes], single_client: bool = False):
+    """
+    Listen on `address`, load the model in the background and serve one web server at a time.
+
+    With single_client=True (workers launched by the web server) the process
+    exits when that server disconnects instead of waiting for another one.
+    The connection carries pickles, so it always needs an authkey: off
+    loopback one must be given, on loopback one is generated and printed.
+    """
+    from config import get_settings
+
+    if not authkey:
+        if not is_loopback(parse_address(address)[0]):
+            raise SystemExit(f"❌ Refusing to listen on {address} without an authkey "
+                             f"(set --authkey, ${AUTHKEY_ENV} or INFERENCE_WORKER_AUTHKEY)")
+        authkey = os.urandom(16).hex().encode()
+        print(f"🔑 No authkey set; generated one for this worker: {authkey.decode()}\n"
+              f"   Give the web server INFERENCE_WORKER_AUTHKEY={authkey.decode()}", flush=True)
+
+    metrics.set_process("worker")
+    worker = InferenceWorker(get_settings())
+    listener = Listener(parse_address(address), authkey=authkey)
+    logger.info(f"🧠 Inference worker listening on {address} (pid {os.getpid()})")
+    threading.Thread(target=worker.load, name="worker-load", daemon=True).start()
+
+    try:
+        while True:
+            try:
+                conn = listener.accept()
+            except Exception as e:
+                logger.warning(f"⚠️ Rejected inference worker connection: {e}")
+                continue
+            if worker.serve(conn) or single_client:
+                logger.info("👋 Inference worker shutting down")
+                return
+    finally:
+        if worker.scheduler is not None:
+            worker.scheduler.stop()
+        listener.close()
+
+
+def run_benchmark(questions: int, max_tokens: int):
+    """Load the model in this process and time a few questions without any web server"""
+    from config import get_settings
+
+    worker = InferenceWorker(get_settings())
+    worker.load()
+    if worker.tutor is None:
+        raise SystemExit(f"Model failed to load: {worker.load_error}")
+
+    samples = [
+        "What is photosynthesis?",
+        "Explain the Pythagorean theorem with an example.",
+        "Why is the sky blue?",
+        "What causes the seasons on Earth?",
+        "How do vaccines work?",
+    ]
+    for i in range(questions):
+        question = samples[i % len(samples)]
+        first_chunk = []
+        start = time.time()
+        answer = generate_text_answer(
+            worker.tutor,
+            worker.scheduler,
+            {'question': question, 'max_tokens': max_tokens, 'deterministic': True},
+            on_chunk=lambda text: first_chunk.append(time.time()) if not first_chunk else None
+        )
+        elapsed = time.time() - start
+        ttft = first_chunk[0] - start if first_chunk else elapsed
+        print(f"⏱️ [{i + 1}/{questions}] {elapsed:.2f}s total, {ttft:.3f}s to first chunk, {len(answer)} chars")
+    if worker.scheduler is not None:
+        worker.scheduler.stop()
+
+
+# ----------------------------------------------------------------------
+# Web server side
+# ----------------------------------------------------------------------
+
+class WorkerRequest:
+    """Handle for one request sent to the worker; events use the GenerationRequest format"""
+
+    def __init__(self, request_id: str):
+        self.request_id = request_id
+        self.events = queue.Queue()
+        self.cleanup: Optional[Callable[[], None]] = None
+
+    def iter_events(self, sleep: Callable[[float], None], poll_interval: float = 0.01):
+        """Yield events until the request completes or fails, waiting with a cooperative `sleep`"""
+        while True:
+            try:
+                event = self.events.get_nowait()
+            except queue.Empty:
+                sleep(poll_interval)
+                continue
+            yield event
+            if event[0] in ('complete', 'error'):
+                return
+
+    def result(self, sleep: Callable[[float], None], timeout: Optional[float] = None):
+        """Wait for the final result, raising RuntimeError if the worker reported an error"""
+        deadline = time.time() + timeout if timeout else None
+        while True:
+            try:
+                event = self.events.get_nowait()
+            except queue.Empty:
+                if deadline is not None and time.time() > deadline:
+                    raise TimeoutError(f"Inference worker did not answer within {timeout}s")
+                sleep(0.01)
+                continue
+            if event[0] == 'complete':
+                return event[1]
+            if event[0] == 'error':
+                raise RuntimeError(event[1])
+
+
+class InferenceClient:
+    """
+    Launches (or connects to) the inference worker and routes its replies to WorkerRequests.
+
+    A supervisor thread restarts the worker if it exits; requests in flight at
+    that moment fail with an error instead of hanging.
+    """
+
+    def __init__(self, settings, on_status: Optional[Callable[..., None]] = None):
+        self.settings = settings
+        self.on_status = on_status
+        self.external_address = getattr(settings, 'inference_worker_address', '') or None
+        self.restart_delay = float(getattr(settings, 'inference_worker_restart_delay', 2.0))
+        self.max_failed_starts = int(getattr(settings, 'inference_worker_max_failed_starts', 3))
+
+        self.ready = False
+        self.failed: Optional[str] = None
+        self.info: dict = {}
+        self.restarts = 0
+
+        self._conn = None
+        self._process: Optional[subprocess.Popen] = None
+        self._pending = {}
+        self._lock = threading.Lock()
+        self._send_lock = threading.Lock()
+        self._stopping = False
+        self._thread = None
+
+    # -- lifecycle -----------------------------------------------------
+
+    def start(self):
+        self._thread = threading.Thread(target=self._supervise, name="inference-supervisor", daemon=True)
+        self._thread.start()
+
+    def wait_ready(self, timeout: Optional[float] = None, sleep: Callable[[float], None] = time.sleep) -> bool:
+        deadline = time.time() + timeout if timeout else None
+        while not self.ready and not self.failed:
+            if deadline is not None and time.time() > deadline:
+                return False
+            sleep(0.1)
+        return self.ready
+
+    def stop(self):
+        self._stopping = True
+        try:
+            self._send(('shutdown', None, None))
+        except Exception:
+            pass
+        if self._process is not None:
+            try:
+                self._process.wait(timeout=10)
+            except subprocess.TimeoutExpired:
+                self._process.kill()
+
+    def _supervise(self):
+        failed_starts = 0
+        while not self._stopping:
+            try:
+                self._connect()
+            except Exception as e:
+                logger.error(f"❌ Could not start inference worker: {e}")
+                self._reap_process()
+                failed_starts += 1
+            else:
+                was_ready = self._read_loop()
+                self.ready = False
+                self._fail_pending("Inference worker stopped while handling this request")
+                self._reap_process()
+                failed_starts = 0 if was_ready else failed_starts + 1
+
+            if self._stopping:
+                break
+            if failed_starts >= self.max_failed_starts:
+                self.failed = self.failed or "Inference worker failed to start"
+                logger.error(f"❌ Giving up on inference worker after {failed_starts} failed starts")
+                self._emit_status(f"❌ Model loading failed: {self.failed}")
+                break
+
+            self.restarts += 1
+            logger.warning(f"🔄 Restarting inference worker in {self.restart_delay:.0f}s (restart #{self.restarts})")
+            self._emit_status("🔄 AI model restarting...")
+            time.sleep(self.restart_delay)
+
+    def _connect(self):
+        if self.external_address:
+            authkey = getattr(self.settings, 'inference_worker_authkey', '').encode() or None
+            address = parse_address(self.external_address)
+            self._conn = self._connect_with_retry(address, authkey, timeout=30)
+            logger.info(f"🔗 Connected to inference worker at {self.external_address}")
+            return
+
+        authkey = os.urandom(16).hex().encode()
+        address = ("127.0.0.1", _free_port())
+        env = dict(os.environ, **{AUTHKEY_ENV: authkey.decode()})
+        self._process = subprocess.Popen(
+            [sys.executable, str(Path(__file__).resolve()), "--listen", f"{address[0]}:{address[1]}", "--single-client"],
+            env=env
+        )
+        logger.info(f"🧠 Started inference worker (pid {self._process.pid})")
+        self._conn = self._connect_with_retry(address, authkey, timeout=120)
+
+    def _connect_with_retry(self, address, authkey, timeout: float):
+        deadline = time.time() + timeout
+        while True:
+            if self._process is not None and self._process.poll() is not None:
+                raise RuntimeError(f"worker exited with code {self._process.returncode}")
+            try:
+                return Client(address, authkey=authkey)
+            except (ConnectionRefusedError, OSError):
+                if time.time() > deadline:
+                    raise
+                time.sleep(0.2)
+
+    def _reap_process(self):
+        if self._process is None:
+            return
+        try:
+            # A worker whose connection closed normally exits on its own
+            self._process.wait(timeout=5)
+        except subprocess.TimeoutExpired:
+            self._process.terminate()
+            try:
+                self._process.wait(timeout=10)
+            except subprocess.TimeoutExpired:
+                self._process.kill()
+        logger.warning(f"⚠️ Inference worker exited with code {self._process.returncode}")
+        self._process = None
+
+    def _read_loop(self) -> bool:
+        """Route worker messages until the connection drops; returns whether the worker became ready"""
+        was_ready = False
+        while True:
+            try:
+                message = self._conn.recv()
+            except (EOFError, OSError):
+                break
+
+            kind, request_id = message[0], message[1]
+            if kind == 'status':
+                self._emit_status(*message[2:])
+            elif kind == 'ready':
+                self.info = message[2]
+                self.ready = was_ready = True
+                self.failed = None
+                logger.info(f"✅ Inference worker ready (pid {self.info.get('pid')})")
+            elif kind == 'failed':
+                self.failed = message[2]
+                self._emit_status(f"❌ Model loading failed: {message[2]}")
+            else:
+                with self._lock:
+                    handle = self._pending.get(request_id)
+                    if handle is not None and kind in ('complete', 'error'):
+                        del self._pending[request_id]
+                if handle is not None:
+                    if kind in ('complete', 'error') and handle.cleanup is not None:
+                        handle.cleanup()
+                    handle.events.put(tuple(message[:1]) + tuple(message[2:]))
+
+        with self._send_lock:
+            try:
+                self._conn.close()
+            except Exception:
+                pass
+            self._conn = None
+        return was_ready
+
+    def _fail_pending(self, message: str):
+        with self._lock:
+            pending, self._pending = self._pending, {}
+        for handle in pending.values():
+            if handle.cleanup is not None:
+                handle.cleanup()
+            handle.events.put(('error', message))
+
+    def _emit_status(self, message: str, progress: Optional[dict] = None):
+        """Forward a loading message; `progress` (weight shards/bytes loaded) only accompanies shard updates"""
+        if self.on_status is not None:
+            try:
+                if progress:
+                    self.on_status(message, progress)
+                else:
+                    self.on_status(message)
+            except Exception as e:
+                logger.warning(f"⚠️ Failed to forward worker status: {e}")
+
+    # -- requests ------------------------------------------------------
+
+    def _send(self, message):
+        with self._send_lock:
+            if self._conn is None:
+                raise RuntimeError("Inference worker is not running")
+            self._conn.send(message)
+
+    def request(self, kind: str, payload: dict, request_id: Optional[str] = None) -> WorkerRequest:
+        handle = WorkerRequest(request_id or str(uuid.uuid4()))
+        return self._submit(kind, payload, handle)
+
+    def _submit(self, kind: str, payload: dict, handle: WorkerRequest) -> WorkerRequest:
+        with self._lock:
+            self._pending[handle.request_id] = handle
+        try:
+            self._send((kind, handle.request_id, payload))
+        except Exception as e:
+            with self._lock:
+                self._pending.pop(handle.request_id, None)
+            if handle.cleanup is not None:
+                handle.cleanup()
+            handle.events.put(('error', f"Inference worker unavailable: {e}"))
+        return handle
+
+    def generate(self, payload: dict, request_id: Optional[str] = None) -> WorkerRequest:
+        return self.request('text', payload, request_id)
+
+    def cancel(self, request_id: str) -> WorkerRequest:
+        """Stop a text request started with generate(); it still completes, with the text so far"""
+        return self.request('cancel', {'request_id': request_id})
+
+    def ask_image_question(self, image_input, question: str, profile: bool = False) -> WorkerRequest:
+        """Send an image question; binary images travel through a shared memory segment"""
+        handle = WorkerRequest(str(uuid.uuid4()))
+        if isinstance(image_input, (bytes, bytearray, memoryview)):
+            data = memoryview(image_input)
+            shm = shared_memory.SharedMemory(create=True, size=max(1, data.nbytes))
+            shm.buf[:data.nbytes] = data.cast('B')
+
+            def release():
+                shm.close()
+                shm.unlink()
+
+            handle.cleanup = release
+            payload = {'shm': shm.name, 'size': data.nbytes, 'question': question, 'profile': profile}
+        else:
+            payload = {'image_url': image_input, 'question': question, 'profile': profile}
+        return self._submit('image', payload, handle)
+
+    def ask_image_batch(self, image_inputs: list, questions: list, max_tokens: int = 300,
+                        profile: bool = False) -> WorkerRequest:
+        """Send several image questions at once; chunks are (index, text) as answers finish"""
+        handle = WorkerRequest(str(uuid.uuid4()))
+        segments, items = [], []
+        for image_input, question in zip(image_inputs, questions):
+            if isinstance(image_input, (bytes, bytearray, memoryview)):
+                data = memoryview(image_input)
+                shm = shared_memory.SharedMemory(create=True, size=max(1, data.nbytes))
+                shm.buf[:data.nbytes] = data.cast('B')
+                segments.append(shm)
+                items.append({'shm': shm.name, 'size': data.nbytes, 'question': question})
+            else:
+                items.append({'image_url': image_input, 'question': question})
+
+        def release():
+            for shm in segments:
+                shm.close()
+                shm.unlink()
+
+        handle.cleanup = release
+        payload = {'images': items, 'max_tokens': max_tokens, 'profile': profile}
+        return self._submit('image_batch', payload, handle)
+
+    def get_stats(self) -> dict:
+        return {
+            'ready': self.ready,
+            'pid': self.info.get('pid'),
+            'restarts': self.restarts,
+            'pending_requests': len(self._pending),
+            'external': self.external_address is not None,
+            'failed': self.failed,
+        }
+
+
+def _free_port() -> int:
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser(description="AI Tutor inference worker")
+    parser.add_argument("--listen", default="127.0.0.1:6001", help="host:port to accept the web server on")
+    parser.add_argument("--authkey", default=None, help=f"connection secret (default: ${AUTHKEY_ENV} or settings)")
+    parser.add_argument("--single-client", action="store_true", help="exit when the first web server disconnects")
+    parser.add_argument("--benchmark", action="store_true", help="time a few questions in-process and exit")
+    parser.add_argument("--questions", type=int, default=5)
+    parser.add_argument("--max-tokens", type=int, default=128)
+    args = parser.parse_args()
+
+    if args.benchmark:
+        run_benchmark(args.questions, args.max_tokens)
+    else:
+        from config import get_settings
+        authkey = args.authkey or os.environ.get(AUTHKEY_ENV) or getattr(get_settings(), 'inference_worker_authkey', '')
+        run_worker(args.listen, authkey.encode() or None, single_client=args.single_client)
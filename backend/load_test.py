@@ -0,0 +1,435 @@
+"""
+End-to-end load test - simulated students speaking the app's Socket.IO protocol
+
+    python load_test.py run --url http://localhost:5000 --clients 5 10 20 40 --requests 5
+    python load_test.py run --url http://localhost:5001 --clients 10 --image-ratio 0.2 --json
+    python load_test.py replay traces.jsonl --url http://localhost:5000 --speed 4
+
+`run` opens N clients per level; each asks questions one after another
+(`ask_ai_tutor` -> text_response_start/chunk/complete, or
+`ask_image_question` -> image_analysis_result) with a think time in between.
+`replay` re-issues a trace recorded by the server (TRACE_FILE in .env) at
+1x-10x the original pace. Both report time to first chunk, total latency,
+error rate and dropped connections, and `run` reports the largest level
+that still meets the latency target.
+"""
+import argparse
+import io
+import json
+import random
+import threading
+import time
+from collections import defaultdict
+from typing import Dict, List, Optional
+
+import socketio
+
+from bench_connections import summarize
+from traces import load_traces
+
+SUBJECTS = ["General", "Mathematics", "Physics", "Biology", "Chemistry", "History", "Computer Science"]
+LEVELS = ["elementary", "middle_school", "high_school", "university"]
+QUESTIONS = [
+    "What is photosynthesis?",
+    "Why is the sky blue?",
+    "How do I solve 2x + 3 = 11?",
+    "What caused the First World War?",
+    "Can you explain Newton's second law with an example?",
+    "What is the difference between mitosis and meiosis?",
+    "How does a for loop work in Python?",
+    "What is a covalent bond?",
+    "Why do we have seasons on Earth?",
+    "What is the Pythagorean theorem used for?",
+    "How do vaccines train the immune system?",
+    "What is the difference between weather and climate?",
+]
+IMAGE_QUESTIONS = ["What is shown in this picture?", "Can you explain this diagram?", "What does this graph tell us?"]
+
+# Filler used when a replayed trace only recorded the question length
+FILLER = (
+    "Please help me understand this part of my homework, the textbook says that energy is conserved "
+    "in a closed system but I do not see why the ball stops bouncing after a while. "
+)
+
+
+class StudentClient:
+    """One Socket.IO connection that asks one question at a time, like the renderer"""
+
+    def __init__(self, url: str, transports: List[str], timeout: float):
+        self.url = url
+        self.transports = transports
+        self.timeout = timeout
+        self.sio = socketio.Client(reconnection=False)
+        self.connect_time: Optional[float] = None
+        self.connect_error: Optional[str] = None
+        self.dropped = False
+        self._closing = False
+        self._done = threading.Event()
+        self._current: Optional[dict] = None
+
+        self.sio.on('text_response_start', self._on_start)
+        self.sio.on('text_response_chunk', self._on_chunk)
+        self.sio.on('text_response_complete', self._on_complete)
+        self.sio.on('image_analysis_result', self._on_image_result)
+        self.sio.on('error', self._on_error)
+        self.sio.on('disconnect', self._on_disconnect)
+
+    def connect(self):
+        start = time.perf_counter()
+        try:
+            self.sio.connect(self.url, transports=self.transports, wait_timeout=30)
+            self.connect_time = time.perf_counter() - start
+        except Exception as e:
+            self.connect_error = str(e)
+
+    @property
+    def connected(self) -> bool:
+        return self.connect_error is None and not self.dropped
+
+    # -- protocol events -----------------------------------------------
+
+    def _on_start(self, data=None):
+        if self._current is not None:
+            self._current['message_id'] = (data or {}).get('message_id')
+
+    def _on_chunk(self, data=None):
+        result = self._current
+        if result is None:
+            return
+        if result['ttfc'] is None:
+            result['ttfc'] = time.perf_counter() - result['_start']
+        result['chunks'] += 1
+        result['chars'] += len((data or {}).get('content', ''))
+
+    def _on_complete(self, data=None):
+        if self._current is not None:
+            self._current['cached'] = bool((data or {}).get('cached', False))
+            self._finish()
+
+    def _on_image_result(self, data=None):
+        result = self._current
+        if result is not None:
+            # Image answers arrive in one piece, so the first chunk is the whole result
+            result['ttfc'] = time.perf_counter() - result['_start']
+            result['chars'] = len(str((data or {}).get('result', '')))
+            self._finish()
+
+    def _on_error(self, data=None):
+        if self._current is not None:
+            self._current['error'] = (data or {}).get('message', 'error')
+            self._finish()
+
+    def _on_disconnect(self, *args):
+        if not self._closing:
+            self.dropped = True
+            if self._current is not None:
+                self._current['error'] = 'connection dropped'
+            self._finish()
+
+    def _finish(self):
+        if self._current is not None and self._current['total'] is None:
+            self._current['total'] = time.perf_counter() - self._current['_start']
+        self._done.set()
+
+    # -- requests ------------------------------------------------------
+
+    def _request(self, kind: str, event: str, payload: dict) -> dict:
+        result = {
+            'kind': kind, 'ttfc': None, 'total': None, 'chunks': 0, 'chars': 0,
+            'cached': False, 'error': None, '_start': time.perf_counter(),
+        }
+        if not self.connected:
+            result['error'] = self.connect_error or 'not connected'
+            return result
+        self._current = result
+        self._done.clear()
+        try:
+            self.sio.emit(event, payload)
+            if not self._done.wait(self.timeout):
+                result['error'] = 'timeout'
+        except Exception as e:
+            result['error'] = str(e)
+        finally:
+            self._current = None
+        del result['_start']
+        return result
+
+    def ask(self, message: str, settings: dict) -> dict:
+        return self._request('text', 'ask_ai_tutor', {'message': message, 'settings': settings})
+
+    def ask_image(self, image: bytes, image_type: str, question: str) -> dict:
+        return self._request('image', 'ask_image_question', {
+            'image': image, 'image_type': image_type, 'question': question
+        })
+
+    def close(self):
+        self._closing = True
+        try:
+            self.sio.disconnect()
+        except Exception:
+            pass
+
+
+def synthetic_image(approx_bytes: int, seed: int = 0) -> bytes:
+    """A noisy JPEG of roughly `approx_bytes` (noise does not compress, so size tracks pixel count)"""
+    from PIL import Image
+
+    rng = random.Random(seed)
+    side = max(32, int((max(approx_bytes, 1024) / 1.2) ** 0.5))
+    for _ in range(2):
+        pixels = rng.randbytes(side * side * 3)
+        buffer = io.BytesIO()
+        Image.frombytes('RGB', (side, side), pixels).save(buffer, format='JPEG', quality=85)
+        data = buffer.getvalue()
+        # One correction step is close enough for load purposes
+        side = max(32, int(side * (approx_bytes / len(data)) ** 0.5))
+    return data
+
+
+def synthetic_question(chars: int, rng: random.Random) -> str:
+    if chars <= 0:
+        return rng.choice(QUESTIONS)
+    text = (FILLER * (chars // len(FILLER) + 1))[:chars]
+    return text.rstrip() + "?"
+
+
+def connect_all(clients: List[StudentClient], timeout: float = 60.0):
+    threads = [threading.Thread(target=c.connect, daemon=True) for c in clients]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(timeout)
+
+
+def close_all(clients: List[StudentClient]):
+    # Disconnects can block on the polling transport; do not let one stall the report
+    threads = [threading.Thread(target=c.close, daemon=True) for c in clients]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(1.0)
+
+
+def report(results: List[dict], clients: List[StudentClient], wall: float) -> dict:
+    """Latency percentiles, error rate and throughput for one load level"""
+
+    def stats(subset: List[dict]) -> dict:
+        ok = [r for r in subset if r['error'] is None]
+        return {
+            'requests': len(subset),
+            'completed': len(ok),
+            'errors': len(subset) - len(ok),
+            'error_rate': round((len(subset) - len(ok)) / len(subset), 4) if subset else 0.0,
+            'cached': sum(r['cached'] for r in ok),
+            'ttfc': summarize([r['ttfc'] for r in ok if r['ttfc'] is not None]),
+            'total': summarize([r['total'] for r in ok]),
+        }
+
+    summary = stats(results)
+    errors = defaultdict(int)
+    for r in results:
+        if r['error'] is not None:
+            errors[r['error'][:80]] += 1
+    summary.update({
+        'clients': len(clients),
+        'connect_failures': sum(c.connect_error is not None for c in clients),
+        'dropped_connections': sum(c.dropped for c in clients),
+        'connect': summarize([c.connect_time for c in clients if c.connect_time is not None]),
+        'duration_s': round(wall, 2),
+        'throughput_rps': round(summary['completed'] / wall, 3) if wall > 0 else 0.0,
+        'chars_per_s': round(sum(r['chars'] for r in results if r['error'] is None) / wall, 1) if wall > 0 else 0.0,
+        'by_kind': {kind: stats([r for r in results if r['kind'] == kind])
+                    for kind in sorted({r['kind'] for r in results})},
+        'error_messages': dict(errors),
+    })
+    return summary
+
+
+def run_level(url: str, clients: int, requests: int, think: float, max_tokens: int,
+              image_ratio: float, timeout: float, transports: List[str], seed: int) -> dict:
+    pool = [StudentClient(url, transports, timeout) for _ in range(clients)]
+    connect_all(pool)
+    images = [synthetic_image(200_000, seed=i) for i in range(3)] if image_ratio > 0 else []
+    results: List[dict] = []
+    lock = threading.Lock()
+
+    def student(index: int, client: StudentClient):
+        rng = random.Random(seed * 100_003 + index)
+        settings = {
+            'subject': rng.choice(SUBJECTS),
+            'language': 'English',
+            'level': rng.choice(LEVELS),
+            'response_style': rng.choice(['regular', 'effective']),
+            'max_tokens': max_tokens,
+        }
+        # Stagger the first question so the level ramps up rather than arriving in one burst
+        time.sleep(rng.uniform(0, think))
+        for _ in range(requests):
+            if images and rng.random() < image_ratio:
+                result = client.ask_image(rng.choice(images), 'image/jpeg', rng.choice(IMAGE_QUESTIONS))
+            else:
+                result = client.ask(rng.choice(QUESTIONS), settings)
+            with lock:
+                results.append(result)
+            if not client.connected:
+                break
+            time.sleep(rng.expovariate(1 / think) if think > 0 else 0)
+
+    start = time.perf_counter()
+    threads = [threading.Thread(target=student, args=(i, c), daemon=True) for i, c in enumerate(pool)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    wall = time.perf_counter() - start
+    close_all(pool)
+    return report(results, pool, wall)
+
+
+def replay(url: str, records: List[dict], speed: float, timeout: float, transports: List[str],
+           max_tokens: Optional[int] = None, seed: int = 0) -> dict:
+    """Re-issue recorded requests, each client on its own connection, `speed` times faster"""
+    by_client: Dict[str, List[dict]] = defaultdict(list)
+    for record in records:
+        by_client[record.get('client', '?')].append(record)
+    pool = {client: StudentClient(url, transports, timeout) for client in by_client}
+    connect_all(list(pool.values()))
+
+    images: Dict[int, bytes] = {}
+    for record in records:
+        if record.get('kind') == 'image':
+            # Bucket to 50KB so similar uploads share one synthetic image
+            bucket = max(1, round(record.get('image_bytes', 200_000) / 50_000)) * 50_000
+            if bucket not in images:
+                images[bucket] = synthetic_image(bucket, seed=len(images))
+            record['_image'] = images[bucket]
+
+    results: List[dict] = []
+    lags: List[float] = []
+    lock = threading.Lock()
+    start = time.perf_counter() + 1.0  # Let every thread reach its first wait
+
+    def student(client: StudentClient, requests: List[dict]):
+        rng = random.Random(seed)
+        for record in requests:
+            due = start + record.get('t', 0) / speed
+            delay = due - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+            lag = max(0.0, -delay)  # This client's previous answer ran past the recorded gap
+            question = record.get('question') or synthetic_question(record.get('question_chars', 0), rng)
+            if record.get('kind') == 'image':
+                result = client.ask_image(record['_image'], record.get('image_type') or 'image/jpeg', question)
+            else:
+                settings = dict(record.get('settings') or {})
+                if max_tokens is not None:
+                    settings['max_tokens'] = max_tokens
+                result = client.ask(question, settings)
+            with lock:
+                results.append(result)
+                lags.append(lag)
+            if not client.connected:
+                break
+
+    threads = [threading.Thread(target=student, args=(pool[c], r), daemon=True) for c, r in by_client.items()]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    wall = time.perf_counter() - start
+    close_all(list(pool.values()))
+    summary = report(results, list(pool.values()), wall)
+    summary['speed'] = speed
+    summary['trace_span_s'] = round(max((r.get('t', 0) for r in records), default=0), 2)
+    summary['schedule_lag'] = summarize(lags)
+    return summary
+
+
+def print_level(label: str, summary: dict):
+    ttfc, total = summary['ttfc'] or {}, summary['total'] or {}
+    print(f"{label}: {summary['completed']}/{summary['requests']} ok "
+          f"({summary['error_rate']:.1%} errors, {summary['dropped_connections']} dropped, "
+          f"{summary['connect_failures']} failed to connect), {summary['throughput_rps']:.2f} req/s")
+    if ttfc:
+        print(f"    first chunk p50 {ttfc['p50_ms']:.0f}ms  p95 {ttfc['p95_ms']:.0f}ms  p99 {ttfc['p99_ms']:.0f}ms")
+    if total:
+        print(f"    total       p50 {total['p50_ms']:.0f}ms  p95 {total['p95_ms']:.0f}ms  p99 {total['p99_ms']:.0f}ms")
+    for message, count in summary['error_messages'].items():
+        print(f"    ❌ {count}x {message}")
+
+
+def within_target(summary: dict, ttfc_ms: float, max_error_rate: float) -> bool:
+    return (summary['completed'] > 0
+            and summary['error_rate'] <= max_error_rate
+            and summary['dropped_connections'] == 0
+            and summary['ttfc'].get('p95_ms', float('inf')) <= ttfc_ms)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Socket.IO load test for the AI Tutor backend")
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    def common(sub):
+        sub.add_argument('--url', default='http://localhost:5000')
+        sub.add_argument('--timeout', type=float, default=300.0, help="Seconds to wait for one answer")
+        sub.add_argument('--transports', nargs='+', default=['polling', 'websocket'])
+        sub.add_argument('--seed', type=int, default=0)
+        sub.add_argument('--json', action='store_true', help="Print results as JSON")
+
+    run_parser = commands.add_parser('run', help="Synthetic students at increasing concurrency")
+    common(run_parser)
+    run_parser.add_argument('--clients', type=int, nargs='+', default=[1, 5, 10])
+    run_parser.add_argument('--requests', type=int, default=3, help="Questions per client")
+    run_parser.add_argument('--think', type=float, default=2.0, help="Mean seconds between a client's questions")
+    run_parser.add_argument('--max-tokens', type=int, default=128)
+    run_parser.add_argument('--image-ratio', type=float, default=0.0, help="Fraction of image questions")
+    run_parser.add_argument('--target-ttfc-ms', type=float, default=3000.0, help="p95 first-chunk latency target")
+    run_parser.add_argument('--max-error-rate', type=float, default=0.01)
+
+    replay_parser = commands.add_parser('replay', help="Replay a recorded trace")
+    common(replay_parser)
+    replay_parser.add_argument('trace')
+    replay_parser.add_argument('--speed', type=float, default=1.0, help="1 = recorded pace, 10 = ten times faster")
+    replay_parser.add_argument('--max-tokens', type=int, help="Override the recorded max_tokens")
+    replay_parser.add_argument('--limit', type=int, help="Only the first N requests")
+
+    args = parser.parse_args()
+
+    if args.command == 'replay':
+        if not 1.0 <= args.speed <= 10.0:
+            parser.error("--speed must be between 1 and 10")
+        records = load_traces(args.trace)[:args.limit]
+        if not records:
+            parser.error(f"No requests in {args.trace}")
+        if not args.json:
+            print(f"📼 Replaying {len(records)} requests from {len({r.get('client') for r in records})} clients "
+                  f"at {args.speed:g}x")
+        summary = replay(args.url, records, args.speed, args.timeout, args.transports, args.max_tokens, args.seed)
+        if args.json:
+            print(json.dumps(summary, indent=2))
+        else:
+            print_level(f"replay {args.speed:g}x", summary)
+            print(f"    schedule lag p95 {summary['schedule_lag']['p95_ms']:.0f}ms")
+        return
+
+    results = []
+    capacity = 0
+    for clients in args.clients:
+        summary = run_level(args.url, clients, args.requests, args.think, args.max_tokens,
+                            args.image_ratio, args.timeout, args.transports, args.seed)
+        results.append(summary)
+        if not args.json:
+            print_level(f"{clients:5d} clients", summary)
+        if within_target(summary, args.target_ttfc_ms, args.max_error_rate):
+            capacity = max(capacity, clients)
+    if args.json:
+        print(json.dumps({'levels': results, 'capacity_clients': capacity}, indent=2))
+    elif capacity:
+        print(f"✅ Up to {capacity} clients stay within p95 first chunk {args.target_ttfc_ms:.0f}ms "
+              f"and {args.max_error_rate:.0%} errors")
+    else:
+        print(f"⚠️ No level met p95 first chunk {args.target_ttfc_ms:.0f}ms with {args.max_error_rate:.0%} errors")
+
+
+if __name__ == '__main__':
+    main()
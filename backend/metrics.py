@@ -0,0 +1,427 @@
+"""
+Prometheus-style metrics (text exposition format) for the tutor backend
+
+Counters, gauges and histograms live in one process-wide REGISTRY. Recording
+is a dict lookup, a bisect and a few additions under a lock, so it stays on
+in production. Values that already exist elsewhere (cache hit counts, model
+memory, connections) are read by collectors only when /metrics is scraped.
+The inference worker sends its collected families to the web server, which
+renders them together with its own.
+"""
+import logging
+import os
+import threading
+import time
+from bisect import bisect_left
+from typing import Callable, Dict, Iterable, List, Optional, Sequence, Tuple
+
+logger = logging.getLogger(__name__)
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0, 300.0)
+TOKEN_BUCKETS = (8, 16, 32, 64, 128, 256, 512, 1024, 2048, 4096)
+
+# (sample name, labels, value)
+Sample = Tuple[str, Dict[str, str], float]
+# (name, type, help, samples)
+Family = Tuple[str, str, str, List[Sample]]
+
+
+class _Metric:
+    kind = ""
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._children: Dict[tuple, object] = {}
+        self._lock = threading.Lock()
+        if not self.labelnames:
+            self._default = self.labels()
+
+    def labels(self, *values, **labels):
+        """The child for one label combination (keep it around on hot paths)"""
+        key = tuple(str(v) for v in values) or tuple(str(labels[name]) for name in self.labelnames)
+        child = self._children.get(key)
+        if child is None:
+            with self._lock:
+                child = self._children.setdefault(key, self._new_child())
+        return child
+
+    def _new_child(self):
+        raise NotImplementedError
+
+    def collect(self) -> Family:
+        samples = []
+        for key, child in list(self._children.items()):
+            samples.extend(self._samples(dict(zip(self.labelnames, key)), child))
+        return self.name, self.kind, self.documentation, samples
+
+
+class _Value:
+    def __init__(self):
+        self.value = 0.0
+        self._lock = threading.Lock()
+
+    def inc(self, amount: float = 1.0):
+        with self._lock:
+            self.value += amount
+
+    def dec(self, amount: float = 1.0):
+        with self._lock:
+            self.value -= amount
+
+    def set(self, value: float):
+        self.value = float(value)
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def _new_child(self):
+        return _Value()
+
+    def inc(self, amount: float = 1.0):
+        self._default.inc(amount)
+
+    def _samples(self, labels, child):
+        return [(self.name + "_total", labels, child.value)]
+
+
+class Gauge(_Metric):
+    kind = "gauge"
+
+    def _new_child(self):
+        return _Value()
+
+    def set(self, value: float):
+        self._default.set(value)
+
+    def inc(self, amount: float = 1.0):
+        self._default.inc(amount)
+
+    def dec(self, amount: float = 1.0):
+        self._default.dec(amount)
+
+    def _samples(self, labels, child):
+        return [(self.name, labels, child.value)]
+
+
+class _HistogramValue:
+    def __init__(self, buckets: Tuple[float, ...]):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)  # Last slot is +Inf
+        self.sum = 0.0
+        self._lock = threading.Lock()
+
+    def observe(self, value: float):
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            self.counts[index] += 1
+            self.sum += value
+
+    def time(self):
+        return _Timer(self)
+
+
+class _Timer:
+    def __init__(self, target):
+        self.target = target
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.target.observe(time.perf_counter() - self.start)
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = (),
+                 buckets: Sequence[float] = LATENCY_BUCKETS):
+        self.buckets = tuple(sorted(buckets))
+        super().__init__(name, documentation, labelnames)
+
+    def _new_child(self):
+        return _HistogramValue(self.buckets)
+
+    def observe(self, value: float):
+        self._default.observe(value)
+
+    def time(self):
+        return self._default.time()
+
+    def _samples(self, labels, child):
+        with child._lock:
+            counts, total = list(child.counts), child.sum
+        samples, cumulative = [], 0
+        for bound, count in zip(self.buckets + (float('inf'),), counts):
+            cumulative += count
+            samples.append((self.name + "_bucket", dict(labels, le=_format_value(bound)), cumulative))
+        samples.append((self.name + "_sum", labels, total))
+        samples.append((self.name + "_count", labels, cumulative))
+        return samples
+
+
+class Registry:
+    def __init__(self):
+        self._metrics: Dict[str, _Metric] = {}
+        self._collectors: Dict[str, Callable[[], Iterable[Family]]] = {}
+        self._lock = threading.Lock()
+
+    def _register(self, cls, name, documentation, labelnames, **kwargs):
+        with self._lock:
+            metric = self._metrics.get(name)
+            if metric is None:
+                metric = self._metrics[name] = cls(name, documentation, labelnames, **kwargs)
+            return metric
+
+    def counter(self, name: str, documentation: str, labelnames: Sequence[str] = ()) -> Counter:
+        return self._register(Counter, name, documentation, labelnames)
+
+    def gauge(self, name: str, documentation: str, labelnames: Sequence[str] = ()) -> Gauge:
+        return self._register(Gauge, name, documentation, labelnames)
+
+    def histogram(self, name: str, documentation: str, labelnames: Sequence[str] = (),
+                  buckets: Sequence[float] = LATENCY_BUCKETS) -> Histogram:
+        return self._register(Histogram, name, documentation, labelnames, buckets=buckets)
+
+    def add_collector(self, name: str, collector: Callable[[], Iterable[Family]]):
+        """Call `collector` on every scrape; registering the same name again replaces it"""
+        with self._lock:
+            self._collectors[name] = collector
+
+    def collect(self) -> List[Family]:
+        families = [metric.collect() for metric in list(self._metrics.values())]
+        for name, collector in list(self._collectors.items()):
+            try:
+                families.extend(collector())
+            except Exception as e:
+                logger.warning(f"⚠️ Metrics collector {name} failed: {e}")
+        return families
+
+
+def _format_value(value: float) -> str:
+    if value == float('inf'):
+        return "+Inf"
+    if value == float('-inf'):
+        return "-Inf"
+    if value != value:
+        return "NaN"
+    return repr(float(value)) if not float(value).is_integer() else str(int(value)) + ".0"
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def render(families: Iterable[Family]) -> str:
+    """
+    Text exposition format. Families with the same name (server + worker) are
+    merged, and identical samples are added up: both processes define every
+    tutor metric but each records only the stages it runs.
+    """
+    merged: Dict[str, tuple] = {}
+    for name, kind, documentation, samples in families:
+        if name not in merged:
+            merged[name] = (kind, documentation, {})
+        values = merged[name][2]
+        for sample_name, labels, value in samples:
+            key = (sample_name, tuple(labels.items()))
+            values[key] = values.get(key, 0) + value
+
+    lines = []
+    for name, (kind, documentation, values) in merged.items():
+        lines.append(f"# HELP {name} {documentation}")
+        lines.append(f"# TYPE {name} {kind}")
+        for (sample_name, labels), value in values.items():
+            label_text = ",".join(f'{k}="{_escape(str(v))}"' for k, v in labels)
+            lines.append(f"{sample_name}{{{label_text}}} {_format_value(value)}" if label_text
+                         else f"{sample_name} {_format_value(value)}")
+    return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+
+# Which process these metrics come from ("server", or "worker" in the inference worker)
+PROCESS = {"name": "server"}
+
+
+def set_process(name: str):
+    PROCESS["name"] = name
+
+
+# -- Tutor metrics -------------------------------------------------------
+
+STAGE_SECONDS = REGISTRY.histogram(
+    "tutor_stage_seconds",
+    "Time spent in each stage of a request (queue, template, prefill, decode, detokenize, emit, ...)",
+    ("stage",)
+)
+REQUEST_SECONDS = REGISTRY.histogram("tutor_request_seconds", "End-to-end request latency", ("kind",))
+FIRST_CHUNK_SECONDS = REGISTRY.histogram(
+    "tutor_time_to_first_chunk_seconds", "From receiving a text question to emitting its first chunk"
+)
+REQUESTS = REGISTRY.counter("tutor_requests", "Requests by kind and outcome", ("kind", "outcome"))
+TOKENS_GENERATED = REGISTRY.counter("tutor_generated_tokens", "Tokens generated", ("path",))
+PROMPT_TOKENS = REGISTRY.counter("tutor_prompt_tokens", "Prompt tokens processed", ("path",))
+RESPONSE_TOKENS = REGISTRY.histogram(
+    "tutor_response_tokens", "Tokens generated per answer", ("path",), buckets=TOKEN_BUCKETS
+)
+CANCELLED_REQUESTS = REGISTRY.counter(
+    "tutor_cancelled_requests", "Generations stopped by cancel_generation or a disconnect", ("path",)
+)
+CANCELLED_TOKENS = REGISTRY.counter(
+    "tutor_cancelled_tokens", "Tokens generated for answers that were then cancelled", ("path",)
+)
+SAVED_TOKENS = REGISTRY.counter(
+    "tutor_cancel_saved_tokens", "Token budget left unspent because its answer was cancelled", ("path",)
+)
+IMAGES_REJECTED = REGISTRY.counter(
+    "tutor_images_rejected", "Images refused before decoding for breaking the byte or pixel limit", ("reason",)
+)
+TRUNCATED_REQUESTS = REGISTRY.counter(
+    "tutor_deadline_truncated", "Answers stopped early to stay within their deadline", ("path",)
+)
+
+QUEUE = STAGE_SECONDS.labels(stage="queue")
+ADMISSION = STAGE_SECONDS.labels(stage="admission")
+BATCH_QUEUE = STAGE_SECONDS.labels(stage="batch_queue")
+TEMPLATE = STAGE_SECONDS.labels(stage="template")
+PREFILL = STAGE_SECONDS.labels(stage="prefill")
+DECODE = STAGE_SECONDS.labels(stage="decode")
+DETOKENIZE = STAGE_SECONDS.labels(stage="detokenize")
+EMIT = STAGE_SECONDS.labels(stage="emit")
+IMAGE_PREPROCESS = STAGE_SECONDS.labels(stage="image_preprocess")
+IMAGE_GENERATE = STAGE_SECONDS.labels(stage="image_generate")
+IMAGE_DECODE = STAGE_SECONDS.labels(stage="image_decode")
+
+
+def record_generation(path: str, prompt_tokens: int, tokens: int, prefill: Optional[float] = None,
+                      decode: Optional[float] = None, detokenize: Optional[float] = None):
+    """Stage timings and token counts of one finished text generation"""
+    if prefill is not None:
+        PREFILL.observe(prefill)
+    if decode is not None:
+        DECODE.observe(decode)
+    if detokenize is not None:
+        DETOKENIZE.observe(detokenize)
+    PROMPT_TOKENS.labels(path).inc(prompt_tokens)
+    TOKENS_GENERATED.labels(path).inc(tokens)
+    RESPONSE_TOKENS.labels(path).observe(tokens)
+
+
+def record_cancelled(path: str, tokens: int, max_tokens: int):
+    CANCELLED_REQUESTS.labels(path).inc()
+    CANCELLED_TOKENS.labels(path).inc(tokens)
+    SAVED_TOKENS.labels(path).inc(max(0, max_tokens - tokens))
+
+
+def record_truncated(path: str):
+    TRUNCATED_REQUESTS.labels(path).inc()
+
+
+# -- Collectors ----------------------------------------------------------
+
+def gauge_family(name: str, documentation: str, samples: Iterable[Tuple[Dict[str, str], float]]) -> Family:
+    return name, "gauge", documentation, [(name, labels, value) for labels, value in samples]
+
+
+def counter_family(name: str, documentation: str, samples: Iterable[Tuple[Dict[str, str], float]]) -> Family:
+    return name, "counter", documentation, [(name + "_total", labels, value) for labels, value in samples]
+
+
+def cache_families(caches: Dict[str, Optional[dict]]) -> List[Family]:
+    """Hit/miss counters and hit ratios from the caches' get_stats() dicts"""
+    hits, misses, ratios = [], [], []
+    for name, stats in caches.items():
+        if not stats:
+            continue
+        for suffix, hit_key, miss_key in (("", "hits", "misses"),
+                                          ("_pixels", "pixel_hits", "pixel_misses"),
+                                          ("_features", "feature_hits", "feature_misses")):
+            if hit_key not in stats or miss_key not in stats:
+                continue
+            labels = {"cache": name + suffix}
+            hits.append((labels, stats[hit_key]))
+            misses.append((labels, stats[miss_key]))
+            lookups = stats[hit_key] + stats[miss_key]
+            ratios.append((labels, stats[hit_key] / lookups if lookups else 0.0))
+    return [
+        counter_family("tutor_cache_hits", "Cache hits", hits),
+        counter_family("tutor_cache_misses", "Cache misses", misses),
+        gauge_family("tutor_cache_hit_ratio", "Cache hits / lookups since start", ratios),
+    ]
+
+
+def _resident_bytes() -> Optional[int]:
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, IndexError):
+        return None
+
+
+def admission_families(stats: dict) -> List[Family]:
+    """Running/waiting gauges and busy rejections from AdmissionController.get_stats()"""
+    return [
+        gauge_family("tutor_admission_requests", "Generation requests running or waiting for a slot",
+                     [({"state": "running"}, stats['running']), ({"state": "waiting"}, stats['waiting'])]),
+        counter_family("tutor_admission_rejected", "Requests turned away with a busy event",
+                       [({"reason": reason}, count) for reason, count in stats['rejected'].items()]),
+    ]
+
+
+def process_families() -> List[Family]:
+    rss = _resident_bytes()
+    if rss is None:
+        return []
+    return [gauge_family("tutor_process_resident_memory_bytes", "Resident memory of the process",
+                         [({"process": PROCESS["name"]}, rss)])]
+
+
+def model_families(tutor, scheduler=None) -> List[Family]:
+    """Model memory, prefix/image cache and batch scheduler state of the process that holds the model"""
+    families = cache_families({
+        "prefix": tutor.prefix_cache.get_stats(),
+        "image": tutor.image_cache.get_stats(),
+    })
+    model = tutor.model
+    if model is not None:
+        # Parameters and buffers only change when the model is replaced
+        if getattr(tutor, '_metrics_model_id', None) != id(model):
+            tutor._metrics_model_bytes = sum(
+                t.numel() * t.element_size() for t in list(model.parameters()) + list(model.buffers())
+            )
+            tutor._metrics_model_id = id(model)
+        memory = [({"kind": "weights"}, tutor._metrics_model_bytes)]
+        memory.append(({"kind": "prefix_cache"}, tutor.prefix_cache.total_bytes))
+        memory.append(({"kind": "image_cache"}, tutor.image_cache.total_bytes))
+        import torch
+        if torch.cuda.is_available():
+            memory.append(({"kind": "cuda_allocated"}, torch.cuda.memory_allocated()))
+            memory.append(({"kind": "cuda_reserved"}, torch.cuda.memory_reserved()))
+        families.append(gauge_family("tutor_model_memory_bytes", "Model weights, KV/image caches and CUDA memory", memory))
+    if scheduler is not None:
+        stats = scheduler.get_stats()
+        families.append(gauge_family("tutor_batch_requests", "Requests waiting for or running in the batch scheduler", [
+            ({"state": "waiting"}, stats['waiting']),
+            ({"state": "active"}, stats['active']),
+        ]))
+    return families
+
+
+def watch_model(tutor_getter: Callable[[], object], scheduler_getter: Callable[[], object] = lambda: None):
+    """Collect model_families() on every scrape of whatever tutor/scheduler the getters return"""
+
+    def collect():
+        families = process_families()
+        tutor = tutor_getter()
+        if tutor is not None:
+            families += model_families(tutor, scheduler_getter())
+        return families
+
+    REGISTRY.add_collector("model", collect)
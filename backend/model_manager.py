@@ -2,10 +2,11 @@
 Model Manager for downloading and caching Gemma 3n model from Hugging Face
 """
 import os
+import json
+import time
 import logging
 from pathlib import Path
-from transformers import AutoTokenizer, AutoModelForCausalLM, AutoProcessor, AutoModelForImageTextToText
-from huggingface_hub import snapshot_download
+from typing import Optional
 from config import Settings
 
 logger = logging.getLogger(__name__)
@@ -15,6 +16,9 @@ class ModelManager:
         self.settings = settings
         self.model_path = None
         self.cache_dir = Path.home() / '.cache' / 'huggingface' / 'transformers'
+        self.manifest_path = Path.home() / '.cache' / 'ai_tutor' / 'model_manifest.json'
+        self.snapshot_path: Optional[Path] = None
+        self.check_seconds = 0.0
         
     async def ensure_model_available(self) -> str:
         """
@@ -36,7 +40,7 @@ class ModelManager:
             
             # Check if model is already cached
             if self._is_model_cached(model_id):
-                logger.info(f"✅ Found cached model: {model_id}")
+                logger.info(f"✅ Found cached model: {model_id} (checked in {self.check_seconds * 1000:.0f}ms)")
                 self.model_path = model_id
                 return self.model_path
             
@@ -45,6 +49,7 @@ class ModelManager:
             logger.info("This may take a while depending on your internet connection...")
             
             # Download model files to cache
+            from huggingface_hub import snapshot_download
             snapshot_download(
                 repo_id=model_id,
                 cache_dir=self.cache_dir,
@@ -53,6 +58,9 @@ class ModelManager:
             )
             
             self.model_path = model_id
+            snapshot = self._find_snapshot(model_id)
+            if snapshot is not None and self._has_required_files(snapshot):
+                self._save_manifest(model_id, snapshot)  # Lets the next start skip the full check
             logger.info(f"✅ Model downloaded and cached: {model_id}")
             
             return self.model_path
@@ -66,17 +74,102 @@ class ModelManager:
             raise
 
     def _is_model_cached(self, model_id: str) -> bool:
-        """Check if model is already cached locally"""
+        """Check if model is already cached locally, without importing transformers"""
+        start = time.perf_counter()
         try:
-            # Try to load tokenizer to check if model is cached
-            AutoTokenizer.from_pretrained(
-                model_id,
-                token=self.settings.hf_token if self.settings.hf_token else None,
-                local_files_only=True
-            )
-            return True
-        except:
+            snapshot = self._find_snapshot(model_id)
+            if snapshot is None:
+                return False
+            manifest = self._load_manifest().get(model_id)
+            if manifest and manifest.get('snapshot') == str(snapshot):
+                cached = self._matches_manifest(snapshot, manifest['files'])
+            else:
+                cached = self._has_required_files(snapshot)
+                if cached:
+                    self._save_manifest(model_id, snapshot)
+            if cached:
+                self.snapshot_path = snapshot
+            return cached
+        except Exception as e:
+            logger.warning(f"⚠️ Cache check failed: {e}")
+            return False
+        finally:
+            self.check_seconds = time.perf_counter() - start
+
+    def _hub_cache_dirs(self):
+        """Cache directories from_pretrained and snapshot_download may have used"""
+        hf_home = Path(os.environ.get('HF_HOME', Path.home() / '.cache' / 'huggingface'))
+        hub_cache = Path(os.environ.get('HF_HUB_CACHE') or os.environ.get('HUGGINGFACE_HUB_CACHE') or hf_home / 'hub')
+        return [hub_cache, self.cache_dir]
+
+    def _find_snapshot(self, model_id: str) -> Optional[Path]:
+        """Resolve the local snapshot directory of a Hub repo (refs/main, else the newest snapshot)"""
+        repo_dir_name = 'models--' + model_id.replace('/', '--')
+        for cache_dir in self._hub_cache_dirs():
+            repo_dir = cache_dir / repo_dir_name
+            ref = repo_dir / 'refs' / 'main'
+            if ref.is_file():
+                snapshot = repo_dir / 'snapshots' / ref.read_text().strip()
+                if snapshot.is_dir():
+                    return snapshot
+            snapshots = repo_dir / 'snapshots'
+            if snapshots.is_dir():
+                candidates = sorted((p for p in snapshots.iterdir() if p.is_dir()), key=lambda p: p.stat().st_mtime)
+                if candidates:
+                    return candidates[-1]
+        return None
+
+    def _has_required_files(self, snapshot: Path) -> bool:
+        """Config, tokenizer and every weight shard listed in the index must be present"""
+        required = ['config.json']
+        index_path = snapshot / 'model.safetensors.index.json'
+        if index_path.is_file():
+            with open(index_path, 'r', encoding='utf-8') as f:
+                required += sorted(set(json.load(f)['weight_map'].values()))
+        else:
+            required.append('model.safetensors')
+        if not any((snapshot / name).is_file() for name in ('tokenizer.json', 'tokenizer.model')):
+            logger.info("📦 Cached snapshot has no tokenizer files")
             return False
+        missing = [name for name in required if not (snapshot / name).is_file()]
+        if missing:
+            logger.info(f"📦 Cached snapshot is incomplete, missing: {', '.join(missing[:5])}")
+            return False
+        return True
+
+    def _matches_manifest(self, snapshot: Path, files: dict) -> bool:
+        """Every recorded file still exists, points at the same blob (named by its hash) and has the same size"""
+        for name, (blob, size) in files.items():
+            path = snapshot / name
+            try:
+                if path.stat().st_size != size or Path(os.path.realpath(path)).name != blob:
+                    logger.info(f"📦 Cached file changed since last start: {name}")
+                    return False
+            except OSError:
+                logger.info(f"📦 Cached file missing: {name}")
+                return False
+        return True
+
+    def _load_manifest(self) -> dict:
+        try:
+            with open(self.manifest_path, 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def _save_manifest(self, model_id: str, snapshot: Path):
+        files = {}
+        for path in snapshot.rglob('*'):
+            if path.is_file():
+                files[str(path.relative_to(snapshot))] = (Path(os.path.realpath(path)).name, path.stat().st_size)
+        manifest = self._load_manifest()
+        manifest[model_id] = {'snapshot': str(snapshot), 'files': files, 'recorded_at': time.time()}
+        try:
+            self.manifest_path.parent.mkdir(parents=True, exist_ok=True)
+            with open(self.manifest_path, 'w', encoding='utf-8') as f:
+                json.dump(manifest, f, indent=2)
+        except OSError as e:
+            logger.warning(f"⚠️ Could not write model manifest: {e}")
 
     def get_model_path(self) -> str:
         """Get the current model identifier"""
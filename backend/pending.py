@@ -0,0 +1,101 @@
+"""
+Bounded FIFO of requests that arrived before the model was ready
+"""
+import itertools
+import logging
+import threading
+import time
+from collections import OrderedDict
+from typing import Callable, Optional
+
+logger = logging.getLogger(__name__)
+
+
+class PendingRequestQueue:
+    """
+    Holds requests while the model loads (or the inference worker restarts)
+    and releases them in arrival order once it is ready.
+
+    Handlers poll `wait()` with their server's cooperative sleep, so nothing
+    blocks while holding the lock.
+    """
+
+    def __init__(self, max_size: int = 32, timeout: float = 600.0):
+        self.max_size = max_size
+        self.timeout = timeout
+        self._tickets: "OrderedDict[int, str]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._counter = itertools.count(1)
+        self.served = 0
+        self.rejected = 0
+        self.abandoned = 0
+
+    def enter(self, client_id: str) -> Optional[int]:
+        """Queue a request; returns its ticket, or None if the queue is full"""
+        with self._lock:
+            if len(self._tickets) >= self.max_size:
+                self.rejected += 1
+                return None
+            ticket = next(self._counter)
+            self._tickets[ticket] = client_id
+            return ticket
+
+    def position(self, ticket: int) -> int:
+        """1-based place in line (0 if the ticket is no longer queued)"""
+        with self._lock:
+            for index, queued in enumerate(self._tickets, start=1):
+                if queued == ticket:
+                    return index
+            return 0
+
+    def leave(self, ticket: int):
+        with self._lock:
+            self._tickets.pop(ticket, None)
+
+    def drop_client(self, client_id: str):
+        """Forget a disconnected client's queued requests"""
+        with self._lock:
+            for ticket in [t for t, cid in self._tickets.items() if cid == client_id]:
+                del self._tickets[ticket]
+                self.abandoned += 1
+
+    def poll(self, ticket: int, ready: Callable[[], bool], failed: Callable[[], bool], started: float) -> Optional[str]:
+        """
+        One step of waiting: 'ready' (at the head of the line and the model is
+        up), 'failed', 'timeout' or 'dropped'; None means keep waiting.
+        """
+        if failed():
+            self.leave(ticket)
+            return 'failed'
+        position = self.position(ticket)
+        if position == 0:
+            return 'dropped'
+        if position == 1 and ready():
+            self.leave(ticket)
+            with self._lock:
+                self.served += 1
+            return 'ready'
+        if time.time() - started > self.timeout:
+            self.leave(ticket)
+            return 'timeout'
+        return None
+
+    def wait(self, ticket: int, ready: Callable[[], bool], failed: Callable[[], bool],
+             sleep: Callable[[float], None], poll_interval: float = 0.1) -> str:
+        """Block (cooperatively) until `poll` has an outcome"""
+        started = time.time()
+        while True:
+            outcome = self.poll(ticket, ready, failed, started)
+            if outcome is not None:
+                return outcome
+            sleep(poll_interval)
+
+    def get_stats(self) -> dict:
+        with self._lock:
+            return {
+                'waiting': len(self._tickets),
+                'max_size': self.max_size,
+                'served': self.served,
+                'rejected': self.rejected,
+                'abandoned': self.abandoned,
+            }
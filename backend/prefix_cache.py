@@ -0,0 +1,130 @@
+"""
+Prefix KV-cache store for the rendered tutor system prompts
+"""
+import logging
+import threading
+from collections import OrderedDict
+from typing import Callable, List, Optional
+
+from transformers import DynamicCache
+
+logger = logging.getLogger(__name__)
+
+
+def cache_nbytes(cache: DynamicCache) -> int:
+    """Bytes held by the key/value tensors of a DynamicCache"""
+    total = 0
+    for store in (cache.key_cache, cache.value_cache):
+        for tensor in store:
+            total += tensor.numel() * tensor.element_size()
+    return total
+
+
+def fork_cache(cache: DynamicCache) -> DynamicCache:
+    """
+    Return a new DynamicCache that shares the tensors of `cache`.
+
+    DynamicCache.update() concatenates into new tensors instead of writing in
+    place, so generations that start from the fork never modify the original.
+    """
+    forked = DynamicCache()
+    forked.key_cache = list(cache.key_cache)
+    forked.value_cache = list(cache.value_cache)
+    forked._seen_tokens = getattr(cache, '_seen_tokens', 0)
+    return forked
+
+
+class PrefixEntry:
+    """Token ids and past_key_values of one precomputed prompt prefix"""
+
+    def __init__(self, key: str, token_ids: List[int], cache: DynamicCache):
+        self.key = key
+        self.token_ids = list(token_ids)
+        self.cache = cache
+        self.nbytes = cache_nbytes(cache)
+        self.hits = 0
+
+    def __len__(self):
+        return len(self.token_ids)
+
+    def fork(self) -> DynamicCache:
+        return fork_cache(self.cache)
+
+
+class PrefixKVCache:
+    """LRU store of prefix KV caches keyed by rendered prompt text, bounded by bytes"""
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self._entries: "OrderedDict[str, PrefixEntry]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.total_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_bytes > 0
+
+    def get(self, key: str) -> Optional[PrefixEntry]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            entry.hits += 1
+            self.hits += 1
+            return entry
+
+    def put(self, key: str, token_ids: List[int], cache: DynamicCache) -> PrefixEntry:
+        entry = PrefixEntry(key, token_ids, cache)
+        if entry.nbytes > self.max_bytes:
+            logger.warning(f"⚠️ Prefix cache entry ({entry.nbytes / 1024**2:.1f}MB) exceeds budget, not stored")
+            return entry
+
+        with self._lock:
+            previous = self._entries.pop(key, None)
+            if previous is not None:
+                self.total_bytes -= previous.nbytes
+            self._entries[key] = entry
+            self.total_bytes += entry.nbytes
+
+            while self.total_bytes > self.max_bytes and self._entries:
+                _, evicted = self._entries.popitem(last=False)
+                self.total_bytes -= evicted.nbytes
+                self.evictions += 1
+        return entry
+
+    def get_or_compute(
+        self,
+        key: str,
+        token_ids: List[int],
+        compute: Callable[[List[int]], DynamicCache]
+    ) -> Optional[PrefixEntry]:
+        """Return the cached prefix, computing and storing its KV cache on a miss"""
+        if not self.enabled:
+            return None
+        entry = self.get(key)
+        if entry is not None:
+            return entry
+        return self.put(key, token_ids, compute(token_ids))
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.total_bytes = 0
+
+    def get_stats(self) -> dict:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'entries': len(self._entries),
+                'memory_mb': round(self.total_bytes / 1024**2, 2),
+                'budget_mb': round(self.max_bytes / 1024**2, 2),
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': round(self.hits / lookups, 3) if lookups else 0.0,
+                'evictions': self.evictions,
+            }
@@ -0,0 +1,191 @@
+"""
+Per-request profiling: torch.profiler plus wall-clock spans, exported as Chrome traces
+
+A profiled request writes <dir>/<time>-<kind>-<id>.json.gz (open it in
+https://ui.perfetto.dev or chrome://tracing) and a .txt summary with its
+spans and top operators. Traces of a few hundred decode steps run to tens
+of MB before compression, so only the newest `max_files` requests within
+`max_mb` are kept.
+"""
+import functools
+import logging
+import random
+import threading
+import time
+import uuid
+from contextlib import contextmanager, nullcontext
+from pathlib import Path
+from typing import List, Optional, Tuple
+
+import torch
+
+logger = logging.getLogger(__name__)
+
+TRACE_SUFFIX = ".json.gz"
+
+
+def default_profile_dir() -> Path:
+    return Path(__file__).parent / "profiles"
+
+
+class ProfileSession:
+    """One profiled request: named wall-clock spans, mirrored as torch.profiler ranges"""
+
+    def __init__(self, kind: str, request_id: str):
+        self.kind = kind
+        self.request_id = request_id
+        self.spans: List[Tuple[str, float]] = []
+        self._open: Optional[Tuple[str, float, object]] = None
+
+    @contextmanager
+    def span(self, name: str):
+        start = time.perf_counter()
+        with torch.profiler.record_function(name):
+            try:
+                yield
+            finally:
+                self.spans.append((name, time.perf_counter() - start))
+
+    def begin(self, name: str):
+        """Open a span that ends at the next begin()/end() (for phases split by a callback)"""
+        self.end()
+        marker = torch.profiler.record_function(name)
+        marker.__enter__()
+        self._open = (name, time.perf_counter(), marker)
+
+    def end(self):
+        if self._open is None:
+            return
+        name, start, marker = self._open
+        self._open = None
+        marker.__exit__(None, None, None)
+        self.spans.append((name, time.perf_counter() - start))
+
+    def describe(self) -> str:
+        return ", ".join(f"{name} {seconds * 1000:.0f}ms" for name, seconds in self.spans)
+
+
+class RequestProfiler:
+    """
+    Decides which requests to profile and records them.
+
+    Nothing is profiled unless `enabled`. Then a request is profiled when it
+    asks for it (`profile` in the socket settings) or, failing that, with
+    probability `sample_rate`. torch.profiler is process-wide, so a request
+    that arrives while another is being profiled runs unprofiled.
+    """
+
+    def __init__(self, enabled: bool = False, sample_rate: float = 0.0, directory: str = "",
+                 max_files: int = 20, max_mb: float = 200, top_ops: int = 15):
+        self.enabled = enabled
+        self.sample_rate = max(0.0, min(1.0, sample_rate))
+        self.directory = Path(directory) if directory else default_profile_dir()
+        self.max_files = max(1, max_files)
+        self.max_bytes = int(max_mb * 1024**2)
+        self.top_ops = top_ops
+        self.profiled = 0
+        self.skipped_busy = 0
+        self.last_trace: Optional[str] = None
+        self._busy = threading.Lock()
+        self._local = threading.local()
+
+    def wanted(self, requested: bool = False) -> bool:
+        if not self.enabled:
+            return False
+        return bool(requested) or (self.sample_rate > 0 and random.random() < self.sample_rate)
+
+    @property
+    def current(self) -> Optional[ProfileSession]:
+        return getattr(self._local, 'session', None)
+
+    def span(self, name: str):
+        """A span in this thread's active profile, or a no-op when it is not being profiled"""
+        session = self.current
+        return session.span(name) if session is not None else nullcontext()
+
+    @contextmanager
+    def profile(self, kind: str, request_id: str, requested: bool = False):
+        """Profile the block if this request is selected; yields the ProfileSession or None"""
+        if not self.wanted(requested):
+            yield None
+            return
+        if not self._busy.acquire(blocking=False):
+            self.skipped_busy += 1
+            logger.info(f"🔬 Profiler busy, {kind} request {request_id} runs unprofiled")
+            yield None
+            return
+
+        session = ProfileSession(kind, request_id)
+        activities = [torch.profiler.ProfilerActivity.CPU]
+        if torch.cuda.is_available():
+            activities.append(torch.profiler.ProfilerActivity.CUDA)
+        start = time.perf_counter()
+        try:
+            with torch.profiler.profile(activities=activities) as prof:
+                self._local.session = session
+                try:
+                    yield session
+                finally:
+                    session.end()
+                    self._local.session = None
+            self._export(prof, session, time.perf_counter() - start)
+        finally:
+            self._busy.release()
+
+    def _export(self, prof, session: ProfileSession, total: float):
+        try:
+            self.directory.mkdir(parents=True, exist_ok=True)
+            stem = f"{time.strftime('%Y%m%d-%H%M%S')}-{session.kind}-{session.request_id[:8]}"
+            trace_path = self.directory / f"{stem}{TRACE_SUFFIX}"
+            prof.export_chrome_trace(str(trace_path))
+            table = prof.key_averages().table(sort_by=self._sort_key(), row_limit=self.top_ops)
+            summary = (f"{session.kind} request {session.request_id}: {total * 1000:.0f}ms total\n"
+                       f"spans: {session.describe()}\n\n{table}\n")
+            (self.directory / f"{stem}.txt").write_text(summary, encoding='utf-8')
+            self.profiled += 1
+            self.last_trace = str(trace_path)
+            self._rotate()
+            logger.info(f"🔬 Profiled {session.kind} request in {total:.2f}s [{session.describe()}] -> {trace_path}")
+            logger.info(f"🔬 Top operators:\n{table}")
+        except Exception as e:
+            logger.warning(f"⚠️ Could not write profile: {e}")
+
+    @staticmethod
+    def _sort_key() -> str:
+        return "self_cuda_time_total" if torch.cuda.is_available() else "self_cpu_time_total"
+
+    def _rotate(self):
+        """Delete the oldest traces beyond max_files or max_bytes (the newest one always stays)"""
+        traces = sorted(self.directory.glob(f"*{TRACE_SUFFIX}"), key=lambda p: p.stat().st_mtime, reverse=True)
+        total = 0
+        for index, trace in enumerate(traces):
+            total += trace.stat().st_size
+            if index == 0 or (index < self.max_files and total <= self.max_bytes):
+                continue
+            trace.unlink(missing_ok=True)
+            (trace.parent / (trace.name[:-len(TRACE_SUFFIX)] + ".txt")).unlink(missing_ok=True)
+
+    def get_stats(self) -> dict:
+        return {
+            'enabled': self.enabled,
+            'sample_rate': self.sample_rate,
+            'directory': str(self.directory),
+            'profiled': self.profiled,
+            'skipped_busy': self.skipped_busy,
+            'last_trace': self.last_trace,
+        }
+
+
+def profiled(kind: str):
+    """
+    Method decorator: adds `profile` and `request_id` keyword arguments and runs
+    the call under `self.profiler` when the request is selected for profiling
+    """
+
+    def decorate(method):
+        @functools.wraps(method)
+        def wrapper(self, *args, profile: bool = False, request_id: Optional[str] = None, **kwargs):
+            with self.profiler.profile(kind, request_id or uuid.uuid4().hex, requested=profile):
+                return method(self, *args, **kwargs)
+        return wrapper
+    return decorate
@@ -0,0 +1,254 @@
+"""
+CPU weight quantization for the text decoder
+
+    int8 - dynamic quantization: per-channel int8 weights, activations quantized
+           on the fly (fbgemm/onednn kernels). Roughly 4x less weight memory than
+           float32 and faster prefill and decode.
+    int4 - weight-only int4 (group-wise scales) for the decoder's Linear layers,
+           int8 for everything else. Smallest footprint; decode is about as fast as
+           int8 but prefill is slower than float32, so long prompts pay for it.
+
+Embeddings (including the large per-layer embedding table) are stored as int8
+rows in both modes; the tied LM head shares the int8 token embedding. The vision
+and audio towers stay in float32.
+"""
+import logging
+import warnings
+from typing import Optional
+
+import torch
+from torch import nn
+from torch.nn import functional as F
+
+logger = logging.getLogger(__name__)
+
+QUANTIZATION_MODES = ("none", "int8", "int4")
+INT4_GROUP_SIZE = 128
+
+# Tiny routing/coefficient layers are not worth quantizing and some are clamped in place
+_SKIP_MODULES = ("altup",)
+_MIN_FEATURES = 64
+
+
+def quantize_rows(weight: torch.Tensor, chunk_rows: int = 16384):
+    """Symmetric per-row int8 (int8 values, float32 scales), converted a chunk at a time"""
+    rows = weight.shape[0]
+    qweight = torch.empty(weight.shape, dtype=torch.int8)
+    scales = torch.empty(rows, dtype=torch.float32)
+    for begin in range(0, rows, chunk_rows):
+        chunk = weight[begin:begin + chunk_rows].detach().float()
+        scale = chunk.abs().amax(dim=1).clamp(min=1e-8) / 127
+        qweight[begin:begin + chunk_rows] = torch.round(chunk / scale[:, None]).clamp(-127, 127).to(torch.int8)
+        scales[begin:begin + chunk_rows] = scale
+    return qweight, scales
+
+
+class Int8DynamicLinear(nn.Module):
+    """Linear with per-channel int8 weights and activations quantized per call"""
+
+    def __init__(self, in_features: int, out_features: int, bias: bool = False):
+        super().__init__()
+        self.in_features = in_features
+        self.out_features = out_features
+        self.register_buffer("weight", torch.empty(out_features, in_features, dtype=torch.int8))
+        self.register_buffer("weight_scale", torch.empty(out_features, dtype=torch.float32))
+        self.bias = nn.Parameter(torch.empty(out_features), requires_grad=False) if bias else None
+        self._packed = None
+
+    @classmethod
+    def from_float(cls, linear: nn.Linear, quantized=None):
+        module = cls(linear.in_features, linear.out_features, bias=linear.bias is not None)
+        module.weight, module.weight_scale = quantized if quantized is not None else quantize_rows(linear.weight)
+        if linear.bias is not None:
+            module.bias = nn.Parameter(linear.bias.detach().float(), requires_grad=False)
+        return module
+
+    def pack(self):
+        """Prepack for the quantized engine (a private copy; the int8 buffer can stay memory-mapped)"""
+        with warnings.catch_warnings():
+            # Quantized tensor constructors warn about deprecation; the packed engine ops are what we use
+            warnings.simplefilter("ignore", UserWarning)
+            qweight = torch._make_per_channel_quantized_tensor(
+                self.weight, self.weight_scale.double(), torch.zeros(self.out_features, dtype=torch.long), 0
+            )
+        bias = self.bias.detach().float() if self.bias is not None else None
+        self._packed = torch.ops.quantized.linear_prepack(qweight, bias)
+
+    def forward(self, x: torch.Tensor) -> torch.Tensor:
+        if self._packed is None:
+            self.pack()
+        shape = x.shape
+        out = torch.ops.quantized.linear_dynamic(x.reshape(-1, shape[-1]).float(), self._packed, True)
+        return out.reshape(*shape[:-1], self.out_features).to(x.dtype)
+
+    def extra_repr(self) -> str:
+        return f"in_features={self.in_features}, out_features={self.out_features}, bias={self.bias is not None}"
+
+
+class Int4WeightOnlyLinear(nn.Module):
+    """Linear with group-wise asymmetric int4 weights, packed for the CPU int4 matmul kernel"""
+
+    def __init__(self, in_features: int, out_features: int, group_size: int = INT4_GROUP_SIZE):
+        super().__init__()
+        self.in_features = in_features
+        self.out_features = out_features
+        self.group_size = group_size
+        self.register_buffer("weight_packed", torch.empty(out_features, in_features // 2, dtype=torch.uint8))
+        self.register_buffer(
+            "scales_and_zeros", torch.empty(in_features // group_size, out_features, 2, dtype=torch.bfloat16)
+        )
+
+    @classmethod
+    def from_float(cls, linear: nn.Linear, group_size: int = INT4_GROUP_SIZE):
+        out_features, in_features = linear.weight.shape
+        module = cls(in_features, out_features, group_size)
+        weight = linear.weight.detach().float().reshape(out_features, in_features // group_size, group_size)
+        low = weight.amin(dim=-1)
+        scale = (weight.amax(dim=-1) - low).clamp(min=1e-8) / 15
+        qweight = torch.round((weight - low[..., None]) / scale[..., None]).clamp(0, 15).to(torch.int32)
+        module.weight_packed = torch._convert_weight_to_int4pack_for_cpu(qweight.reshape(out_features, in_features), 1)
+        # The kernel dequantizes as (q - 8) * scale + zero
+        zeros = low + 8 * scale
+        module.scales_and_zeros = torch.stack([scale, zeros], dim=-1).transpose(0, 1).contiguous().to(torch.bfloat16)
+        return module
+
+    def forward(self, x: torch.Tensor) -> torch.Tensor:
+        shape = x.shape
+        out = torch._weight_int4pack_mm_for_cpu(
+            x.reshape(-1, shape[-1]).to(torch.bfloat16), self.weight_packed, self.group_size, self.scales_and_zeros
+        )
+        return out.reshape(*shape[:-1], self.out_features).to(x.dtype)
+
+    def extra_repr(self) -> str:
+        return f"in_features={self.in_features}, out_features={self.out_features}, group_size={self.group_size}"
+
+
+class Int8Embedding(nn.Module):
+    """Embedding table stored as int8 rows with per-row scales (keeps Gemma3n's embed_scale)"""
+
+    def __init__(self, num_embeddings: int, embedding_dim: int, embed_scale: float = 1.0):
+        super().__init__()
+        self.num_embeddings = num_embeddings
+        self.embedding_dim = embedding_dim
+        self.register_buffer("weight", torch.empty(num_embeddings, embedding_dim, dtype=torch.int8))
+        self.register_buffer("weight_scale", torch.empty(num_embeddings, dtype=torch.float32))
+        self.register_buffer("embed_scale", torch.tensor(embed_scale), persistent=False)
+
+    @classmethod
+    def from_float(cls, embedding: nn.Embedding):
+        embed_scale = getattr(embedding, 'embed_scale', None)
+        module = cls(embedding.num_embeddings, embedding.embedding_dim,
+                     float(embed_scale) if embed_scale is not None else 1.0)
+        module.weight, module.weight_scale = quantize_rows(embedding.weight)
+        return module
+
+    def forward(self, input_ids: torch.Tensor) -> torch.Tensor:
+        rows = F.embedding(input_ids, self.weight).float()
+        return rows * (self.weight_scale[input_ids] * self.embed_scale).unsqueeze(-1)
+
+    def extra_repr(self) -> str:
+        return f"{self.num_embeddings}, {self.embedding_dim}"
+
+
+def _quantizable_linears(model: nn.Module):
+    language_model = model.model.language_model
+    for name, module in language_model.named_modules():
+        if any(part in name for part in _SKIP_MODULES):
+            continue
+        if isinstance(module, nn.Linear) and min(module.in_features, module.out_features) >= _MIN_FEATURES:
+            yield name, module
+
+
+def _set_submodule(root: nn.Module, name: str, module: nn.Module):
+    parent_name, _, leaf = name.rpartition('.')
+    setattr(root.get_submodule(parent_name) if parent_name else root, leaf, module)
+
+
+def _linear_for(linear: nn.Linear, mode: str, empty: bool):
+    """The quantized replacement for one Linear; `empty` only builds the structure (for loading)"""
+    use_int4 = (mode == "int4" and linear.bias is None and linear.in_features % INT4_GROUP_SIZE == 0)
+    if empty:
+        if use_int4:
+            return Int4WeightOnlyLinear(linear.in_features, linear.out_features)
+        return Int8DynamicLinear(linear.in_features, linear.out_features, bias=linear.bias is not None)
+    return Int4WeightOnlyLinear.from_float(linear) if use_int4 else Int8DynamicLinear.from_float(linear)
+
+
+def quantize_model(model: nn.Module, mode: str, empty: bool = False) -> nn.Module:
+    """
+    Replace the text decoder's Linear layers and embeddings in place (the
+    model may be loaded in bf16; the rest is upcast to float32 afterwards).
+
+    With empty=True nothing is computed: the quantized modules are created
+    uninitialized so a saved quantized snapshot can be loaded into them.
+    """
+    if mode not in QUANTIZATION_MODES:
+        raise ValueError(f"Unknown quantization mode {mode!r} (expected one of {', '.join(QUANTIZATION_MODES)})")
+    if mode == "none":
+        return model
+
+    language_model = model.model.language_model
+    count = 0
+    for name, linear in list(_quantizable_linears(model)):
+        _set_submodule(language_model, name, _linear_for(linear, mode, empty))
+        count += 1
+
+    for name in ("embed_tokens", "embed_tokens_per_layer"):
+        embedding = getattr(language_model, name)
+        if empty:
+            # embed_scale is restored from the snapshot with the other buffers
+            quantized = Int8Embedding(embedding.num_embeddings, embedding.embedding_dim)
+        else:
+            quantized = Int8Embedding.from_float(embedding)
+        setattr(language_model, name, quantized)
+
+    # The LM head is tied to the token embedding: reuse its int8 rows as per-channel weights
+    embed_tokens = language_model.embed_tokens
+    lm_head = Int8DynamicLinear(embed_tokens.embedding_dim, embed_tokens.num_embeddings)
+    lm_head.weight, lm_head.weight_scale = embed_tokens.weight, embed_tokens.weight_scale
+    model.lm_head = lm_head
+
+    if not empty:
+        # Whatever stays unquantized (vision/audio towers, norms, small layers) runs in float32
+        _to_float32(model)
+        logger.info(f"🗜️ Quantized {count} Linear layers, embeddings and LM head to {mode}")
+    return model
+
+
+def _to_float32(model: nn.Module):
+    """Upcast half-precision parameters and buffers, leaving the int4 kernel's bf16 scales alone"""
+    for module in model.modules():
+        if isinstance(module, Int4WeightOnlyLinear):
+            continue
+        for name, param in module._parameters.items():
+            if param is not None and param.dtype in (torch.bfloat16, torch.float16):
+                module._parameters[name] = nn.Parameter(param.detach().float(), requires_grad=False)
+        for name, buffer in module._buffers.items():
+            if buffer is not None and buffer.dtype in (torch.bfloat16, torch.float16):
+                module._buffers[name] = buffer.float()
+    model.config.torch_dtype = torch.float32
+
+
+def pack_model(model: nn.Module):
+    """Prepack every int8 Linear up front so the first request doesn't pay for it"""
+    for module in model.modules():
+        if isinstance(module, Int8DynamicLinear):
+            module.pack()
+    return model
+
+
+def quantized_nbytes(model: nn.Module) -> int:
+    """Bytes of all parameters and buffers (tied tensors counted once)"""
+    seen = set()
+    total = 0
+    for tensor in list(model.parameters()) + list(model.buffers()):
+        if tensor.data_ptr() in seen:
+            continue
+        seen.add(tensor.data_ptr())
+        total += tensor.numel() * tensor.element_size()
+    return total
+
+
+def normalize_mode(mode: Optional[str]) -> str:
+    mode = (mode or "none").strip().lower()
+    return "none" if mode in ("", "0", "false", "off", "float32", "fp32") else mode
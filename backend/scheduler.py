@@ -0,0 +1,513 @@
+"""
+Continuous-batching scheduler for text generation with the shared Gemma3n model
+"""
+import logging
+import queue
+import threading
+import time
+import uuid
+from typing import Callable, List, Optional
+
+import torch
+from transformers import DynamicCache
+
+import metrics
+from deadline import Deadline
+from streaming import IncrementalDetokenizer
+
+logger = logging.getLogger(__name__)
+
+
+class GenerationRequest:
+    """One queued text generation; results are delivered through `events`"""
+
+    def __init__(
+        self,
+        input_ids: List[int],
+        max_new_tokens: int = 256,
+        do_sample: bool = True,
+        temperature: float = 0.7,
+        top_p: float = 0.9,
+        stream_chunk_tokens: int = 1,
+        client_id: Optional[str] = None,
+        request_id: Optional[str] = None,
+        messages: Optional[list] = None,
+        past_key_values: Optional[DynamicCache] = None,
+        keep_cache: bool = False,
+        cancel_event: Optional[threading.Event] = None,
+        deadline: Optional[Deadline] = None
+    ):
+        self.request_id = request_id or str(uuid.uuid4())
+        self.client_id = client_id
+        self.input_ids = list(input_ids)
+        self.max_new_tokens = max_new_tokens
+        self.do_sample = do_sample
+        self.temperature = temperature
+        self.top_p = top_p
+        self.stream_chunk_tokens = max(1, stream_chunk_tokens)
+        # Chat messages the ids were rendered from; used to look up a cached system-prompt prefix
+        self.messages = messages
+        # KV cache covering the start of input_ids (prefix or session); only the rest is prefilled
+        self.past_key_values = past_key_values
+        # Return this sequence's KV cache in `final_cache` when it completes (multi-turn sessions)
+        self.keep_cache = keep_cache
+        self.final_cache: Optional[DynamicCache] = None
+        # Set by the caller to stop generating; the row leaves the batch after the current step
+        self.cancel_event = cancel_event
+        # Stop at a sentence end once most of the latency budget is spent
+        self.deadline = deadline
+
+        # ('chunk', text) / ('complete', text, stats) / ('error', message)
+        self.events = queue.Queue()
+
+        self.generated_ids: List[int] = []
+        self.detokenizer = None
+        self.pending_text = ""
+        self.pending_tokens = 0
+        self.tail = ""
+        self.submitted_at = time.time()
+        self.started_at: Optional[float] = None
+        self.first_token_at: Optional[float] = None
+        self.finished = False
+        self.cached_tokens = 0
+        self.detokenize_time = 0.0
+
+    @property
+    def cancelled(self) -> bool:
+        return self.cancel_event is not None and self.cancel_event.is_set()
+
+    def iter_events(self, sleep: Callable[[float], None], poll_interval: float = 0.01):
+        """
+        Yield events until the request completes or fails.
+
+        `sleep` must be cooperative for the calling context (socketio.sleep under eventlet)
+        so the web server keeps serving other clients while this request waits.
+        """
+        while True:
+            try:
+                event = self.events.get_nowait()
+            except queue.Empty:
+                sleep(poll_interval)
+                continue
+            yield event
+            if event[0] in ('complete', 'error'):
+                return
+
+    def stats(self) -> dict:
+        end = time.time()
+        decode_time = end - (self.first_token_at or end)
+        return {
+            'prompt_tokens': len(self.input_ids),
+            'tokens_generated': len(self.generated_ids),
+            'queue_wait': (self.started_at or end) - self.submitted_at,
+            'time_to_first_token': (self.first_token_at or end) - self.submitted_at,
+            'total_time': end - self.submitted_at,
+            'decode_tok_s': (len(self.generated_ids) - 1) / decode_time if decode_time > 0 else 0.0,
+            'cancelled': self.cancelled,
+            'truncated': self.deadline is not None and self.deadline.truncated,
+        }
+
+
+class BatchScheduler:
+    """
+    Serve many GenerationRequests with one model using iteration-level batching.
+
+    A background thread owns a single running batch. Every iteration it admits
+    waiting requests (padded prefill in one forward pass), merges them into the
+    running KV cache, runs one shared decode step for all active sequences and
+    retires the ones that finished, so new sequences join as others leave.
+    """
+
+    def __init__(self, tutor, max_batch_size: int = 8, max_prefill_batch: int = 4):
+        self.tutor = tutor
+        self.max_batch_size = max(1, max_batch_size)
+        self.max_prefill_batch = max(1, max_prefill_batch)
+
+        self._waiting: List[GenerationRequest] = []
+        self._lock = threading.Condition()
+        # The tutor's model lock, held for each prefill/decode step (direct and image calls hold it too)
+        self.model_lock = tutor.model_lock
+        self._thread: Optional[threading.Thread] = None
+        self._running = False
+
+        # Running batch state
+        self._rows: List[GenerationRequest] = []
+        self._cache: Optional[DynamicCache] = None
+        self._attention_mask: Optional[torch.Tensor] = None  # [B, cache_len]
+        self._positions: Optional[torch.Tensor] = None       # [B] position of the next input token
+        self._next_tokens: Optional[torch.Tensor] = None     # [B] token to feed in the next step
+
+        # Aggregate counters
+        self.total_tokens = 0
+        self.total_requests = 0
+        self.decode_steps = 0
+
+    # ------------------------------------------------------------------
+    # Public API
+    # ------------------------------------------------------------------
+
+    def start(self):
+        if self._thread and self._thread.is_alive():
+            return
+        self._running = True
+        self._thread = threading.Thread(target=self._loop, name="batch-scheduler", daemon=True)
+        self._thread.start()
+        logger.info(f"🧵 Batch scheduler started (max batch: {self.max_batch_size})")
+
+    def stop(self):
+        with self._lock:
+            self._running = False
+            self._lock.notify_all()
+        if self._thread:
+            self._thread.join(timeout=5)
+
+    def submit(self, request: GenerationRequest) -> GenerationRequest:
+        with self._lock:
+            self._waiting.append(request)
+            self._lock.notify()
+        return request
+
+    def get_stats(self) -> dict:
+        with self._lock:
+            waiting = len(self._waiting)
+        return {
+            'waiting': waiting,
+            'active': len(self._rows),
+            'max_batch_size': self.max_batch_size,
+            'total_requests': self.total_requests,
+            'total_tokens': self.total_tokens,
+            'decode_steps': self.decode_steps,
+        }
+
+    # ------------------------------------------------------------------
+    # Scheduler loop
+    # ------------------------------------------------------------------
+
+    def _loop(self):
+        while True:
+            with self._lock:
+                while self._running and not self._waiting and not self._rows:
+                    self._lock.wait()
+                if not self._running:
+                    break
+                dropped = [r for r in self._waiting if r.cancelled]
+                if dropped:
+                    self._waiting = [r for r in self._waiting if not r.cancelled]
+                free_slots = self.max_batch_size - len(self._rows)
+                admitted = self._waiting[:min(free_slots, self.max_prefill_batch)]
+                del self._waiting[:len(admitted)]
+
+            # Cancelled before they were admitted: nothing was generated
+            for request in dropped:
+                request.finished = True
+                metrics.record_cancelled("batched", 0, request.max_new_tokens)
+                request.events.put(('complete', "", request.stats()))
+
+            try:
+                with self.model_lock, torch.inference_mode():
+                    if admitted:
+                        self._prefill(admitted)
+                    if self._rows:
+                        self._decode_step()
+            except Exception as e:
+                logger.error(f"❌ Batch scheduler step failed: {e}")
+                self._fail_all(admitted, e)
+
+    def _fail_all(self, admitted: List[GenerationRequest], error: Exception):
+        for request in set(self._rows) | set(admitted):
+            if not request.finished:
+                request.finished = True
+                request.events.put(('error', f"Error generating response: {error}"))
+        self._reset_batch()
+
+    def _reset_batch(self):
+        self._rows = []
+        self._cache = None
+        self._attention_mask = None
+        self._positions = None
+        self._next_tokens = None
+
+    # ------------------------------------------------------------------
+    # Prefill / decode
+    # ------------------------------------------------------------------
+
+    @property
+    def _device(self):
+        return self.tutor.model.device
+
+    def _forward(self, input_ids, attention_mask, position_ids, cache, cache_start):
+        cache_position = torch.arange(cache_start, cache_start + input_ids.shape[1], device=self._device)
+        outputs = self.tutor.model(
+            input_ids=input_ids,
+            attention_mask=attention_mask,
+            position_ids=position_ids,
+            past_key_values=cache,
+            cache_position=cache_position,
+            use_cache=True,
+            logits_to_keep=1,
+        )
+        return outputs.logits[:, -1, :].float()
+
+    def _prefill(self, requests: List[GenerationRequest]):
+        """Prefill admitted requests and merge them into the running batch"""
+        for request in requests:
+            request.started_at = time.time()
+            if request.deadline is not None:
+                # Time spent waiting in the queue doesn't count against the answer's budget
+                request.deadline.start()
+            request.detokenizer = IncrementalDetokenizer(self.tutor.processor.tokenizer)
+            if request.past_key_values is None and request.messages is not None:
+                prefix = self.tutor.lookup_prefix(request.messages, request.input_ids)
+                if prefix is not None:
+                    request.past_key_values = prefix.fork()
+
+        # Requests with a cached prefix only prefill their uncached tail, one at a time;
+        # the rest share a single left-padded prefill.
+        seeded = [r for r in requests if r.past_key_values is not None]
+        unseeded = [r for r in requests if r.past_key_values is None]
+        if unseeded:
+            self._prefill_padded(unseeded)
+        for request in seeded:
+            self._prefill_from_cache(request)
+
+        self.total_requests += len(requests)
+        logger.info(
+            f"📥 Admitted {len(requests)} request(s) ({len(seeded)} from cached KV), "
+            f"batch size now {len(self._rows)}"
+        )
+
+    def _prefill_padded(self, requests: List[GenerationRequest]):
+        pad_id = self.tutor.processor.tokenizer.pad_token_id or 0
+        max_len = max(len(r.input_ids) for r in requests)
+
+        input_ids = torch.full((len(requests), max_len), pad_id, dtype=torch.long)
+        attention_mask = torch.zeros((len(requests), max_len), dtype=torch.long)
+        for i, request in enumerate(requests):
+            n = len(request.input_ids)
+            input_ids[i, max_len - n:] = torch.tensor(request.input_ids, dtype=torch.long)
+            attention_mask[i, max_len - n:] = 1
+
+        input_ids = input_ids.to(self._device)
+        attention_mask = attention_mask.to(self._device)
+        position_ids = (attention_mask.cumsum(-1) - 1).clamp(min=0)
+
+        cache = DynamicCache()
+        logits = self._forward(input_ids, attention_mask, position_ids, cache, 0)
+        next_tokens = self._sample(logits, requests)
+        positions = attention_mask.sum(-1)
+
+        start = len(self._rows)
+        self._merge(requests, cache, attention_mask, positions, next_tokens)
+        self._deliver(next_tokens.tolist(), start=start)
+
+    def _prefill_from_cache(self, request: GenerationRequest):
+        cache = request.past_key_values
+        request.past_key_values = None
+        prefix_len = cache.get_seq_length()
+        request.cached_tokens = prefix_len
+        total_len = len(request.input_ids)
+
+        suffix = torch.tensor([request.input_ids[prefix_len:]], dtype=torch.long, device=self._device)
+        attention_mask = torch.ones((1, total_len), dtype=torch.long, device=self._device)
+        position_ids = torch.arange(prefix_len, total_len, device=self._device).unsqueeze(0)
+
+        logits = self._forward(suffix, attention_mask, position_ids, cache, prefix_len)
+        next_tokens = self._sample(logits, [request])
+        positions = torch.tensor([total_len], device=self._device)
+
+        start = len(self._rows)
+        self._merge([request], cache, attention_mask, positions, next_tokens)
+        self._deliver(next_tokens.tolist(), start=start)
+
+    def _decode_step(self):
+        cache_len = self._attention_mask.shape[1]
+        attention_mask = torch.cat(
+            [self._attention_mask, torch.ones((len(self._rows), 1), dtype=torch.long, device=self._device)],
+            dim=1
+        )
+        logits = self._forward(
+            self._next_tokens.unsqueeze(1),
+            attention_mask,
+            self._positions.unsqueeze(1),
+            self._cache,
+            cache_len
+        )
+        self._attention_mask = attention_mask
+        self._positions = self._positions + 1
+        self._next_tokens = self._sample(logits, self._rows)
+        self.decode_steps += 1
+
+        self._deliver(self._next_tokens.tolist())
+
+    def _sample(self, logits: torch.Tensor, requests: List[GenerationRequest]) -> torch.Tensor:
+        """Per-row greedy or temperature/top-p sampling"""
+        next_tokens = logits.argmax(dim=-1)
+        sample_rows = [i for i, r in enumerate(requests) if r.do_sample and r.temperature > 0]
+        if not sample_rows:
+            return next_tokens
+
+        rows = torch.tensor(sample_rows, device=logits.device)
+        temperature = torch.tensor([requests[i].temperature for i in sample_rows], device=logits.device)
+        top_p = torch.tensor([requests[i].top_p for i in sample_rows], device=logits.device)
+
+        scores = logits[rows] / temperature.unsqueeze(1)
+        sorted_scores, sorted_idx = scores.sort(dim=-1, descending=True)
+        cumulative = sorted_scores.softmax(dim=-1).cumsum(dim=-1)
+        # Drop tokens outside the nucleus, always keeping the most likely one
+        remove = (cumulative - sorted_scores.softmax(dim=-1)) > top_p.unsqueeze(1)
+        sorted_scores = sorted_scores.masked_fill(remove, float('-inf'))
+        scores = torch.full_like(scores, float('-inf')).scatter(1, sorted_idx, sorted_scores)
+
+        sampled = torch.multinomial(scores.softmax(dim=-1), num_samples=1).squeeze(1)
+        next_tokens[rows] = sampled
+        return next_tokens
+
+    # ------------------------------------------------------------------
+    # Batch bookkeeping
+    # ------------------------------------------------------------------
+
+    def _merge(self, requests, cache, attention_mask, positions, next_tokens):
+        if not self._rows:
+            self._rows = list(requests)
+            self._cache = cache
+            self._attention_mask = attention_mask
+            self._positions = positions
+            self._next_tokens = next_tokens
+            return
+
+        # Left-pad the shorter side so both caches share the same sequence length
+        running_len = self._attention_mask.shape[1]
+        new_len = attention_mask.shape[1]
+        target_len = max(running_len, new_len)
+
+        for layer_idx in range(len(self._cache.key_cache)):
+            for store_running, store_new in ((self._cache.key_cache, cache.key_cache),
+                                             (self._cache.value_cache, cache.value_cache)):
+                store_running[layer_idx] = torch.cat([
+                    _left_pad(store_running[layer_idx], target_len),
+                    _left_pad(store_new[layer_idx], target_len)
+                ], dim=0)
+
+        self._attention_mask = torch.cat([
+            _left_pad_mask(self._attention_mask, target_len),
+            _left_pad_mask(attention_mask, target_len)
+        ], dim=0)
+        self._positions = torch.cat([self._positions, positions])
+        self._next_tokens = torch.cat([self._next_tokens, next_tokens])
+        self._rows.extend(requests)
+
+    def _deliver(self, token_ids: List[int], start: int = 0):
+        """Hand rows[start:] their new tokens, then retire rows that are done"""
+        stop_ids = self.tutor.stop_token_ids
+        keep = list(range(start))
+        now = time.time()
+
+        for i, (request, token_id) in enumerate(zip(self._rows[start:], token_ids), start=start):
+            if request.first_token_at is None:
+                request.first_token_at = now
+
+            is_stop = token_id in stop_ids
+            detokenize_start = time.perf_counter()
+            if not is_stop:
+                request.generated_ids.append(token_id)
+                request.pending_tokens += 1
+                delta = request.detokenizer.add_tokens([token_id])
+                request.pending_text += delta
+                request.tail = (request.tail + delta)[-16:]
+                self.total_tokens += 1
+
+            done = (is_stop or len(request.generated_ids) >= request.max_new_tokens or request.cancelled
+                    or (request.deadline is not None and request.deadline.should_stop(lambda: request.tail)))
+            if done:
+                request.pending_text += request.detokenizer.flush()
+            request.detokenize_time += time.perf_counter() - detokenize_start
+
+            if request.pending_text and (done or request.pending_tokens >= request.stream_chunk_tokens):
+                request.events.put(('chunk', request.pending_text))
+                request.pending_text, request.pending_tokens = "", 0
+
+            if done:
+                self._complete(request, i)
+            else:
+                keep.append(i)
+
+        if len(keep) < len(self._rows):
+            self._select_rows(keep)
+
+    def _complete(self, request: GenerationRequest, row: int):
+        request.finished = True
+        if request.deadline is not None and not request.cancelled:
+            request.deadline.note_length(len(request.generated_ids), request.max_new_tokens)
+        stats = request.stats()
+        if request.keep_cache and not stats['cancelled']:
+            request.final_cache = self._extract_row_cache(row)
+        text = request.detokenizer.text.strip()
+        if stats['cancelled']:
+            metrics.record_cancelled("batched", stats['tokens_generated'], request.max_new_tokens)
+        elif stats['truncated']:
+            metrics.record_truncated("batched")
+        self.tutor.decode_rate.observe(stats['tokens_generated'] - 1, stats['total_time'] - stats['time_to_first_token'])
+        metrics.BATCH_QUEUE.observe(stats['queue_wait'])
+        metrics.record_generation(
+            "batched",
+            prompt_tokens=stats['prompt_tokens'] - request.cached_tokens,
+            tokens=stats['tokens_generated'],
+            prefill=stats['time_to_first_token'] - stats['queue_wait'],
+            decode=stats['total_time'] - stats['time_to_first_token'],
+            detokenize=request.detokenize_time
+        )
+        logger.info(
+            f"⚡ Batched Gemma3n E2B-it: {stats['tokens_generated']} tokens in {stats['total_time']:.3f}s "
+            f"({stats['decode_tok_s']:.1f} tok/s decode) [ttft: {stats['time_to_first_token']:.3f}s] "
+            f"[queue: {stats['queue_wait']:.3f}s] [batch: {len(self._rows)}]{' [cancelled]' if stats['cancelled'] else ''}"
+            f"{' [deadline]' if stats['truncated'] else ''}"
+        )
+        request.events.put(('complete', text, stats))
+
+    def _extract_row_cache(self, row: int) -> DynamicCache:
+        """Copy one row's unpadded KV cache out of the batch"""
+        start = int(self._attention_mask[row].nonzero()[0])
+        cache = DynamicCache()
+        for layer_idx in range(len(self._cache.key_cache)):
+            cache.key_cache.append(self._cache.key_cache[layer_idx][row:row + 1, :, start:].clone())
+            cache.value_cache.append(self._cache.value_cache[layer_idx][row:row + 1, :, start:].clone())
+        return cache
+
+    def _select_rows(self, keep: List[int]):
+        if not keep:
+            self._reset_batch()
+            return
+
+        index = torch.tensor(keep, device=self._device)
+        for layer_idx in range(len(self._cache.key_cache)):
+            self._cache.key_cache[layer_idx] = self._cache.key_cache[layer_idx].index_select(0, index)
+            self._cache.value_cache[layer_idx] = self._cache.value_cache[layer_idx].index_select(0, index)
+        self._attention_mask = self._attention_mask.index_select(0, index)
+        self._positions = self._positions.index_select(0, index)
+        self._next_tokens = self._next_tokens.index_select(0, index)
+        self._rows = [self._rows[i] for i in keep]
+
+        # Drop leading columns that are padding for every remaining row
+        used = self._attention_mask.any(dim=0).nonzero()
+        trim = int(used[0]) if len(used) else 0
+        if trim > 0:
+            for layer_idx in range(len(self._cache.key_cache)):
+                self._cache.key_cache[layer_idx] = self._cache.key_cache[layer_idx][:, :, trim:]
+                self._cache.value_cache[layer_idx] = self._cache.value_cache[layer_idx][:, :, trim:]
+            self._attention_mask = self._attention_mask[:, trim:]
+
+
+def _left_pad(tensor: torch.Tensor, target_len: int) -> torch.Tensor:
+    """Left-pad a [B, H, L, D] cache tensor with zeros along the sequence dimension"""
+    missing = target_len - tensor.shape[2]
+    if missing <= 0:
+        return tensor
+    padding = tensor.new_zeros((tensor.shape[0], tensor.shape[1], missing, tensor.shape[3]))
+    return torch.cat([padding, tensor], dim=2)
+
+
+def _left_pad_mask(mask: torch.Tensor, target_len: int) -> torch.Tensor:
+    missing = target_len - mask.shape[1]
+    if missing <= 0:
+        return mask
+    return torch.cat([mask.new_zeros((mask.shape[0], missing)), mask], dim=1)
@@ -0,0 +1,285 @@
+"""
+Semantic near-duplicate answer cache backed by a NumPy embedding index
+"""
+import logging
+import re
+import sqlite3
+import threading
+import time
+from pathlib import Path
+from typing import Optional, Tuple
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+
+# Words that flip or quantify a question's meaning; two questions only share an
+# answer if they agree on these exactly (embeddings barely notice them)
+NEGATIONS = frozenset(("not", "no", "never", "none", "nothing", "neither", "nor", "without", "cannot"))
+NUMBER_WORDS = frozenset((
+    "zero", "one", "two", "three", "four", "five", "six", "seven", "eight", "nine", "ten", "eleven", "twelve",
+    "first", "second", "third", "half", "hundred", "thousand", "million", "billion",
+))
+# Function words that move around freely when a question is rephrased
+FUNCTION_WORDS = frozenset((
+    "a", "an", "the", "is", "are", "was", "were", "be", "do", "does", "did", "it", "that", "this", "what",
+    "what's", "why", "how", "who", "when", "where", "which", "can", "could", "you", "me", "i", "please",
+    "of", "to", "in", "on", "for", "with", "by", "and", "or", "so", "there",
+))
+_WORD = re.compile(r"\d+(?:[.,]\d+)*|[^\W\d_]+(?:'[^\W\d_]+)?")
+
+
+def _words(question: str) -> list:
+    return _WORD.findall(question.casefold().replace("’", "'"))
+
+
+def questions_agree(first: str, second: str) -> bool:
+    """
+    Whether two similar-looking questions can share an answer: the same numbers
+    in the same order, the same number of negations, and the words they have in
+    common (other than FUNCTION_WORDS) in the same order. Pooled embeddings ignore all three, so "Is 3
+    bigger than 5?" and "Is 5 bigger than 3?" embed identically.
+    """
+    first_words, second_words = _words(first), _words(second)
+
+    def numbers(words):
+        return [w for w in words if w[0].isdigit() or w in NUMBER_WORDS]
+
+    def negations(words):
+        return sum(1 for w in words if w in NEGATIONS or w.endswith("n't"))
+
+    def shared_order(words, other):
+        other, seen, order = set(other) - FUNCTION_WORDS, set(), []
+        for word in words:
+            if word in other and word not in seen:
+                seen.add(word)
+                order.append(word)
+        return order
+
+    return (numbers(first_words) == numbers(second_words)
+            and negations(first_words) == negations(second_words)
+            and shared_order(first_words, second_words) == shared_order(second_words, first_words))
+
+
+def make_partition(subject: str, level: str, language: str, response_style: str = "regular",
+                   max_tokens: int = 256, deterministic: bool = False) -> str:
+    """
+    Answers are only shared between questions asked with the same tutor settings,
+    token budget and sampling mode (the same fields as the exact-match key)
+    """
+    parts = [part.strip().casefold() for part in (subject, level, language, response_style)]
+    return "|".join(parts + [str(int(max_tokens)), "greedy" if deterministic else "sampled"])
+
+
+class SemanticAnswerCache:
+    """
+    Fixed-capacity cosine-similarity index of question embeddings.
+
+    Row i of the [max_entries, dim] float32 matrix holds the unit-normalized
+    embedding stored in slot i. With a `persist_dir` the matrix is a
+    memory-mapped .npy file and slot metadata lives in SQLite, so the index
+    survives restarts without re-embedding. Inserts write one row in place;
+    when full, the least recently used slot is overwritten.
+
+    Lookups given the question text only count a match that questions_agree()
+    with the cached question, trying the next closest one otherwise.
+    """
+
+    def __init__(
+        self,
+        dim: int,
+        threshold: float = 0.92,
+        max_entries: int = 4096,
+        persist_dir: Optional[str] = None,
+        signature: str = ""
+    ):
+        self.dim = dim
+        # What produced the vectors (model and embedding mode); a persisted index made by anything else is rebuilt
+        self.signature = signature
+        self.threshold = threshold
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._db = None
+
+        # Per-slot metadata kept in NumPy arrays for vectorized filtering
+        self._partition_ids = np.full(max_entries, -1, dtype=np.int32)
+        self._last_used = np.zeros(max_entries, dtype=np.float64)
+        self._answers = [None] * max_entries
+        self._questions = [None] * max_entries
+        self._partitions = {}
+        self._count = 0
+
+        self.hits = 0
+        self.misses = 0
+        self.disagreements = 0
+        self.evictions = 0
+
+        if persist_dir:
+            self._vectors = self._open_persisted(Path(persist_dir))
+        else:
+            self._vectors = np.zeros((max_entries, dim), dtype=np.float32)
+
+    # ------------------------------------------------------------------
+    # Persistence
+    # ------------------------------------------------------------------
+
+    def _open_persisted(self, persist_dir: Path) -> np.ndarray:
+        persist_dir.mkdir(parents=True, exist_ok=True)
+        vectors_path = persist_dir / "vectors.npy"
+
+        vectors = None
+        if vectors_path.exists():
+            try:
+                vectors = np.load(vectors_path, mmap_mode="r+")
+                if vectors.shape != (self.max_entries, self.dim) or vectors.dtype != np.float32:
+                    logger.warning(f"⚠️ Semantic cache index shape {vectors.shape} does not match, rebuilding")
+                    del vectors
+                    vectors = None
+            except (ValueError, OSError) as e:
+                logger.warning(f"⚠️ Could not open semantic cache index, rebuilding: {e}")
+                vectors = None
+
+        rebuilt = vectors is None
+        if rebuilt:
+            vectors = np.lib.format.open_memmap(
+                vectors_path, mode="w+", dtype=np.float32, shape=(self.max_entries, self.dim)
+            )
+
+        self._db = sqlite3.connect(str(persist_dir / "entries.sqlite"), check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS entries ("
+            "slot INTEGER PRIMARY KEY, partition TEXT NOT NULL, question TEXT, "
+            "answer TEXT NOT NULL, created_at REAL NOT NULL, last_used REAL NOT NULL)"
+        )
+        self._db.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT NOT NULL)")
+        stored = self._db.execute("SELECT value FROM meta WHERE key = 'signature'").fetchone()
+        if not rebuilt and (stored[0] if stored else "") != self.signature:
+            logger.warning(f"⚠️ Semantic cache index was built by {stored[0] if stored else 'an unknown embedder'!r}, "
+                           f"not {self.signature!r}; rebuilding")
+            vectors[:] = 0
+            rebuilt = True
+        if rebuilt:
+            self._db.execute("DELETE FROM entries")
+        self._db.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('signature', ?)", (self.signature,))
+        self._db.commit()
+
+        rows = self._db.execute(
+            "SELECT slot, partition, question, answer, last_used FROM entries WHERE slot < ?", (self.max_entries,)
+        ).fetchall()
+        for slot, partition, question, answer, last_used in rows:
+            self._partition_ids[slot] = self._partition_id(partition)
+            self._questions[slot] = question
+            self._answers[slot] = answer
+            self._last_used[slot] = last_used
+        self._count = len(rows)
+
+        logger.info(f"💾 Semantic cache loaded {self._count} entries from {persist_dir}")
+        return vectors
+
+    def _partition_id(self, partition: str) -> int:
+        if partition not in self._partitions:
+            self._partitions[partition] = len(self._partitions)
+        return self._partitions[partition]
+
+    # ------------------------------------------------------------------
+    # Lookup / insert
+    # ------------------------------------------------------------------
+
+    def _normalize(self, vector: np.ndarray) -> np.ndarray:
+        vector = np.asarray(vector, dtype=np.float32).reshape(-1)
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm > 0 else vector
+
+    def lookup(self, vector: np.ndarray, partition: str, question: Optional[str] = None) -> Optional[Tuple[str, float]]:
+        """
+        Return (answer, similarity) of the closest cached question above the
+        threshold (that agrees with `question`, when given)
+        """
+        query = self._normalize(vector)
+        with self._lock:
+            partition_id = self._partitions.get(partition)
+            if partition_id is None:
+                self.misses += 1
+                return None
+
+            slots = np.flatnonzero(self._partition_ids == partition_id)
+            if len(slots) == 0:
+                self.misses += 1
+                return None
+
+            scores = self._vectors[slots] @ query
+            for best in np.argsort(-scores):
+                score = float(scores[best])
+                if score < self.threshold:
+                    break
+                slot = int(slots[best])
+                if question is not None and not (self._questions[slot] and questions_agree(question, self._questions[slot])):
+                    self.disagreements += 1
+                    continue
+                self._last_used[slot] = time.time()
+                self.hits += 1
+                return self._answers[slot], score
+
+            self.misses += 1
+            return None
+
+    def insert(self, vector: np.ndarray, partition: str, answer: str, question: str = ""):
+        now = time.time()
+        with self._lock:
+            slot = self._free_slot()
+            self._vectors[slot] = self._normalize(vector)
+            self._partition_ids[slot] = self._partition_id(partition)
+            self._answers[slot] = answer
+            self._questions[slot] = question
+            self._last_used[slot] = now
+
+            if self._db is not None:
+                try:
+                    self._db.execute(
+                        "INSERT OR REPLACE INTO entries (slot, partition, question, answer, created_at, last_used) "
+                        "VALUES (?, ?, ?, ?, ?, ?)",
+                        (slot, partition, question, answer, now, now)
+                    )
+                    self._db.commit()
+                except sqlite3.Error as e:
+                    logger.warning(f"⚠️ Failed to persist semantic cache entry: {e}")
+
+    def _free_slot(self) -> int:
+        empty = np.flatnonzero(self._partition_ids < 0)
+        if len(empty):
+            self._count += 1
+            return int(empty[0])
+        # Full: overwrite the least recently used slot
+        self.evictions += 1
+        return int(np.argmin(self._last_used))
+
+    def flush(self):
+        """Write pending vector rows and recency to disk"""
+        with self._lock:
+            if isinstance(self._vectors, np.memmap):
+                self._vectors.flush()
+            if self._db is not None:
+                used = np.flatnonzero(self._partition_ids >= 0)
+                self._db.executemany(
+                    "UPDATE entries SET last_used = ? WHERE slot = ?",
+                    [(float(self._last_used[slot]), int(slot)) for slot in used]
+                )
+                self._db.commit()
+
+    def get_stats(self) -> dict:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'entries': self._count,
+                'max_entries': self.max_entries,
+                'partitions': len(self._partitions),
+                'threshold': self.threshold,
+                'hits': self.hits,
+                'misses': self.misses,
+                'disagreements': self.disagreements,
+                'hit_rate': round(self.hits / lookups, 3) if lookups else 0.0,
+                'evictions': self.evictions,
+                'persisted': self._db is not None,
+            }
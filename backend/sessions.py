@@ -0,0 +1,142 @@
+"""
+Multi-turn tutoring sessions with per-client KV cache reuse
+"""
+import logging
+import threading
+import time
+from collections import OrderedDict
+from typing import List, Optional
+
+logger = logging.getLogger(__name__)
+
+
+class TutorSession:
+    """
+    Conversation state for one socket client.
+
+    `token_ids` is the full transcript as the model saw it (without trailing
+    stop tokens) and `cache` holds past_key_values for its first
+    `cache.get_seq_length()` tokens, so a follow-up only prefills the new turn.
+    """
+
+    def __init__(self, sid: str, signature: tuple):
+        self.sid = sid
+        self.signature = signature
+        self.messages: List[dict] = []
+        self.token_ids: List[int] = []
+        self.cache = None
+        self.nbytes = 0
+        self.turns = 0
+        self.busy = False
+        self.created_at = time.time()
+        self.last_used = self.created_at
+
+    @property
+    def has_history(self) -> bool:
+        return self.turns > 0
+
+    def record_turn(self, messages: List[dict], token_ids: List[int], cache):
+        """Store the transcript after a completed answer"""
+        from prefix_cache import cache_nbytes  # transformers is only needed where the model runs
+
+        self.messages = messages
+        self.token_ids = list(token_ids)
+        self.cache = cache
+        self.nbytes = cache_nbytes(cache) if cache is not None else 0
+        self.turns += 1
+        self.last_used = time.time()
+
+    def mark_turn(self):
+        """Count a turn whose transcript and KV cache are held by the inference worker"""
+        self.turns += 1
+        self.last_used = time.time()
+
+    def drop_cache(self):
+        """Free the KV memory but keep the transcript (the next turn re-prefills it)"""
+        self.cache = None
+        self.nbytes = 0
+
+
+class SessionStore:
+    """Sessions keyed by socket sid, with KV memory bounded by a global byte budget"""
+
+    def __init__(self, max_bytes: int, idle_seconds: float = 1800, max_tokens: int = 4096):
+        self.max_bytes = max_bytes
+        self.idle_seconds = idle_seconds
+        self.max_tokens = max_tokens
+        self._sessions: "OrderedDict[str, TutorSession]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.evicted_caches = 0
+        self.expired_sessions = 0
+
+    def get(self, sid: str, signature: tuple, reset: bool = False) -> TutorSession:
+        """Return the client's session, starting a new one if settings changed or on reset"""
+        with self._lock:
+            session = self._sessions.get(sid)
+            if (session is None or reset or session.signature != signature
+                    or len(session.token_ids) >= self.max_tokens):
+                session = TutorSession(sid, signature)
+                self._sessions[sid] = session
+            self._sessions.move_to_end(sid)
+            session.last_used = time.time()
+            return session
+
+    def commit(self, session: TutorSession):
+        """Account for a session's new KV cache and evict others to stay within budget"""
+        with self._lock:
+            if self._sessions.get(session.sid) is not session:
+                # Client disconnected (or reset) while generating
+                session.drop_cache()
+                return
+            self._sessions.move_to_end(session.sid)
+            self._expire_idle()
+            self._enforce_budget(keep=session)
+
+    def drop(self, sid: str) -> bool:
+        with self._lock:
+            session = self._sessions.pop(sid, None)
+        if session is not None:
+            session.drop_cache()
+            return True
+        return False
+
+    def _expire_idle(self):
+        if self.idle_seconds <= 0:
+            return
+        cutoff = time.time() - self.idle_seconds
+        for sid in [sid for sid, s in self._sessions.items() if s.last_used < cutoff and not s.busy]:
+            self._sessions.pop(sid).drop_cache()
+            self.expired_sessions += 1
+
+    def _enforce_budget(self, keep: Optional[TutorSession] = None):
+        total = sum(s.nbytes for s in self._sessions.values())
+        # Least recently used first; the session that was just updated goes last
+        for session in list(self._sessions.values()):
+            if total <= self.max_bytes:
+                break
+            if session is keep or session.busy or session.cache is None:
+                continue
+            total -= session.nbytes
+            session.drop_cache()
+            self.evicted_caches += 1
+        if total > self.max_bytes and keep is not None and keep.cache is not None:
+            total -= keep.nbytes
+            keep.drop_cache()
+            self.evicted_caches += 1
+
+    def sweep(self):
+        """Drop idle sessions; call periodically"""
+        with self._lock:
+            self._expire_idle()
+
+    def get_stats(self) -> dict:
+        with self._lock:
+            total = sum(s.nbytes for s in self._sessions.values())
+            return {
+                'sessions': len(self._sessions),
+                'cached_sessions': sum(1 for s in self._sessions.values() if s.cache is not None),
+                'memory_mb': round(total / 1024**2, 2),
+                'budget_mb': round(self.max_bytes / 1024**2, 2),
+                'evicted_caches': self.evicted_caches,
+                'expired_sessions': self.expired_sessions,
+            }
@@ -0,0 +1,199 @@
+"""
+Speculative (assisted) decoding: tokens proposed by a small draft model, or
+by n-gram lookup in the prompt, verified by the main model in one pass
+"""
+import logging
+import threading
+from collections import deque
+from contextlib import contextmanager
+from typing import Optional
+
+import torch
+
+logger = logging.getLogger(__name__)
+
+
+class SpeculationStats:
+    """Draft tokens proposed and accepted during one generate() call"""
+
+    def __init__(self, mode: str):
+        self.mode = mode
+        self.steps = 0        # Verification passes of the main model
+        self.proposed = 0
+        self.accepted = 0
+
+    @property
+    def acceptance(self) -> float:
+        return self.accepted / self.proposed if self.proposed else 0.0
+
+    @property
+    def tokens_per_step(self) -> float:
+        # Every verification pass also yields the main model's own next token
+        return (self.accepted + self.steps) / self.steps if self.steps else 0.0
+
+    def describe(self) -> str:
+        return (f"[spec {self.mode}: {self.accepted}/{self.proposed} accepted "
+                f"({self.acceptance:.0%}), {self.tokens_per_step:.2f} tok/step]")
+
+
+class SpeculativeDecoder:
+    """
+    Assisted generation for AITutor, in one of two modes per request:
+
+    draft  - a draft model proposes `num_tokens` tokens that the main model
+             verifies in one forward pass. Acceptance is tracked per request;
+             once the mean over the last `window` requests drops below
+             `min_acceptance` the draft costs more than it saves, so it is
+             switched off (and freed) for the rest of the process.
+    ngram  - prompt lookup: when the question is at least `lookup_min_tokens`
+             long, continuations are copied from earlier matches of the last
+             1..`lookup_max_ngram` tokens in the prompt. Answers that quote a
+             pasted passage get several tokens per step at no memory cost.
+    """
+
+    def __init__(self, num_tokens: int = 5, min_acceptance: float = 0.35, window: int = 8,
+                 lookup_tokens: int = 10, lookup_max_ngram: int = 3, lookup_min_tokens: int = 150):
+        self.num_tokens = max(1, num_tokens)
+        self.min_acceptance = min_acceptance
+        self.window = max(1, window)
+        self.lookup_tokens = lookup_tokens      # 0 disables prompt lookup
+        self.lookup_max_ngram = max(1, lookup_max_ngram)
+        self.lookup_min_tokens = lookup_min_tokens
+        self.draft_model = None
+        self.draft_tokenizer = None
+        self.draft_model_id = None
+        self.disabled_reason: Optional[str] = None
+        self._recent = deque(maxlen=self.window)
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self.totals = {mode: {'requests': 0, 'proposed': 0, 'accepted': 0} for mode in ('draft', 'ngram')}
+
+    @property
+    def enabled(self) -> bool:
+        return self.draft_model is not None and self.disabled_reason is None
+
+    def load_draft(self, model_id: str, target_model, target_vocab_size: int, token: str = None):
+        """Load the draft model next to the main model (same device and dtype)"""
+        from transformers import AutoModelForCausalLM, AutoTokenizer
+
+        logger.info(f"🧪 Loading draft model {model_id} for speculative decoding...")
+        draft = AutoModelForCausalLM.from_pretrained(
+            model_id,
+            torch_dtype=target_model.dtype,
+            token=token,
+            low_cpu_mem_usage=True,
+            local_files_only=True
+        ).to(target_model.device).eval()
+        draft.generation_config.num_assistant_tokens = self.num_tokens
+        draft.generation_config.num_assistant_tokens_schedule = "constant"
+
+        # A draft with a different vocabulary needs both tokenizers (universal assisted decoding)
+        if draft.config.get_text_config().vocab_size != target_vocab_size:
+            self.draft_tokenizer = AutoTokenizer.from_pretrained(model_id, token=token, local_files_only=True)
+            logger.info("🔀 Draft vocabulary differs from the main model; translating between tokenizers")
+
+        self.draft_model = draft
+        self.draft_model_id = model_id
+        params = sum(p.numel() for p in draft.parameters())
+        logger.info(f"✅ Draft model ready ({params / 1e6:.0f}M params, {self.num_tokens} tokens per step)")
+
+    def install(self, model):
+        """Count proposed/accepted tokens for whichever candidate generator `model.generate()` builds"""
+        if getattr(model, '_speculation_installed', False):
+            return
+        original = model._get_candidate_generator
+
+        def get_candidate_generator(*args, **kwargs):
+            generator = original(*args, **kwargs)
+            stats = getattr(self._local, 'stats', None)
+            if stats is not None:
+                _instrument(generator, stats)
+            return generator
+
+        model._get_candidate_generator = get_candidate_generator
+        model._speculation_installed = True
+
+    def choose_mode(self, question_tokens: int) -> Optional[str]:
+        """'draft', 'ngram' or None (plain decoding) for a question of this many tokens"""
+        if self.enabled:
+            return "draft"
+        if self.lookup_tokens > 0 and question_tokens >= self.lookup_min_tokens:
+            return "ngram"
+        return None
+
+    def generate_kwargs(self, mode: Optional[str], tokenizer) -> dict:
+        """Extra model.generate() arguments for the chosen mode (empty for plain decoding)"""
+        if mode == "draft" and self.enabled:
+            kwargs = {"assistant_model": self.draft_model, "num_assistant_tokens": self.num_tokens}
+            if self.draft_tokenizer is not None:
+                kwargs.update(tokenizer=tokenizer, assistant_tokenizer=self.draft_tokenizer)
+            return kwargs
+        if mode == "ngram":
+            return {"prompt_lookup_num_tokens": self.lookup_tokens, "max_matching_ngram_size": self.lookup_max_ngram}
+        return {}
+
+    @contextmanager
+    def track(self, mode: str):
+        """Collect SpeculationStats for the generate() call made inside the block (this thread only)"""
+        stats = SpeculationStats(mode)
+        self._local.stats = stats
+        try:
+            yield stats
+        finally:
+            self._local.stats = None
+
+    def record(self, stats: SpeculationStats):
+        """Add a finished request's acceptance and apply the draft auto-disable rule"""
+        with self._lock:
+            totals = self.totals[stats.mode]
+            totals['requests'] += 1
+            totals['proposed'] += stats.proposed
+            totals['accepted'] += stats.accepted
+            if stats.mode != "draft" or stats.proposed == 0:
+                return
+            self._recent.append(stats.acceptance)
+            if len(self._recent) < self.window or self.disabled_reason is not None:
+                return
+            mean = sum(self._recent) / len(self._recent)
+            if mean >= self.min_acceptance:
+                return
+            self.disabled_reason = (f"acceptance {mean:.0%} over the last {len(self._recent)} requests "
+                                    f"is below {self.min_acceptance:.0%}")
+            self.draft_model = None
+        logger.warning(f"🐢 Speculative decoding disabled: {self.disabled_reason}")
+
+    def get_stats(self) -> dict:
+        with self._lock:
+            totals = {
+                mode: dict(t, acceptance=round(t['accepted'] / t['proposed'], 3) if t['proposed'] else None)
+                for mode, t in self.totals.items()
+            }
+            return {
+                'draft_model': self.draft_model_id,
+                'enabled': self.enabled,
+                'disabled_reason': self.disabled_reason,
+                'num_tokens': self.num_tokens,
+                'recent_acceptance': round(sum(self._recent) / len(self._recent), 3) if self._recent else None,
+                'prompt_lookup_min_tokens': self.lookup_min_tokens if self.lookup_tokens > 0 else None,
+                'draft': totals['draft'],
+                'ngram': totals['ngram'],
+            }
+
+
+def _instrument(generator, stats: SpeculationStats):
+    """Wrap one candidate generator so it reports into `stats`"""
+    get_candidates = generator.get_candidates
+    update_candidate_strategy = generator.update_candidate_strategy
+
+    def counted_get_candidates(input_ids: torch.LongTensor):
+        candidate_ids, candidate_logits = get_candidates(input_ids)
+        stats.proposed += candidate_ids.shape[1] - input_ids.shape[1]
+        return candidate_ids, candidate_logits
+
+    def counted_update(input_ids, scores, num_matches):
+        stats.steps += 1
+        stats.accepted += int(num_matches)
+        return update_candidate_strategy(input_ids, scores, num_matches)
+
+    generator.get_candidates = counted_get_candidates
+    generator.update_candidate_strategy = counted_update
@@ -0,0 +1,188 @@
+"""
+Incremental token streaming for Gemma3n generation
+"""
+import logging
+import threading
+import time
+from typing import Callable, Iterable, List, Optional, Set
+
+import torch
+from transformers import StoppingCriteria
+from transformers.generation.streamers import BaseStreamer
+
+from deadline import Deadline
+
+logger = logging.getLogger(__name__)
+
+
+class IncrementalDetokenizer:
+    """Turn a growing list of token ids into text deltas without re-decoding the whole answer"""
+
+    def __init__(self, tokenizer, skip_special_tokens: bool = True):
+        self.tokenizer = tokenizer
+        self.skip_special_tokens = skip_special_tokens
+        self.token_ids: List[int] = []
+        # Only the window [prefix_offset:] is decoded on every step. The prefix
+        # keeps SentencePiece word boundaries (leading spaces) intact.
+        self.prefix_offset = 0
+        self.read_offset = 0
+
+    def _decode(self, token_ids: List[int]) -> str:
+        return self.tokenizer.decode(token_ids, skip_special_tokens=self.skip_special_tokens)
+
+    def add_tokens(self, token_ids: List[int]) -> str:
+        """Append new token ids and return the newly completed text (may be empty)"""
+        self.token_ids.extend(token_ids)
+
+        prefix_text = self._decode(self.token_ids[self.prefix_offset:self.read_offset])
+        new_text = self._decode(self.token_ids[self.prefix_offset:])
+
+        # Wait for more tokens while a multi-byte character is still incomplete
+        if len(new_text) > len(prefix_text) and not new_text.endswith("�"):
+            delta = new_text[len(prefix_text):]
+            self.prefix_offset = self.read_offset
+            self.read_offset = len(self.token_ids)
+            return delta
+        return ""
+
+    def flush(self) -> str:
+        """Return whatever text is still held back at the end of generation"""
+        prefix_text = self._decode(self.token_ids[self.prefix_offset:self.read_offset])
+        new_text = self._decode(self.token_ids[self.prefix_offset:])
+        self.prefix_offset = self.read_offset = len(self.token_ids)
+        return new_text[len(prefix_text):] if len(new_text) > len(prefix_text) else ""
+
+    @property
+    def text(self) -> str:
+        return self._decode(self.token_ids)
+
+
+class CallbackStreamer(BaseStreamer):
+    """
+    Streamer for model.generate that calls on_chunk(text) while decoding is still running.
+
+    The first put() from generate carries the prompt and is skipped. Text is
+    flushed every `chunk_tokens` generated tokens.
+    """
+
+    def __init__(
+        self,
+        tokenizer,
+        on_chunk: Callable[[str], None],
+        chunk_tokens: int = 1,
+        skip_special_tokens: bool = True,
+        on_first_token: Optional[Callable[[], None]] = None
+    ):
+        self.detokenizer = IncrementalDetokenizer(tokenizer, skip_special_tokens=skip_special_tokens)
+        self.on_chunk = on_chunk
+        self.on_first_token = on_first_token
+        self.chunk_tokens = max(1, chunk_tokens)
+        self.prompt_seen = False
+        self.pending_text = ""
+        self.pending_tokens = 0
+        self.tokens_generated = 0
+        self.first_token_time: Optional[float] = None
+        self.detokenize_time = 0.0
+
+    def put(self, value):
+        if not self.prompt_seen:
+            self.prompt_seen = True
+            return
+
+        if len(value.shape) > 1:
+            if value.shape[0] > 1:
+                raise ValueError("CallbackStreamer only supports batch size 1")
+            value = value[0]
+
+        token_ids = value.tolist()
+        if not token_ids:
+            return
+
+        if self.first_token_time is None:
+            self.first_token_time = time.time()
+            if self.on_first_token is not None:
+                self.on_first_token()
+
+        self.tokens_generated += len(token_ids)
+        self.pending_tokens += len(token_ids)
+        start = time.perf_counter()
+        self.pending_text += self.detokenizer.add_tokens(token_ids)
+        self.detokenize_time += time.perf_counter() - start
+
+        if self.pending_tokens >= self.chunk_tokens and self.pending_text:
+            self._emit()
+
+    def end(self):
+        start = time.perf_counter()
+        self.pending_text += self.detokenizer.flush()
+        self.detokenize_time += time.perf_counter() - start
+        if self.pending_text:
+            self._emit()
+
+    def _emit(self):
+        text, self.pending_text, self.pending_tokens = self.pending_text, "", 0
+        try:
+            self.on_chunk(text)
+        except Exception as e:
+            # A failed emit (e.g. client gone) must not abort generation for the caller
+            logger.warning(f"⚠️ Stream callback failed: {e}")
+
+    @property
+    def text(self) -> str:
+        return self.detokenizer.text
+
+
+class RowFinishedCriteria(StoppingCriteria):
+    """
+    Report each row of a batched model.generate as soon as it emits a stop token.
+
+    on_finished(row, token_ids) gets the row's generated ids (stop token
+    included) while the rest of the batch keeps decoding; the row itself is
+    marked done so generate pads it from then on.
+    """
+
+    def __init__(self, prompt_length: int, stop_token_ids: Iterable[int],
+                 on_finished: Callable[[int, torch.Tensor], None]):
+        self.prompt_length = prompt_length
+        self.stop_token_ids = set(stop_token_ids)
+        self.on_finished = on_finished
+        self.finished: Set[int] = set()
+
+    def __call__(self, input_ids: torch.LongTensor, scores: torch.FloatTensor, **kwargs) -> torch.BoolTensor:
+        for row, token_id in enumerate(input_ids[:, -1].tolist()):
+            if row not in self.finished and token_id in self.stop_token_ids:
+                self.finished.add(row)
+                try:
+                    self.on_finished(row, input_ids[row, self.prompt_length:])
+                except Exception as e:
+                    logger.warning(f"⚠️ Row callback failed: {e}")
+        return torch.tensor([row in self.finished for row in range(input_ids.shape[0])],
+                            dtype=torch.bool, device=input_ids.device)
+
+
+class CancelledCriteria(StoppingCriteria):
+    """Stop model.generate after the current step once `event` is set"""
+
+    def __init__(self, event: threading.Event):
+        self.event = event
+
+    def __call__(self, input_ids: torch.LongTensor, scores: torch.FloatTensor, **kwargs) -> torch.BoolTensor:
+        return torch.full((input_ids.shape[0],), self.event.is_set(), dtype=torch.bool, device=input_ids.device)
+
+
+class DeadlineCriteria(StoppingCriteria):
+    """Stop model.generate (batch of one) when its Deadline says so"""
+
+    def __init__(self, deadline: Deadline, tokenizer, prompt_length: int, tail_tokens: int = 4):
+        self.deadline = deadline
+        self.tokenizer = tokenizer
+        self.prompt_length = prompt_length
+        self.tail_tokens = tail_tokens
+
+    def __call__(self, input_ids: torch.LongTensor, scores: torch.FloatTensor, **kwargs) -> torch.BoolTensor:
+        def tail() -> str:
+            start = max(self.prompt_length, input_ids.shape[1] - self.tail_tokens)
+            return self.tokenizer.decode(input_ids[0, start:], skip_special_tokens=True)
+
+        stop = self.deadline.should_stop(tail)
+        return torch.full((input_ids.shape[0],), stop, dtype=torch.bool, device=input_ids.device)
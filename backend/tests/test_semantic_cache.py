@@ -0,0 +1,91 @@
+"""
+Semantic cache matching: paraphrases share answers, near misses don't
+
+Pooled embeddings score the near misses below at (or close to) 1.0, so
+these use the same vector for both questions and rely on questions_agree().
+"""
+import numpy as np
+import pytest
+
+from semantic_cache import SemanticAnswerCache, make_partition, questions_agree
+
+PARAPHRASES = [
+    ("What is photosynthesis?", "Can you explain what photosynthesis is?"),
+    ("Why is the sky blue?", "Why is it that the sky is blue?"),
+    ("How do plants make their food?", "How do plants make food?"),
+    ("What's 12 times 7?", "What is 12 times 7?"),
+    ("Explain the water cycle", "Please explain the water cycle to me"),
+]
+
+NEAR_MISSES = [
+    ("Is 3 bigger than 5?", "Is 5 bigger than 3?"),
+    ("What is 12 times 7?", "What is 12 times 8?"),
+    ("What is half of ten?", "What is half of twelve?"),
+    ("Why is ice not denser than water?", "Why is ice denser than water?"),
+    ("Isn't zero an even number?", "Is zero an even number?"),
+    ("Does heat flow from cold to hot?", "Does heat flow from hot to cold?"),
+]
+
+PARTITION = make_partition("Math", "middle_school", "English")
+
+
+def vector(seed: int, dim: int = 16) -> np.ndarray:
+    return np.random.default_rng(seed).standard_normal(dim).astype(np.float32)
+
+
+@pytest.mark.parametrize("first,second", PARAPHRASES)
+def test_paraphrases_agree(first, second):
+    assert questions_agree(first, second)
+    assert questions_agree(second, first)
+
+
+@pytest.mark.parametrize("first,second", NEAR_MISSES)
+def test_near_misses_disagree(first, second):
+    assert not questions_agree(first, second)
+    assert not questions_agree(second, first)
+
+
+@pytest.mark.parametrize("cached,asked", PARAPHRASES)
+def test_paraphrase_hits(cached, asked):
+    cache = SemanticAnswerCache(dim=16)
+    cache.insert(vector(0), PARTITION, "answer", question=cached)
+    assert cache.lookup(vector(0), PARTITION, question=asked) == ("answer", pytest.approx(1.0))
+
+
+@pytest.mark.parametrize("cached,asked", NEAR_MISSES)
+def test_near_miss_misses_at_full_similarity(cached, asked):
+    cache = SemanticAnswerCache(dim=16)
+    cache.insert(vector(0), PARTITION, "answer", question=cached)
+    assert cache.lookup(vector(0), PARTITION, question=asked) is None
+    assert cache.get_stats()['disagreements'] == 1
+
+
+def test_falls_through_to_next_closest_agreeing_question():
+    cache = SemanticAnswerCache(dim=16, threshold=0.9)
+    close = vector(0)
+    cache.insert(close, PARTITION, "3 > 5 answer", question="Is 3 bigger than 5?")
+    cache.insert(close + 0.05 * vector(1), PARTITION, "5 > 3 answer", question="Is 5 bigger than 3?")
+    answer, score = cache.lookup(close, PARTITION, question="Is 5 larger than 3?")
+    assert answer == "5 > 3 answer" and score < 1.0
+
+
+def test_partitions_separate_budgets_and_sampling():
+    cache = SemanticAnswerCache(dim=16)
+    cache.insert(vector(0), make_partition("Math", "middle_school", "English", max_tokens=50), "short",
+                 question="What is a prime number?")
+    for partition in (make_partition("Math", "middle_school", "English", max_tokens=1024),
+                      make_partition("Math", "middle_school", "English", max_tokens=50, deterministic=True)):
+        assert cache.lookup(vector(0), partition, question="What is a prime number?") is None
+
+
+def test_persisted_index_is_rebuilt_for_another_embedder(tmp_path):
+    cache = SemanticAnswerCache(dim=16, persist_dir=str(tmp_path), signature="gemma|input")
+    cache.insert(vector(0), PARTITION, "answer", question="What is a prime number?")
+    cache.flush()
+
+    reopened = SemanticAnswerCache(dim=16, persist_dir=str(tmp_path), signature="gemma|input")
+    assert reopened.lookup(vector(0), PARTITION, question="What is a prime number?")[0] == "answer"
+
+    other = SemanticAnswerCache(dim=16, persist_dir=str(tmp_path), signature="gemma|hidden")
+    assert other.get_stats()['entries'] == 0
+    assert other.lookup(vector(0), PARTITION, question="What is a prime number?") is None
@@ -0,0 +1,92 @@
+"""
+Anonymized request traces for load_test.py replay
+
+One JSON line per tutor request: when it arrived, from which (hashed)
+client, its settings and sizes. Question text is only stored when
+explicitly enabled, so traces from real students can be shared safely.
+"""
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+from pathlib import Path
+from typing import Optional
+
+logger = logging.getLogger(__name__)
+
+TRACE_SETTINGS = ('subject', 'level', 'language', 'response_style', 'max_tokens', 'deterministic', 'new_conversation')
+
+
+class TraceRecorder:
+    """Appends request records to a JSONL file (safe to call from any thread)"""
+
+    def __init__(self, path: str, include_text: bool = False):
+        self.path = Path(path)
+        self.include_text = include_text
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self._file = open(self.path, 'a', encoding='utf-8')
+        self._lock = threading.Lock()
+        # Per-process salt: the same client maps to the same id within one trace only
+        self._salt = os.urandom(16)
+        self.recorded = 0
+        logger.info(f"📼 Recording request traces to {self.path}")
+
+    def _client(self, client_id: str) -> str:
+        return hashlib.sha256(self._salt + client_id.encode()).hexdigest()[:12]
+
+    def record(self, client_id: str, kind: str, question: str = "", settings: Optional[dict] = None,
+               image_bytes: Optional[int] = None, image_type: Optional[str] = None):
+        entry = {
+            't': round(time.time(), 3),
+            'client': self._client(client_id),
+            'kind': kind,
+            'question_chars': len(question),
+        }
+        if self.include_text:
+            entry['question'] = question
+        if settings:
+            entry['settings'] = {k: settings[k] for k in TRACE_SETTINGS if k in settings}
+        if image_bytes is not None:
+            entry['image_bytes'] = image_bytes
+            entry['image_type'] = image_type
+        line = json.dumps(entry, ensure_ascii=False) + '\n'
+        try:
+            with self._lock:
+                self._file.write(line)
+                self._file.flush()
+                self.recorded += 1
+        except (OSError, ValueError) as e:
+            logger.warning(f"⚠️ Could not write trace record: {e}")
+
+    def record_event(self, client_id: str, event: str, data: dict):
+        """Record an incoming `ask_ai_tutor` / `ask_image_question` payload"""
+        if not isinstance(data, dict):
+            return
+        if event == 'ask_image_question':
+            image = data.get('image')
+            if image is not None:
+                size = len(image)
+            else:
+                # Base64 data URL: about 3 bytes per 4 characters
+                size = len(data.get('image_url') or '') * 3 // 4
+            self.record(client_id, 'image', data.get('question') or '', image_bytes=size,
+                        image_type=data.get('image_type', 'image/jpeg'))
+        else:
+            self.record(client_id, 'text', data.get('message') or '', settings=data.get('settings') or {})
+
+    def close(self):
+        with self._lock:
+            self._file.close()
+
+
+def load_traces(path: str) -> list:
+    """Trace records sorted by arrival time, with `t` made relative to the first request"""
+    with open(path, encoding='utf-8') as f:
+        records = sorted((json.loads(line) for line in f if line.strip()), key=lambda r: r.get('t', 0))
+    if records:
+        start = records[0].get('t', 0)
+        for record in records:
+            record['t'] = round(record.get('t', 0) - start, 3)
+    return records
@@ -0,0 +1,313 @@
+"""
+Pre-converted weight snapshots: the model's tensors written once in the runtime dtype
+and memory-mapped on later starts, so loading is a page-cache lookup instead of a conversion
+
+    python weight_snapshot.py --build            # write the snapshot for this machine's dtype
+    python weight_snapshot.py --compare          # reload time and RSS: Hugging Face cache vs snapshot
+"""
+import argparse
+import json
+import logging
+import mmap
+import os
+import struct
+import subprocess
+import sys
+import time
+from pathlib import Path
+from typing import Callable, Dict, Optional
+
+import torch
+
+logger = logging.getLogger(__name__)
+
+SNAPSHOT_FILE = "model.safetensors"
+SNAPSHOT_FORMAT = 1
+
+_SAFETENSORS_DTYPES = {
+    "F64": torch.float64, "F32": torch.float32, "F16": torch.float16, "BF16": torch.bfloat16,
+    "I64": torch.int64, "I32": torch.int32, "I16": torch.int16, "I8": torch.int8,
+    "U8": torch.uint8, "BOOL": torch.bool,
+}
+
+
+def default_snapshot_dir() -> Path:
+    return Path.home() / '.cache' / 'ai_tutor' / 'snapshots'
+
+
+def source_revision(model_id: str) -> Optional[str]:
+    """Commit hash of the cached Hub snapshot the weights come from (None if unknown)"""
+    try:
+        from huggingface_hub import try_to_load_from_cache
+        config_path = try_to_load_from_cache(model_id, 'config.json')
+        if isinstance(config_path, str):
+            return Path(config_path).parent.name
+    except Exception:
+        pass
+    return None
+
+
+class WeightSnapshot:
+    """
+    One model variant (model id, revision, dtype, optional quantization) stored as a single
+    safetensors file plus its config.
+
+    Loading builds the model on the meta device and points every parameter and
+    buffer at a slice of the memory-mapped file, so nothing is copied or
+    converted and processes loading the same snapshot share its pages.
+    """
+
+    def __init__(self, directory: Path, fingerprint: dict):
+        self.directory = Path(directory)
+        self.fingerprint = fingerprint
+        self.path = self.directory / SNAPSHOT_FILE
+
+    @classmethod
+    def for_model(cls, model_id: str, dtype: torch.dtype, variant: str = "", base_dir: Optional[str] = None):
+        dtype_name = str(dtype).replace('torch.', '')
+        name = model_id.replace('/', '--') + f"-{dtype_name}" + (f"-{variant}" if variant else "")
+        fingerprint = {
+            'format': SNAPSHOT_FORMAT,
+            'model_id': model_id,
+            'revision': source_revision(model_id),
+            'dtype': dtype_name,
+            'variant': variant,
+            'torch': torch.__version__,
+            'transformers': _transformers_version(),
+        }
+        return cls((Path(base_dir) if base_dir else default_snapshot_dir()) / name, fingerprint)
+
+    def is_current(self) -> bool:
+        """The snapshot exists and was written from the same weights with the same library versions"""
+        if not self.path.is_file():
+            return False
+        try:
+            metadata = read_header(self.path)[1].get('__metadata__', {})
+            return json.loads(metadata.get('fingerprint', '{}')) == self.fingerprint
+        except (OSError, ValueError) as e:
+            logger.warning(f"⚠️ Unreadable weight snapshot {self.path}: {e}")
+            return False
+
+    # -- writing -------------------------------------------------------
+
+    def save(self, model):
+        """Write every parameter and buffer as stored in memory (tied tensors once, with aliases)"""
+        from safetensors.torch import save_file
+
+        start = time.perf_counter()
+        tensors: Dict[str, torch.Tensor] = {}
+        aliases: Dict[str, str] = {}
+        parameters = []
+        seen = {}
+        named = [(name, tensor, True) for name, tensor in model.named_parameters(remove_duplicate=False)]
+        named += [(name, tensor, False) for name, tensor in model.named_buffers(remove_duplicate=False)]
+        for name, tensor, is_parameter in named:
+            if tensor is None:
+                continue
+            if is_parameter:
+                parameters.append(name)
+            key = (tensor.data_ptr(), tensor.dtype, tuple(tensor.shape), tensor.stride())
+            if key in seen:
+                aliases[name] = seen[key]
+                continue
+            seen[key] = name
+            data = tensor.detach().to('cpu')
+            # Overlapping views of one storage cannot be stored as separate entries
+            tensors[name] = data.clone() if any(t.data_ptr() == data.data_ptr() for t in tensors.values()) else data.contiguous()
+
+        self.directory.mkdir(parents=True, exist_ok=True)
+        temp_path = self.path.with_suffix('.tmp')
+        save_file(tensors, str(temp_path), metadata={
+            'fingerprint': json.dumps(self.fingerprint),
+            'aliases': json.dumps(aliases),
+            'parameters': json.dumps(parameters),
+        })
+        model.config.save_pretrained(self.directory)
+        if getattr(model, 'generation_config', None) is not None:
+            model.generation_config.save_pretrained(self.directory)
+        os.replace(temp_path, self.path)
+        logger.info(f"💾 Weight snapshot written to {self.path} "
+                    f"({self.path.stat().st_size / 1024**3:.2f} GB in {time.perf_counter() - start:.1f}s)")
+
+    # -- loading -------------------------------------------------------
+
+    def load(self, model_class, device: str = "cpu", prepare: Optional[Callable] = None):
+        """
+        Build `model_class` from the snapshot with zero-copy mmap'd weights.
+        `prepare(model)` reshapes the empty model first (e.g. swaps in quantized modules).
+        """
+        from transformers import AutoConfig, GenerationConfig
+
+        config = AutoConfig.from_pretrained(self.directory)
+        tensors, metadata, mapping = map_tensors(self.path)
+        aliases = json.loads(metadata.get('aliases', '{}'))
+        parameters = set(json.loads(metadata.get('parameters', '[]')))
+        dtype = getattr(torch, json.loads(metadata['fingerprint'])['dtype'])
+
+        with torch.device('meta'):
+            model = model_class._from_config(config, torch_dtype=dtype)
+            if prepare is not None:
+                model = prepare(model)
+
+        for name in list(tensors) + list(aliases):
+            tensor = tensors[aliases.get(name, name)]
+            module_name, _, leaf = name.rpartition('.')
+            module = model.get_submodule(module_name)
+            if name in parameters:
+                # Tied weights resolve to the same Parameter object
+                source = aliases.get(name, name)
+                if source != name:
+                    source_module_name, _, source_leaf = source.rpartition('.')
+                    module._parameters[leaf] = model.get_submodule(source_module_name)._parameters[source_leaf]
+                else:
+                    module._parameters[leaf] = torch.nn.Parameter(tensor, requires_grad=False)
+            else:
+                module._buffers[leaf] = tensor
+
+        missing = [name for name, t in list(model.named_parameters()) + list(model.named_buffers()) if t.is_meta]
+        if missing:
+            raise RuntimeError(f"Weight snapshot is missing {len(missing)} tensors (e.g. {missing[0]})")
+
+        if (self.directory / 'generation_config.json').is_file():
+            model.generation_config = GenerationConfig.from_pretrained(self.directory)
+        model._weight_snapshot_mmap = mapping  # Keep the mapping open for the model's lifetime
+        if device != "cpu":
+            model = model.to(device)
+        return model.eval()
+
+
+def read_header(path: Path):
+    """(data_start, header) of a safetensors file"""
+    with open(path, 'rb') as f:
+        header_size = struct.unpack('<Q', f.read(8))[0]
+        header = json.loads(f.read(header_size))
+    return 8 + header_size, header
+
+
+def map_tensors(path: Path):
+    """
+    Tensors backed directly by a private (copy-on-write) mapping of the file: reads
+    come from the shared page cache, and nothing is copied unless a tensor is written.
+    """
+    data_start, header = read_header(path)
+    metadata = header.pop('__metadata__', {})
+    with open(path, 'rb') as f:
+        mapping = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_COPY)
+    tensors = {}
+    for name, info in header.items():
+        dtype = _SAFETENSORS_DTYPES[info['dtype']]
+        begin, end = info['data_offsets']
+        shape = info['shape']
+        if end == begin:
+            tensors[name] = torch.empty(shape, dtype=dtype)
+            continue
+        tensor = torch.frombuffer(mapping, dtype=dtype, count=(end - begin) // _itemsize(dtype), offset=data_start + begin)
+        tensors[name] = tensor.view(shape)
+    return tensors, metadata, mapping
+
+
+def _itemsize(dtype: torch.dtype) -> int:
+    return torch.empty((), dtype=dtype).element_size()
+
+
+def _transformers_version() -> str:
+    import transformers
+    return transformers.__version__
+
+
+def _memory_mb() -> dict:
+    """
+    Resident memory of this process. On Linux it is split into anonymous (private
+    to the process) and file-backed pages (shareable through the page cache).
+    """
+    try:
+        fields = {}
+        with open('/proc/self/status') as f:
+            for line in f:
+                key, _, value = line.partition(':')
+                if key in ('VmRSS', 'RssAnon', 'RssFile'):
+                    fields[key] = round(int(value.split()[0]) / 1024, 1)
+        return {'rss': fields['VmRSS'], 'anon': fields.get('RssAnon'), 'file': fields.get('RssFile')}
+    except (OSError, KeyError):
+        import resource
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return {'rss': round(peak / 1024**2 if sys.platform == 'darwin' else peak / 1024, 1), 'anon': None, 'file': None}
+
+
+# ----------------------------------------------------------------------
+# CLI: build and compare
+# ----------------------------------------------------------------------
+
+def _load_for_measurement(mode: str, model_id: str):
+    """Load the model one way in this process and report time and memory as JSON"""
+    from transformers import Gemma3nForConditionalGeneration
+
+    dtype = torch.bfloat16 if torch.cuda.is_available() else torch.float32
+    memory_before = _memory_mb()
+    start = time.perf_counter()
+    if mode == 'snapshot':
+        snapshot = WeightSnapshot.for_model(model_id, dtype)
+        if not snapshot.is_current():
+            raise SystemExit("No current snapshot - run with --build first")
+        model = snapshot.load(Gemma3nForConditionalGeneration)
+    else:
+        model = Gemma3nForConditionalGeneration.from_pretrained(
+            model_id, torch_dtype=dtype, low_cpu_mem_usage=True, local_files_only=True
+        ).eval()
+    load_seconds = time.perf_counter() - start
+
+    # One forward pass touches every weight the way a first request would
+    start = time.perf_counter()
+    with torch.inference_mode():
+        model(input_ids=torch.tensor([[2, 1, 2]]))
+    first_forward = time.perf_counter() - start
+    memory = _memory_mb()
+    print(json.dumps({
+        'mode': mode,
+        'load_seconds': round(load_seconds, 2),
+        'first_forward_seconds': round(first_forward, 2),
+        'rss_mb': memory['rss'],
+        'rss_delta_mb': round(memory['rss'] - memory_before['rss'], 1),
+        'anon_mb': memory['anon'],
+        'file_mb': memory['file'],
+    }))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Build or benchmark the pre-converted weight snapshot")
+    parser.add_argument('--model-id', default="google/gemma-3n-e2b-it")
+    parser.add_argument('--build', action='store_true', help="Write the snapshot from the Hugging Face cache")
+    parser.add_argument('--compare', action='store_true', help="Measure both load paths in fresh processes")
+    parser.add_argument('--measure', choices=['hf', 'snapshot'], help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+
+    if args.measure:
+        _load_for_measurement(args.measure, args.model_id)
+        return
+
+    if args.build:
+        from transformers import Gemma3nForConditionalGeneration
+        dtype = torch.bfloat16 if torch.cuda.is_available() else torch.float32
+        model = Gemma3nForConditionalGeneration.from_pretrained(
+            args.model_id, torch_dtype=dtype, low_cpu_mem_usage=True, local_files_only=True
+        ).eval()
+        WeightSnapshot.for_model(args.model_id, dtype).save(model)
+
+    if args.compare:
+        results = []
+        for mode in ('hf', 'snapshot', 'snapshot'):
+            # Each load runs in a new process; the second snapshot load shows the warm page cache
+            output = subprocess.run(
+                [sys.executable, __file__, '--measure', mode, '--model-id', args.model_id],
+                capture_output=True, text=True, check=True
+            ).stdout.strip().splitlines()[-1]
+            results.append(json.loads(output))
+            print(f"⏱️ {mode:8s} load {results[-1]['load_seconds']:7.2f}s | first forward "
+                  f"{results[-1]['first_forward_seconds']:6.2f}s | RSS {results[-1]['rss_mb']:8.1f}MB "
+                  f"(private {results[-1]['anon_mb']}MB, shared file pages {results[-1]['file_mb']}MB)")
+        print(json.dumps(results, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -6,6 +6,9 @@ contextBridge.exposeInMainWorld('electronAPI', {
     // Platform information
     platform: process.platform,
     
+    // Backend server (set AI_TUTOR_BACKEND_URL=http://localhost:5001 for the ASGI server)
+    backendUrl: process.env.AI_TUTOR_BACKEND_URL || 'http://localhost:5000',
+    
     // File operations (if needed for future features)
     openFile: () => ipcRenderer.invoke('dialog:openFile'),
     saveFile: (content) => ipcRenderer.invoke('dialog:saveFile', content),
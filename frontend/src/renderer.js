@@ -4,6 +4,9 @@ class OfflineAITutor {
         this.isConnected = false;
         this.currentTab = 'text-tutor';
         this.currentImage = null;
+        this.currentImagePreviewUrl = null;
+        // Longest side sent to the backend; matches the vision processor's 768x768 input
+        this.imageUploadMaxSize = 768;
         this.connectionRetries = 0;
         this.maxRetries = Infinity;
         this.retryDelay = 2000;
@@ -14,6 +17,9 @@ class OfflineAITutor {
         this.currentStreamingMessage = null;
         this.streamingContent = '';
         this.isWaitingForResponse = false;
+        this.currentMessageId = null;
+        // Answers we asked the backend to stop; their last chunks/complete are ignored
+        this.cancelledMessageIds = new Set();
         
         // Settings tracking for forced reconnection
         this.lastUsedSettings = null;
@@ -30,6 +36,7 @@ class OfflineAITutor {
         }
         this.currentStreamingMessage = null;
         this.streamingContent = '';
+        this.currentMessageId = null;
         
         // CRITICAL FIX: Reset the waiting state
         this.isWaitingForResponse = false;
@@ -114,7 +121,9 @@ class OfflineAITutor {
         });
 
         this.imageElements.imageFileInput.addEventListener('change', (e) => {
-            if (e.target.files[0]) {
+            if (e.target.files.length > 1) {
+                this.handleImageFiles(Array.from(e.target.files));
+            } else if (e.target.files[0]) {
                 this.handleImageFile(e.target.files[0]);
             }
         });
@@ -222,8 +231,10 @@ class OfflineAITutor {
         });
 
         uploadArea.addEventListener('drop', (e) => {
-            const files = e.dataTransfer.files;
-            if (files[0] && files[0].type.startsWith('image/')) {
+            const files = Array.from(e.dataTransfer.files).filter((file) => file.type.startsWith('image/'));
+            if (files.length > 1) {
+                this.handleImageFiles(files);
+            } else if (files[0]) {
                 this.handleImageFile(files[0]);
             }
         });
@@ -289,7 +300,7 @@ class OfflineAITutor {
             this.resetAllState();
             
             // Create new socket connection
-            this.socket = io('http://localhost:5000', {
+            this.socket = io(window.electronAPI?.backendUrl || 'http://localhost:5000', {
                 forceNew: true,
                 upgrade: true,
                 transports: ['polling', 'websocket'],
@@ -393,6 +404,12 @@ class OfflineAITutor {
 
             this.socket.on('model_loading_status', (data) => {
                 console.log('📡 Loading status:', data.message);
+                if (data.progress && data.progress.bytes_total) {
+                    // Weight shard progress only updates the status bar
+                    const percent = Math.round(100 * data.progress.bytes_loaded / data.progress.bytes_total);
+                    this.updateStatus('connecting', `Loading AI Models... ${percent}%`);
+                    return;
+                }
                 this.updateStatus('connecting', 'Loading AI Models...');
                 this.addSystemMessage(data.message, 'info');
             });
@@ -413,6 +430,7 @@ class OfflineAITutor {
                 this.showTypingIndicator(false);
                 this.currentStreamingMessage = this.addTextMessage('', 'assistant');
                 this.streamingContent = '';
+                this.currentMessageId = data.message_id;
                 
                 console.log('✅ Started new streaming message');
             });
@@ -427,10 +445,17 @@ class OfflineAITutor {
                 console.log('🔍 Current streaming message exists:', !!this.currentStreamingMessage);
                 console.log('='.repeat(80));
                 
+                if (this.cancelledMessageIds.has(data.message_id)) {
+                    return;
+                }
+                
+                // Chunks are incremental - append to what we already have
+                this.streamingContent += data.content || '';
+                
                 if (this.currentStreamingMessage) {
                     const contentDiv = this.currentStreamingMessage.querySelector('.message-text');
                     if (contentDiv) {
-                        contentDiv.innerHTML = this.formatMessage(data.content);
+                        contentDiv.innerHTML = this.formatMessage(this.streamingContent);
                         this.scrollToBottom(this.textElements.chatContainer);
                         console.log('✅ Message content updated in DOM');
                     } else {
@@ -439,7 +464,7 @@ class OfflineAITutor {
                 } else {
                     console.error('❌ No current streaming message to update');
                     // Emergency: create message
-                    this.currentStreamingMessage = this.addTextMessage(data.content, 'assistant');
+                    this.currentStreamingMessage = this.addTextMessage(this.streamingContent, 'assistant');
                     console.log('🆘 Created emergency message');
                 }
             });
@@ -451,16 +476,64 @@ class OfflineAITutor {
                 console.log('🕐 Received at:', new Date().toISOString());
                 console.log('='.repeat(80));
                 
+                if (this.cancelledMessageIds.delete(data.message_id)) {
+                    console.log('🛑 Cancelled response finished on the backend');
+                    return;
+                }
+                
+                if (data.truncated && this.currentStreamingMessage) {
+                    // The server stopped at its time limit (at a sentence end when it could)
+                    const note = document.createElement('div');
+                    note.className = 'message-note';
+                    note.textContent = '⏱️ Answer shortened to stay within the time limit';
+                    const textDiv = this.currentStreamingMessage.querySelector('.message-text');
+                    if (textDiv) {
+                        textDiv.insertAdjacentElement('afterend', note);
+                    }
+                }
+                
                 this.currentStreamingMessage = null;
                 this.streamingContent = '';
                 console.log('✅ Streaming completed and reset');
                 this.completeStreamingResponse();
             });
 
+            this.socket.on('queue_position', (data) => {
+                console.log('🚦 Queue position:', data.position, 'estimated wait:', data.estimated_wait);
+                this.showQueuePosition(data);
+            });
+
+            this.socket.on('busy', (data) => {
+                this.handleBusy(data);
+            });
+
+            this.socket.on('image_analysis_start', () => {
+                // Our turn after waiting in line
+                this.imageElements.analyzeImageButton.innerHTML = `
+                    <span class="analyze-icon">⏳</span>
+                    <span class="analyze-text">Analyzing...</span>
+                `;
+            });
+
             this.socket.on('image_analysis_result', (data) => {
                 this.displayImageAnalysisResult(data.result);
             });
 
+            this.socket.on('image_batch_start', (data) => {
+                this.imageElements.analyzeImageButton.innerHTML = `
+                    <span class="analyze-icon">⏳</span>
+                    <span class="analyze-text">Analyzing ${data.count} images...</span>
+                `;
+            });
+
+            this.socket.on('image_batch_result', (data) => {
+                this.displayImageBatchResult(data);
+            });
+
+            this.socket.on('image_batch_complete', (data) => {
+                this.completeImageBatch(data);
+            });
+
             this.socket.on('error', (data) => {
                 this.handleError(data.message, data.context);
                 // Reset state after error
@@ -560,8 +633,12 @@ class OfflineAITutor {
         }
 
         if (this.isWaitingForResponse) {
-            this.addSystemMessage('Please wait for current response to complete', 'warning');
-            return;
+            if (!this.currentMessageId) {
+                this.addSystemMessage('Please wait for current response to complete', 'warning');
+                return;
+            }
+            // A new question replaces the answer still streaming
+            this.cancelCurrentResponse();
         }
 
         const settings = this.getCurrentTextSettings();
@@ -601,6 +678,20 @@ class OfflineAITutor {
         });
     }
 
+    cancelCurrentResponse() {
+        console.log('🛑 Cancelling response', this.currentMessageId);
+        this.cancelledMessageIds.add(this.currentMessageId);
+        this.socket.emit('cancel_generation', { message_id: this.currentMessageId });
+        
+        if (this.currentStreamingMessage) {
+            const contentDiv = this.currentStreamingMessage.querySelector('.message-text');
+            if (contentDiv) {
+                contentDiv.innerHTML = this.formatMessage(this.streamingContent + ' …');
+            }
+        }
+        this.completeStreamingResponse();
+    }
+
     settingsChanged(oldSettings, newSettings) {
         return (
             oldSettings.subject !== newSettings.subject ||
@@ -719,13 +810,55 @@ class OfflineAITutor {
             return;
         }
 
-        const reader = new FileReader();
-        reader.onload = (e) => {
-            this.displayImagePreview(e.target.result);
-            this.currentImage = e.target.result;
-            this.updateAnalyzeButton();
-        };
-        reader.readAsDataURL(file);
+        // Keep the File itself; it is downscaled and sent as binary when analyzed
+        this.releaseImagePreviewUrl();
+        this.currentImagePreviewUrl = URL.createObjectURL(file);
+        this.displayImagePreview(this.currentImagePreviewUrl);
+        this.currentImage = file;
+        this.updateAnalyzeButton();
+    }
+
+    handleImageFiles(files) {
+        // Several pages (e.g. a worksheet) are answered together in one ask_image_batch request
+        const images = files.filter((file) => file.type.startsWith('image/'));
+        if (images.length === 0) {
+            this.addSystemMessage('Please select valid image files.', 'error');
+            return;
+        }
+
+        this.releaseImagePreviewUrl();
+        this.currentImagePreviewUrl = URL.createObjectURL(images[0]);
+        this.displayImagePreview(this.currentImagePreviewUrl);
+        this.currentImage = images;
+        this.addSystemMessage(`${images.length} images selected; each page gets its own answer.`, 'info');
+        this.updateAnalyzeButton();
+    }
+
+    releaseImagePreviewUrl() {
+        if (this.currentImagePreviewUrl) {
+            URL.revokeObjectURL(this.currentImagePreviewUrl);
+            this.currentImagePreviewUrl = null;
+        }
+    }
+
+    async prepareImageUpload(file) {
+        // Downscale on the client so large phone photos are never uploaded at full size
+        const bitmap = await createImageBitmap(file);
+        const scale = Math.min(1, this.imageUploadMaxSize / Math.max(bitmap.width, bitmap.height));
+
+        if (scale === 1 && (file.type === 'image/jpeg' || file.type === 'image/png')) {
+            bitmap.close();
+            return { buffer: await file.arrayBuffer(), type: file.type };
+        }
+
+        const canvas = document.createElement('canvas');
+        canvas.width = Math.round(bitmap.width * scale);
+        canvas.height = Math.round(bitmap.height * scale);
+        canvas.getContext('2d').drawImage(bitmap, 0, 0, canvas.width, canvas.height);
+        bitmap.close();
+
+        const blob = await new Promise((resolve) => canvas.toBlob(resolve, 'image/jpeg', 0.9));
+        return { buffer: await blob.arrayBuffer(), type: 'image/jpeg' };
     }
 
     loadImageFromUrl() {
@@ -739,6 +872,7 @@ class OfflineAITutor {
             return;
         }
 
+        this.releaseImagePreviewUrl();
         this.displayImagePreview(url);
         this.currentImage = url;
         this.updateAnalyzeButton();
@@ -752,6 +886,7 @@ class OfflineAITutor {
 
     removeImage() {
         this.currentImage = null;
+        this.releaseImagePreviewUrl();
         this.imageElements.imagePreviewContainer.style.display = 'none';
         this.imageElements.imageUploadArea.style.display = 'block';
         this.imageElements.imageUrlInput.value = '';
@@ -764,7 +899,7 @@ class OfflineAITutor {
         this.imageElements.analyzeImageButton.disabled = !(hasImage && hasQuestion && this.isConnected);
     }
 
-    analyzeImage() {
+    async analyzeImage() {
         if (!this.currentImage || !this.isConnected) return;
 
         const question = this.imageElements.imageQuestionInput.value.trim();
@@ -776,11 +911,49 @@ class OfflineAITutor {
             <span class="analyze-text">Analyzing...</span>
         `;
 
-        console.log('📤 Sending image analysis request...');
-        this.socket.emit('ask_image_question', {
-            image_url: this.currentImage,
-            question: question
-        });
+        if (Array.isArray(this.currentImage)) {
+            try {
+                const uploads = await Promise.all(this.currentImage.map((file) => this.prepareImageUpload(file)));
+                console.log(`📤 Sending batch of ${uploads.length} images...`);
+                this.socket.emit('ask_image_batch', {
+                    images: uploads.map((upload) => ({
+                        image: upload.buffer,
+                        image_type: upload.type,
+                        question: question
+                    })),
+                    settings: this.getCurrentTextSettings()
+                });
+            } catch (error) {
+                console.error('❌ Failed to prepare images:', error);
+                this.handleError('Could not read the selected images.', 'image-analyzer');
+            }
+            return;
+        }
+
+        if (typeof this.currentImage === 'string') {
+            console.log('📤 Sending image analysis request...');
+            this.socket.emit('ask_image_question', {
+                image_url: this.currentImage,
+                question: question,
+                settings: this.getCurrentTextSettings()
+            });
+            return;
+        }
+
+        try {
+            const upload = await this.prepareImageUpload(this.currentImage);
+            console.log(`📤 Sending image analysis request (${(upload.buffer.byteLength / 1024).toFixed(0)}KB binary)...`);
+            // ArrayBuffers are sent as Socket.IO binary attachments, no base64 encoding
+            this.socket.emit('ask_image_question', {
+                image: upload.buffer,
+                image_type: upload.type,
+                question: question,
+                settings: this.getCurrentTextSettings()
+            });
+        } catch (error) {
+            console.error('❌ Failed to prepare image:', error);
+            this.handleError('Could not read the selected image.', 'image-analyzer');
+        }
     }
 
     displayImageAnalysisResult(result) {
@@ -790,11 +963,33 @@ class OfflineAITutor {
             <span class="analyze-text">Analyze Image</span>
         `;
 
+        this.appendImageResult(result, '🔍 Analysis Result');
+
+        this.imageElements.imageQuestionInput.value = '';
+        this.updateAnalyzeButton();
+    }
+
+    displayImageBatchResult(data) {
+        // Results arrive in the order they finish, not page order
+        this.appendImageResult(data.result, `🔍 Page ${data.index + 1}`);
+    }
+
+    completeImageBatch(data) {
+        this.imageElements.analyzeImageButton.disabled = false;
+        this.imageElements.analyzeImageButton.innerHTML = `
+            <span class="analyze-icon">🔍</span>
+            <span class="analyze-text">Analyze Image</span>
+        `;
+        this.imageElements.imageQuestionInput.value = '';
+        this.updateAnalyzeButton();
+    }
+
+    appendImageResult(result, title) {
         const resultDiv = document.createElement('div');
         resultDiv.className = 'analysis-result';
         resultDiv.innerHTML = `
             <div class="result-header">
-                <h3>🔍 Analysis Result</h3>
+                <h3>${title}</h3>
                 <div class="result-time">${new Date().toLocaleTimeString()}</div>
             </div>
             <div class="result-question">
@@ -807,9 +1002,6 @@ class OfflineAITutor {
 
         this.imageElements.imageResultsContainer.appendChild(resultDiv);
         this.scrollToBottom(this.imageElements.imageResultsContainer);
-
-        this.imageElements.imageQuestionInput.value = '';
-        this.updateAnalyzeButton();
     }
 
     formatMessage(text) {
@@ -820,11 +1012,42 @@ class OfflineAITutor {
             .replace(/\n/g, '<br>');
     }
 
-    showTypingIndicator(show) {
+    showTypingIndicator(show, text = 'AI Tutor is thinking...') {
         this.textElements.typingIndicator.style.display = show ? 'flex' : 'none';
+        const typingText = this.textElements.typingIndicator.querySelector('.typing-text');
+        if (typingText) typingText.textContent = text;
         if (show) this.scrollToBottom(this.textElements.chatContainer);
     }
 
+    showQueuePosition(data) {
+        const wait = data.estimated_wait ? ` (about ${Math.ceil(data.estimated_wait)}s)` : '';
+        if (data.context === 'text-tutor') {
+            // Lets a new question cancel this one while it is still waiting
+            this.currentMessageId = data.message_id;
+            this.showTypingIndicator(true, `Waiting in line: position ${data.position}${wait}...`);
+        } else if (data.context === 'image-analyzer') {
+            this.imageElements.analyzeImageButton.innerHTML = `
+                <span class="analyze-icon">⏳</span>
+                <span class="analyze-text">In line: #${data.position}${wait}</span>
+            `;
+        }
+    }
+
+    handleBusy(data) {
+        console.warn('🚦 Backend busy:', data.reason);
+        if (data.context === 'text-tutor') {
+            this.showTypingIndicator(false);
+            this.completeStreamingResponse();
+        } else if (data.context === 'image-analyzer') {
+            this.imageElements.analyzeImageButton.disabled = false;
+            this.imageElements.analyzeImageButton.innerHTML = `
+                <span class="analyze-icon">🔍</span>
+                <span class="analyze-text">Analyze Image</span>
+            `;
+        }
+        this.addSystemMessage(`⏳ ${data.message}`, 'warning');
+    }
+
     handleError(message, context) {
         console.error(`❌ Error in ${context}:`, message);
         